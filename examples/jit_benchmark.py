@@ -0,0 +1,59 @@
+import numpy as np
+from time import time
+
+from rayflare.ray_tracing.rt import rt_structure
+from rayflare.ray_tracing.jit_kernel import jit_available
+from rayflare.textures import regular_pyramids, planar_surface
+from rayflare.options import default_options
+
+from solcore import material
+from solcore import si
+
+# Benchmark of the compiled ray-tracing kernel (options.jit_kernel = True, requires numba) against the same
+# one-ray-at-a-time calculation in Python, for the structure in full_RT_Sipyramids.py: 300 um of Si with 2 um inverted
+# pyramids on the front and a planar rear surface. The vectorized ray packet tracer (the default) is included for
+# comparison. The first calculation with the compiled kernel includes the time to compile it (which is cached, so it
+# is only done once).
+
+Air = material('Air')()
+Si = material('Si')()
+
+nxy = 5
+
+options = default_options()
+options.wavelengths = np.linspace(300, 1200, 10) * 1e-9
+options.nx = nxy
+options.ny = nxy
+options.n_rays = 40 * nxy ** 2
+options.depth_spacing = si('1um')
+options.parallel = False
+
+flat_surf = planar_surface(size=2)
+triangle_surf = regular_pyramids(55, upright=False, size=2)
+
+rtstr = rt_structure(textures=[triangle_surf, flat_surf], materials=[Si], widths=[si('300um')],
+                     incidence=Air, transmission=Air)
+
+if not jit_available:
+    print('numba is not installed: the compiled kernel is not available.')
+
+methods = [('Python', False, False), ('compiled (including compilation)', False, True), ('compiled', False, True),
+           ('ray packets', True, False)]
+
+results = {}
+
+for name, ray_packets, jit in methods:
+    options.ray_packets = ray_packets
+    options.jit_kernel = jit
+    np.random.seed(0)
+    start = time()
+    result = rtstr.calculate(options)
+    results[name] = result
+    print('{}: {:.2f} s, R = {}, A = {}'.format(name, time() - start, np.round(result['R'], 3),
+                                              np.round(result['A_per_layer'][:, 0], 3)))
+
+# the results agree within the statistical error
+for name in results:
+    print(name, 'max. deviation of R from Python / standard error:',
+          np.max(np.abs(results[name]['R'] - results['Python']['R']) /
+                 np.sqrt(results[name]['R_err']**2 + results['Python']['R_err']**2 + 1e-12)))
@@ -0,0 +1,83 @@
+import numpy as np
+
+from rayflare.ray_tracing.rt import rt_structure
+from rayflare.textures import regular_pyramids, planar_surface
+from rayflare.options import default_options
+
+from solcore import material
+from solcore import si
+
+# imports for plotting
+import matplotlib.pyplot as plt
+import seaborn as sns
+
+# Benchmark of the error in R and A against the number of rays traced, for different choices of the sequence used
+# to choose the ray positions (options.ray_sequence) and of the random numbers used to decide whether rays are
+# reflected or transmitted (options.decision_sampling). The error is the RMS deviation from a calculation with a
+# large number of rays, over n_repeats calculations with different random seeds. The rays are launched from a grid of
+# nx x ny positions, so the number of positions is increased together with the number of rays.
+
+Air = material('Air')()
+Si = material('Si')()
+
+options = default_options()
+options.wavelengths = np.array([600, 1050]) * 1e-9
+options.parallel = False
+
+nxy_list = np.array([4, 6, 9, 13, 19])
+n_rays_list = 4*nxy_list**2
+n_repeats = 20
+
+rtstr = rt_structure(textures=[regular_pyramids(), planar_surface()], materials=[Si],
+                     widths=[si('200um')], incidence=Air, transmission=Air)
+
+# reference result
+options.nx = 60
+options.ny = 60
+options.n_rays = 10*60**2
+options.decision_sampling = 'stratified'
+np.random.seed(0)
+result = rtstr.calculate(options)
+reference = np.concatenate((result['R'], result['A_per_layer'][:, 0]))
+
+options.random_ray_position = True
+
+methods = [('random', 'random'), ('sobol', 'random'), ('random', 'stratified'), ('random', 'antithetic'),
+           ('sobol', 'stratified')]
+
+errors = np.zeros((len(methods), len(n_rays_list), len(reference)))
+
+for i1, (sequence, sampling) in enumerate(methods):
+    options.ray_sequence = sequence
+    options.decision_sampling = sampling
+
+    for i2, (nxy, n_rays) in enumerate(zip(nxy_list, n_rays_list)):
+        options.nx = nxy
+        options.ny = nxy
+        options.n_rays = n_rays
+        res = []
+        for seed in range(n_repeats):
+            np.random.seed(seed + 1)
+            result = rtstr.calculate(options)
+            res.append(np.concatenate((result['R'], result['A_per_layer'][:, 0])))
+
+        errors[i1, i2] = np.sqrt(np.mean((np.array(res) - reference)**2, 0))
+        print(sequence, sampling, n_rays, errors[i1, i2])
+
+pal = sns.color_palette("husl", len(methods))
+labels = ['R, 600 nm', 'R, 1050 nm', 'A, 600 nm', 'A, 1050 nm']
+
+fig, axes = plt.subplots(1, len(reference), figsize=(14, 3.7))
+
+for i3, ax in enumerate(axes):
+    for i1, (sequence, sampling) in enumerate(methods):
+        ax.loglog(n_rays_list, errors[i1, :, i3], '-o', color=pal[i1], label=sequence + ' / ' + sampling)
+
+    ax.loglog(n_rays_list, errors[0, 0, i3]*np.sqrt(n_rays_list[0]/n_rays_list), '--k', label=r'$N^{-1/2}$')
+    ax.set_xlabel('Number of rays')
+    ax.set_title(labels[i3])
+
+axes[0].set_ylabel('RMS error')
+axes[0].legend()
+plt.tight_layout()
+plt.show()
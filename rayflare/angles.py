@@ -1,12 +1,105 @@
 import numpy as np
 import xarray as xr
+from functools import lru_cache
 import matplotlib.pyplot as plt
 import seaborn as sns
 import matplotlib as mpl
 
 
+class AngleGrid:
+    """Immutable angular discretization used for the redistribution matrices. Rather than creating these directly, use
+    angle_grid, which returns a cached instance for each set of parameters. All the arrays are read-only.
+
+    :param n_angle_bins: number of bins per 90 degrees in the polar direction (theta)
+    :param phi_sym: phi angle (in radians) for the rotational symmetry of the unit cell; e.g. for a square-based pyramid,
+    pi/4
+    :param c_azimuth: a number between 0 and 1 which determines how finely the space is discretized in the
+    azimuthal direction (see make_angle_vector).
+
+    Attributes:
+
+    - theta_intv: edges of the theta (polar angle) bins
+    - theta_middle: centre of each theta bin
+    - phi_intv: tuple with the edges of the phi bins for every theta bin
+    - phi_edges: phi_intv as a single array of shape (n_theta, max. number of phi edges), padded with infinity
+    - n_phis: number of phi bins for every theta bin
+    - bin_start: global index (row in angle_vector) of the first bin for every theta bin
+    - angle_vector: array where the first column is the theta bin index, the second column the mean theta for that \
+    bin, and the third column is the mean phi for that bin.
+    - n_bins: total number of angular bins (len(angle_vector))
+    - n_a_in: number of bins in each half (0 -> 90 degrees and 90 -> 180 degrees); the front half is \
+    angle_vector[:n_a_in] and the rear half angle_vector[n_a_in:]
+    """
+    def __init__(self, n_angle_bins, phi_sym, c_azimuth):
+        sin_a_b = np.linspace(0, 1, n_angle_bins+1) # number of bins is between 0 and 90 degrees
+        # even spacing in terms of sin(theta) rather than theta
+        # will have the same number of bins between 90 and 180 degrees
+
+        theta_intv = np.concatenate([np.arcsin(sin_a_b), np.pi-np.flip(np.arcsin(sin_a_b[:-1]))])
+        theta_middle = (theta_intv[:-1] + theta_intv[1:])/2
+
+        # ring index r which determines the number of phi bins; counts up from 1 at 0 and 180 degrees
+        ring = np.arange(1, len(theta_middle) + 1)
+        ring = np.where(theta_middle > np.pi/2, len(theta_intv) - ring, ring)
+
+        phi_intv = tuple(np.linspace(0, phi_sym, int(np.ceil(c_azimuth*ind)+1)) for ind in ring)
+        phi_edges, n_phis, bin_start = phi_bin_edges(phi_intv)
+
+        angle_vector = np.stack([np.repeat(np.arange(len(theta_middle)), n_phis),
+                                 np.repeat(theta_middle, n_phis),
+                                 np.concatenate([(x[:-1] + x[1:])/2 for x in phi_intv])], axis=1)
+
+        for arr in (theta_intv, theta_middle, n_phis, phi_edges, bin_start, angle_vector) + phi_intv:
+            arr.flags.writeable = False
+
+        values = dict(n_angle_bins=n_angle_bins, phi_sym=phi_sym, c_azimuth=c_azimuth,
+                      theta_intv=theta_intv, theta_middle=theta_middle, phi_intv=phi_intv, phi_edges=phi_edges,
+                      n_phis=n_phis, bin_start=bin_start, angle_vector=angle_vector, n_bins=len(angle_vector),
+                      n_a_in=int(len(angle_vector)/2))
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('AngleGrid is immutable')
+
+    def __reduce__(self):
+        # only the parameters are pickled (e.g. when the grid is sent to parallel workers); the grid is then taken from
+        # the cache of angle_grid
+        return angle_grid, (self.n_angle_bins, self.phi_sym, self.c_azimuth)
+
+    def global_index(self, theta_bins, phi_index):
+        """Global bin index (row in angle_vector) for the given theta bin indices and phi bin indices within each
+        theta bin."""
+        return self.bin_start[theta_bins] + phi_index
+
+    def theta_bin(self, thetas):
+        """Index of the theta bin for each polar angle (see theta_bin)."""
+        return theta_bin(thetas, self.theta_intv)
+
+    def overall_bin(self, theta_bins, phis):
+        """Global bin index for arrays of theta bin indices and (folded) phi angles (see overall_bin)."""
+        return _overall_bin(theta_bins, phis, self.phi_edges, self.n_phis, self.bin_start)
+
+    def angle_bin(self, thetas, phis):
+        """Global bin index for arrays of (theta, phi) pairs (see angle_bin)."""
+        return self.overall_bin(self.theta_bin(thetas), phis)
+
+
+@lru_cache(maxsize=None)
+def angle_grid(n_angle_bins, phi_sym, c_azimuth):
+    """Returns the (cached) AngleGrid for these parameters.
+
+    :param n_angle_bins: number of bins per 90 degrees in the polar direction (theta)
+    :param phi_sym: phi angle (in radians) for the rotational symmetry of the unit cell
+    :param c_azimuth: a number between 0 and 1 which determines how finely the space is discretized in the
+    azimuthal direction.
+    """
+    return AngleGrid(n_angle_bins, phi_sym, c_azimuth)
+
+
 def make_angle_vector(n_angle_bins, phi_sym, c_azimuth):
-    """Makes the binning intervals & angle vector depending on the relevant options.
+    """Makes the binning intervals & angle vector depending on the relevant options. The values are taken from the
+    cached AngleGrid (see angle_grid); this function returns writeable copies.
     :param n_angle_bins: number of bins per 90 degrees in the polar direction (theta)
     :param phi_sym: phi angle (in radians) for the rotational symmetry of the unit cell; e.g. for a square-based pyramid,
     pi/4
@@ -18,35 +111,106 @@ def make_angle_vector(n_angle_bins, phi_sym, c_azimuth):
     :return angle_vector: array where the first column is the r index (theta bin), the second column in
     the mean theta for that bin, and the third column is the mean phi for that bin.
     """
-    sin_a_b = np.linspace(0, 1, n_angle_bins+1) # number of bins is between 0 and 90 degrees
-    # even spacing in terms of sin(theta) rather than theta
-    # will have the same number of bins between 90 and 180 degrees
+    grid = angle_grid(n_angle_bins, phi_sym, c_azimuth)
+
+    return grid.theta_intv.copy(), [x.copy() for x in grid.phi_intv], grid.angle_vector.copy()
+
+
+def theta_bin(thetas, theta_intv):
+    """Finds the index of the theta bin each polar angle falls into. Angles exactly on the edge between two bins are
+    placed in the lower bin (as for np.digitize with right=True); angles larger than the last edge get the index
+    len(theta_intv) - 1.
+
+    :param thetas: array of polar angles (in radians)
+    :param theta_intv: edges of the theta bins (output from make_angle_vector)
+    :return: array of theta bin indices
+    """
+    return np.maximum(np.digitize(thetas, theta_intv, right=True) - 1, 0)
+
+
+def phi_bin_edges(phi_intv):
+    """Stores the phi bin edges for every theta bin in a single array, padded with infinity, so that they can be
+    indexed by theta bin.
+
+    :param phi_intv: list with the edges of the phi bins for every theta bin (output from make_angle_vector)
+    :return: phi_edges: array of shape (len(phi_intv), max. number of phi edges) \
+    n_phis: number of phi bins for every theta bin \
+    bin_start: index in angle_vector of the first bin for every theta bin
+    """
+    n_phis = np.array([len(x) - 1 for x in phi_intv])
+    phi_edges = np.full((len(phi_intv), np.max(n_phis) + 1), np.inf)
+    for i1, edges in enumerate(phi_intv):
+        phi_edges[i1, :len(edges)] = edges
+    bin_start = np.concatenate(([0], np.cumsum(n_phis)[:-1]))
+
+    return phi_edges, n_phis, bin_start
+
+
+def overall_bin(theta_bins, phis, phi_intv):
+    """Finds the overall (global) bin index, i.e. the row in angle_vector, for arrays of theta bin indices and
+    azimuthal angles. The phi bins are found arithmetically (they are evenly spaced) and then checked against the bin
+    edges, so the result is the same as using np.digitize with right=True on phi_intv[theta_bin]; phi values outside
+    the range of the bins are put in the first or last phi bin of that theta bin.
+
+    :param theta_bins: array of theta bin indices (e.g. from theta_bin)
+    :param phis: array of azimuthal angles (in radians), already folded into the symmetry element using fold_phi
+    :param phi_intv: list with the edges of the phi bins for every theta bin (output from make_angle_vector)
+    :return: array of global bin indices
+    """
+    return _overall_bin(theta_bins, phis, *phi_bin_edges(phi_intv))
+
+
+def _overall_bin(theta_bins, phis, phi_edges, n_phis, bin_start):
+    theta_bins = np.asarray(theta_bins)
+    phis = np.asarray(phis, dtype=float)
 
-    theta_intv= np.concatenate([np.arcsin(sin_a_b), np.pi-np.flip(np.arcsin(sin_a_b[:-1]))])
+    n = n_phis[theta_bins]
+    ind = np.ceil(phis * n / phi_edges[theta_bins, n]).astype(int) - 1
+    ind = np.clip(ind, 0, n - 1)
+    # correct for rounding errors: bin i1 is phi_edges[i1] < phi <= phi_edges[i1+1]
+    ind = np.where((phis <= phi_edges[theta_bins, ind]) & (ind > 0), ind - 1, ind)
+    ind = np.where((phis > phi_edges[theta_bins, ind + 1]) & (ind < n - 1), ind + 1, ind)
 
-    theta_middle = (theta_intv[:-1] + theta_intv[1:])/2
-    phi_intv = []
-    angle_vector = np.empty((0,3))
+    return bin_start[theta_bins] + ind
 
-    for i1, theta in enumerate(theta_middle):
-        if theta > np.pi/2:
-            ind = len(theta_intv)-(i1 + 1) # + 1 because Python is zero-indexed
-        else:
-            ind = i1 + 1
 
-        phi_intv.append(np.linspace(0, phi_sym, int(np.ceil(c_azimuth*ind)+1)))
-        phi_middle = (phi_intv[i1][:-1] + phi_intv[i1][1:])/2
+def angle_bin(thetas, phis, theta_intv, phi_intv):
+    """Finds the global bin index (row in angle_vector) for arrays of (theta, phi) pairs in a single vectorized call.
 
-        angle_vector = np.append(angle_vector, np.array([np.array(len(phi_middle)*[i1]),
-                                      np.array(len(phi_middle)*[theta]),
-                                          phi_middle]).T, axis = 0)
+    :param thetas: array of polar angles (in radians)
+    :param phis: array of azimuthal angles (in radians), already folded into the symmetry element using fold_phi
+    :param theta_intv: edges of the theta bins (output from make_angle_vector)
+    :param phi_intv: list with the edges of the phi bins for every theta bin (output from make_angle_vector)
+    :return: array of global bin indices
+    """
+    return overall_bin(theta_bin(thetas, theta_intv), phis, phi_intv)
+
+
+def accumulate_bins(bin_out, bin_in, n_out, n_in, weights=None):
+    """Adds up weights (or counts, if weights is None) in a matrix of shape (n_out, n_in) at the positions
+    (bin_out, bin_in). Repeated positions are summed.
+
+    :param bin_out: array of row indices
+    :param bin_in: array of column indices
+    :param n_out: number of rows
+    :param n_in: number of columns
+    :param weights: array of weights with the same length as bin_out and bin_in, or None.
+    :return: float array of shape (n_out, n_in)
+    """
+    flat_index = np.asarray(bin_out) * n_in + np.asarray(bin_in)
+    summed = np.bincount(flat_index.astype(int), weights, minlength=n_out * n_in)
+    return summed.reshape((n_out, n_in)).astype(float)
 
-    return theta_intv, phi_intv, angle_vector
 
 def fold_phi(phis, phi_sym):
     """'Folds' phi angles back into symmetry element from 0 -> phi_sym radians"""
     return (abs(phis//np.pi)*2*np.pi + phis) % phi_sym
 
+def fold_phi_mirror(phis):
+    """'Folds' phi angles back into the range 0 -> pi/2 radians using the mirror symmetry in the xz and yz planes,
+    for structures which are not symmetric under rotations by pi/2 (e.g. V-grooves)"""
+    return np.arctan2(np.abs(np.sin(phis)), np.abs(np.cos(phis)))
+
 def theta_summary(out_mat, angle_vector, n_theta_bins, front_or_rear="front"):
     """
     Accepts an RT redistribution matrix and sums it over all the azimuthal angle bins to create an output
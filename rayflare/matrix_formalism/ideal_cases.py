@@ -2,7 +2,7 @@ import numpy as np
 import os
 from rayflare.config import results_path
 from sparse import COO, load_npz, save_npz
-from rayflare.angles import fold_phi
+from rayflare.angles import fold_phi, angle_bin, accumulate_bins
 
 def lambertian_matrix(angle_vector, theta_intv, surf_name, options, front_or_rear='front', save=True):
     """
@@ -117,26 +117,12 @@ def mirror_matrix(angle_vector, theta_intv, phi_intv, surf_name, options, front_
 
         # matrix will be all zeros with just one '1' in each column/row. Just need to determine where it goes
 
-        binned_theta = np.digitize(angle_vector_th, theta_intv, right=True) - 1
-
-        # print(binned_theta_out, theta_out, theta_intv)
-
-        # print(binned_theta_in)
-        # print(binned_theta_out)
-        # -1 to give the correct index for the bins in phi_intv
-
-
         bin_in = np.arange(len(angle_vector_phi))
+        bin_out = angle_bin(angle_vector_th, phis_out, theta_intv, phi_intv)
 
-        phi_ind = [np.digitize(phi, phi_intv[binned_theta[i1]], right=True) - 1 for i1, phi in enumerate(phis_out)]
-        overall_bin = [np.argmin(abs(angle_vector[:,0] - binned_theta[i1])) + phi_i for i1, phi_i in enumerate(phi_ind)]
-
-        whole_matrix = np.zeros((len(overall_bin)*2, len(overall_bin)))
-
-        whole_matrix[overall_bin, bin_in] = 1
-
+        whole_matrix = accumulate_bins(bin_out, bin_in, len(bin_in)*2, len(bin_in))
 
-        A_matrix = np.zeros((1, len(overall_bin)))
+        A_matrix = np.zeros((1, len(bin_in)))
 
         allArray = COO(whole_matrix)
         absArray = COO(A_matrix)
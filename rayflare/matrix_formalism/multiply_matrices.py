@@ -1,19 +1,33 @@
 import numpy as np
-from sparse import load_npz, dot, COO, stack
+import scipy
+from sparse import load_npz, dot, COO
+from scipy.sparse import csr_matrix, issparse, identity, kron, vstack
+from scipy.sparse.linalg import spsolve, gmres
+from warnings import warn
 from rayflare.config import results_path
-from rayflare.angles import make_angle_vector, fold_phi
+from rayflare.angles import angle_grid, fold_phi, angle_bin
 import os
 import xarray as xr
 from rayflare.structure import Interface, BulkLayer
 
+# the relative tolerance of gmres is called tol before scipy 1.12 (and rtol from 1.12 on, when tol is deprecated)
+_gmres_rtol = 'rtol' if tuple(int(x) for x in scipy.__version__.split('.')[:2]) >= (1, 12) else 'tol'
 
-def calculate_RAT(SC, options):
+
+def calculate_RAT(SC, options, incidence=None):
     """
     After the list of Interface and BulkLayers has been processed by process_structure,
     this function calculates the R, A and T by calling matrix_multiplication.
 
+    Several incident angles can be calculated together, with the same matrices, by setting options['theta_in'] (and
+    optionally options['phi_in']) to a list or array of angles, or by passing the angular distributions of the
+    incident light in incidence. The results then have an additional dimension 'incidence'.
+
     :param SC: list of Interface and BulkLayer objects. Order is [Interface, BulkLayer, Interface]
     :param options: options for the matrix calculations
+    :param incidence: optional array with the fraction of the incident power in each incoming angular bin (see \
+    make_v0), of shape (n_angle_bins_in) or (n_incidence, n_angle_bins_in) for several distributions. If given, \
+    options['theta_in'] and options['phi_in'] are not used.
     """
 
     bulk_mats = []
@@ -37,7 +51,8 @@ def calculate_RAT(SC, options):
 
 
     results = matrix_multiplication(bulk_mats, bulk_widths, options,
-                                                               layer_widths, n_layers, layer_names, calc_prof_list)
+                                                               layer_widths, n_layers, layer_names, calc_prof_list,
+                                    incidence)
 
     return results
 
@@ -47,22 +62,28 @@ def make_v0(th_in, phi_in, num_wl, n_theta_bins, c_azimuth, phi_sym):
     This function makes the v0 array, corresponding to the input power per angular channel
     at each wavelength, of size (num_wl, n_angle_bins_in) where n_angle_bins in = len(angle_vector)/2
 
-    :param th_in: Polar angle of the incoming light (in radians)
+    :param th_in: Polar angle of the incoming light (in radians), or a list or array of angles for several \
+    incidences.
     :param phi_in: Azimuthal angle of the incoming light (in radians), or can be set as 'all' \
-    in which case the power is spread equally over all the phi bins for the relevant theta.
+    in which case the power is spread equally over all the phi bins for the relevant theta. For several incidences, \
+    a single value (angle or 'all'), which is then used for every angle in th_in, or a list with a value for each.
     :param num_wl: Number of wavelengths
     :param n_theta_bins: Number of theta bins in the matrix multiplication
     :param c_azimuth: c_azimuth used to generate the matrices being multiplied
 
-    :return: v0, an array of size (num_wl, n_angle_bins_in)
+    :return: v0, an array of size (num_wl, n_angle_bins_in), or (num_wl, n_incidence, n_angle_bins_in) if th_in is \
+    a list or array, with n_incidence = len(th_in) (also if a single phi_in is given)
     """
-
-    theta_intv, phi_intv, angle_vector = make_angle_vector(n_theta_bins, phi_sym, c_azimuth)
-    n_a_in = int(len(angle_vector)/2)
-    v0 = np.zeros((num_wl, n_a_in))
-    th_bin = np.digitize(th_in, theta_intv) - 1
-    phi_intv = phi_intv[th_bin]
-    bin = np.argmin(abs(angle_vector[:,0] - th_bin))
+    if np.ndim(th_in) > 0:
+        phi_in = np.broadcast_to(np.array(phi_in, dtype=object), np.shape(th_in))
+        return np.stack([make_v0(th, phi, num_wl, n_theta_bins, c_azimuth, phi_sym)
+                         for th, phi in zip(th_in, phi_in)], axis=1)
+
+    grid = angle_grid(n_theta_bins, phi_sym, c_azimuth)
+    v0 = np.zeros((num_wl, grid.n_a_in))
+    th_bin = np.digitize(th_in, grid.theta_intv) - 1
+    phi_intv = grid.phi_intv[th_bin]
+    bin = grid.bin_start[th_bin]
     if phi_in == 'all':
         n_phis = len(phi_intv) - 1
         v0[:, bin:(bin+n_phis)] = 1/n_phis
@@ -78,16 +99,9 @@ def out_to_in_matrix(phi_sym, angle_vector, theta_intv, phi_intv):
     if phi_sym == 2*np.pi:
         phi_sym = phi_sym - 0.0001
     out_to_in = np.zeros((len(angle_vector), len(angle_vector)))
-    binned_theta_out = np.digitize(np.pi-angle_vector[:,1], theta_intv, right=True) - 1
-
     phi_rebin = fold_phi(angle_vector[:,2] + np.pi, phi_sym)
 
-    phi_out = xr.DataArray(phi_rebin,
-                           coords={'theta_bin': (['angle_in'], binned_theta_out)},
-                           dims=['angle_in'])
-
-    bin_out = phi_out.groupby('theta_bin').apply(overall_bin,
-                                                 args=(phi_intv, angle_vector[:, 0])).data
+    bin_out = angle_bin(np.pi-angle_vector[:,1], phi_rebin, theta_intv, phi_intv)
 
     out_to_in[bin_out, np.arange(len(angle_vector))] = 1
 
@@ -97,13 +111,6 @@ def out_to_in_matrix(phi_sym, angle_vector, theta_intv, phi_intv):
     return COO(up_to_down), COO(down_to_up)
 
 
-def overall_bin(x, phi_intv, angle_vector_0):
-    phi_ind = np.digitize(x, phi_intv[x.coords['theta_bin'].data[0]], right=True) - 1
-    bin = np.argmin(abs(angle_vector_0 - x.coords['theta_bin'].data[0])) + phi_ind
-    return bin
-
-
-
 def make_D(alphas, thick, thetas):
     """
     Makes the bulk absorption vector for the bulk material.
@@ -117,10 +124,81 @@ def make_D(alphas, thick, thetas):
     #print(alphas, abs(np.cos(thetas[None, :])))
     diag = np.exp(-alphas[:, None] * thick / abs(np.cos(thetas[None, :])))
     #print(diag)
-    D_1 = stack([COO(np.diag(x)) for x in diag])
+    # same as stack([COO(np.diag(x)) for x in diag]), without making the dense matrices
+    i_wl, i_angle = np.nonzero(diag)
+    D_1 = COO(np.array([i_wl, i_angle, i_angle]), diag[i_wl, i_angle], shape=(diag.shape[0],) + 2*(diag.shape[1],),
+              has_duplicates=False, sorted=True)
     return D_1
 
+
+def row_block(mat, start, stop):
+    """
+    Rows start to stop (along the second to last axis) of the COO array mat, i.e. mat[..., start:stop, :], selected
+    directly from the coordinates of its non-zero elements (which is much faster than general indexing).
+
+    :param mat: COO array with 2 or 3 dimensions
+    :param start: first row
+    :param stop: last row (not included)
+
+    :return: COO array
+    """
+    keep = (mat.coords[-2] >= start) & (mat.coords[-2] < stop)
+    coords = mat.coords[:, keep]
+    coords[-2] -= start
+
+    return COO(coords, mat.data[keep], shape=mat.shape[:-2] + (stop - start, mat.shape[-1]),
+               has_duplicates=False, sorted=True)
+
+def batch_wl(mat):
+    """
+    Converts a sparse matrix at each wavelength (a COO array of shape (n_wavelengths, n_out, n_in)) into a single
+    block-diagonal scipy CSR matrix of shape (n_wavelengths*n_out, n_wavelengths*n_in), so that the products with the
+    vectors at all the wavelengths can be calculated in one operation by dot_wl. A matrix which is the same for all
+    the wavelengths (a 2D COO array) is converted to a CSR matrix. The non-zero elements in each row are kept in the
+    same order, so that the products are identical to those calculated with sparse.dot at each wavelength.
+
+    :param mat: COO array with 2 or 3 dimensions
+
+    :return: scipy CSR matrix
+    """
+    if len(mat.shape) == 2:
+        return csr_matrix((mat.data, (mat.coords[0], mat.coords[1])), shape=mat.shape)
+
+    num_wl, n_out, n_in = mat.shape
+    rows = mat.coords[0]*n_out + mat.coords[1]
+    cols = mat.coords[0]*n_in + mat.coords[2]
+
+    return csr_matrix((mat.data, (rows, cols)), shape=(num_wl*n_out, num_wl*n_in))
+
+
 def dot_wl(mat, vec):
+    """
+    Product of the matrix at each wavelength with the vector at the same wavelength.
+
+    :param mat: COO array of shape (n_wavelengths, n_out, n_in) or (n_out, n_in) (same matrix for all the \
+    wavelengths), or the equivalent scipy matrix from batch_wl
+    :param vec: array of shape (n_wavelengths, n_in). For a scipy matrix, can also be an array of shape \
+    (n_wavelengths, n_incidence, n_in) with the vectors for several incidences at each wavelength.
+
+    :return: array of shape (n_wavelengths, n_out), or (n_wavelengths, n_incidence, n_out)
+    """
+    if issparse(mat) and vec.ndim == 3:
+        num_wl, n_inc, n_in = vec.shape
+
+        if mat.shape[1] == n_in:
+            return dot_wl(mat, vec.reshape((-1, n_in))).reshape((num_wl, n_inc, -1))
+
+        # the vectors of all the incidences are multiplied together, as the columns of a matrix
+        result = mat @ vec.transpose((0, 2, 1)).reshape((-1, n_inc))
+        return np.ascontiguousarray(result.reshape((num_wl, -1, n_inc)).transpose((0, 2, 1)))
+
+    if issparse(mat):
+        if mat.shape[1] == vec.shape[1]:
+            # same matrix for all the wavelengths
+            return np.ascontiguousarray((mat @ vec.T).T)
+
+        return (mat @ vec.ravel()).reshape((vec.shape[0], -1))
+
     #print(mat.shape)
     result = np.empty((vec.shape[0], mat.shape[1]))
 
@@ -135,6 +213,9 @@ def dot_wl(mat, vec):
     return result
 
 def dot_wl_u2d(mat, vec):
+    if issparse(mat):
+        return dot_wl(mat, vec)
+
     result = np.empty((vec.shape[0], vec.shape[1]))
     for i1 in range(vec.shape[0]):  # loop over wavelengths
         result[i1, :] = dot(mat, vec[i1])
@@ -147,18 +228,176 @@ def dot_wl_prof(mat, vec):
     return result
 
 
+def block_wl(mat, num_wl, n_in):
+    """
+    Block-diagonal form, for num_wl wavelengths, of a matrix from batch_wl acting on vectors of length n_in at each
+    wavelength: a matrix which is the same for all the wavelengths is repeated along the diagonal.
+    """
+    if mat.shape[1] == n_in:
+        return kron(identity(num_wl), mat, format='csr')
+
+    return mat
+
+
+def select_wl(mat, active, n_in):
+    """
+    Restriction of a matrix from batch_wl to the wavelengths selected by the boolean mask active, to act on the vectors
+    at these wavelengths only. A matrix which is the same for all the wavelengths is returned unchanged. The non-zero
+    elements in each row are kept in the same order, so that the products are identical to those with the full matrix.
+
+    :param mat: scipy CSR matrix from batch_wl
+    :param active: boolean array of length n_wavelengths
+    :param n_in: length of the vectors at each wavelength
+
+    :return: scipy CSR matrix
+    """
+    if mat.shape[1] == n_in:
+        return mat
+
+    n_out = mat.shape[0] // len(active)
+    rows = (np.flatnonzero(active)[:, None]*n_out + np.arange(n_out)).ravel()
+    sub_mat = mat[rows]
+    new_index = np.cumsum(active) - 1
+    cols = new_index[sub_mat.indices // n_in]*n_in + sub_mat.indices % n_in
+
+    return csr_matrix((sub_mat.data, cols, sub_mat.indptr), shape=(len(rows), np.sum(active)*n_in))
+
+
+def stack_wl(mats, num_wl, n_in):
+    """
+    Stacks matrices from batch_wl which act on the same vectors into a single matrix, so that their products with the
+    vectors are calculated in one operation: at each wavelength, the result contains the products with each matrix,
+    in the order of mats (see split_wl). If any of the matrices is different at each wavelength, the matrices which
+    are the same for all the wavelengths are repeated for each wavelength (see block_wl). The rows are not modified,
+    so that the products are identical to those with each matrix.
+
+    :param mats: list of scipy CSR matrices from batch_wl
+    :param num_wl: number of wavelengths
+    :param n_in: length of the vectors at each wavelength
+
+    :return: the stacked scipy CSR matrix, and the list of the lengths of the products with each matrix at each \
+    wavelength
+    """
+    if all(mat.shape[1] == n_in for mat in mats):
+        return vstack(mats, format='csr'), [mat.shape[0] for mat in mats]
+
+    mats = [block_wl(mat, num_wl, n_in) for mat in mats]
+    n_outs = [mat.shape[0] // num_wl for mat in mats]
+    offsets = np.cumsum([0] + [mat.shape[0] for mat in mats])[:-1]
+    rows = [offset + i1*n_out + np.arange(n_out) for i1 in range(num_wl) for offset, n_out in zip(offsets, n_outs)]
+
+    return vstack(mats, format='csr')[np.concatenate(rows)], n_outs
+
+
+def split_wl(vec, n_outs):
+    """
+    Splits the product of a matrix from stack_wl with the vectors at each wavelength into the products with each of
+    the stacked matrices.
+
+    :param vec: array of shape (n_wavelengths, sum(n_outs)) or (n_wavelengths, n_incidence, sum(n_outs))
+    :param n_outs: lengths of the products with each matrix, from stack_wl
+
+    :return: list of arrays of shape (n_wavelengths, n_out) or (n_wavelengths, n_incidence, n_out)
+    """
+    return [np.ascontiguousarray(x) for x in np.split(vec, np.cumsum(n_outs)[:-1], axis=-1)]
+
+
+def permutation_index(mat):
+    """
+    If the matrix mat (from batch_wl, the same for all the wavelengths) is a permutation matrix, returns the index
+    array index such that its product with the vectors vec is vec[:, index], otherwise returns None.
+    """
+    if np.all(np.diff(mat.indptr) == 1) and np.all(mat.data == 1) and len(np.unique(mat.indices)) == mat.shape[1]:
+        return mat.indices.copy()
+
+    return None
+
+
+def permute_wl(mat, index, vec):
+    """
+    Product of the matrix mat, which is the same for all the wavelengths, with the vectors vec at each wavelength,
+    calculated as an index gather if mat is a permutation matrix (index from permutation_index is not None).
+    """
+    if index is not None:
+        # np.take returns a C-ordered array (unlike vec[..., index]), so that the sums over angles are identical
+        return np.take(vec, index, axis=-1)
+
+    return dot_wl_u2d(mat, vec)
+
+
+def bounce_series(vf, D, Rf_back, Rb_front, up2down, down2up, solver='direct'):
+    """
+    Sum over all the passes through a bulk layer of the power vector travelling down into the bulk from the front
+    surface, vf + M vf + M^2 vf + ..., where M is the round-trip operator (down2up, D, Rf_back, D, up2down,
+    Rb_front, as in the loop in matrix_multiplication), calculated by solving (I - M) x = vf for all the wavelengths
+    at once.
+
+    :param vf: power vector transmitted into the bulk through the front surface, shape (n_wavelengths, n_angle_bins) \
+    or (n_wavelengths, n_incidence, n_angle_bins)
+    :param D: bulk absorption matrix
+    :param Rf_back: reflection matrix of the back surface (front incidence)
+    :param Rb_front: reflection matrix of the front surface (rear incidence)
+    :param up2down: matrix converting outgoing upwards angles to incoming downwards angles
+    :param down2up: matrix converting outgoing downwards angles to incoming upwards angles
+    :param solver: 'direct' (sparse LU decomposition) or 'iterative' (GMRES)
+
+    :return: array with the same shape as vf
+    """
+    num_wl, n_a_in = vf.shape[0], vf.shape[-1]
+    M = identity(num_wl*n_a_in, format='csr')
+
+    for mat in [down2up, D, Rf_back, D, up2down, Rb_front]:
+        M = block_wl(mat, num_wl, n_a_in) @ M
+
+    A = identity(num_wl*n_a_in, format='csc') - M
+
+    # one column for each incidence
+    b = vf.reshape((num_wl, -1, n_a_in)).transpose((0, 2, 1)).reshape((num_wl*n_a_in, -1))
+
+    if solver == 'direct':
+        x = spsolve(A.tocsc(), b).reshape(b.shape)
+
+    else:
+        x = np.empty_like(b)
+        for i1 in range(b.shape[1]):
+            x[:, i1], info = gmres(A, b[:, i1], atol=0, restart=100, maxiter=1000, **{_gmres_rtol: 1e-12})
+            if info > 0:
+                warn('The iterative solver for the bulk bounces did not converge.')
+
+    return np.ascontiguousarray(x.reshape((num_wl, n_a_in, -1)).transpose((0, 2, 1)).reshape(vf.shape))
+
+
+def add_pass(tally, x, per_pass, active=None):
+    """
+    Appends the result of a pass x to the list tally, or adds it to the total (the only element of tally) if the
+    results per pass are not kept. If active (a boolean array of length n_wavelengths) is given, x only contains the
+    wavelengths selected by active, and is zero at the other wavelengths.
+    """
+    if active is not None and not np.all(active):
+        full = np.zeros((len(active),) + x.shape[1:])
+        full[active] = x
+        x = full
+
+    if per_pass or len(tally) == 0:
+        tally.append(x)
+
+    else:
+        tally[0] = tally[0] + x
+
+
 def bulk_profile(x, ths):
     #print('wl2')
     return np.exp(-x/ths)
 
 
 def matrix_multiplication(bulk_mats, bulk_thick, options,
-                          layer_widths=[], n_layers=[], layer_names=[], calc_prof_list=[]):
+                          layer_widths=[], n_layers=[], layer_names=[], calc_prof_list=[], incidence=None):
     n_bulks = len(bulk_mats)
     n_interfaces = n_bulks + 1
 
-    theta_intv, phi_intv, angle_vector = make_angle_vector(options['n_theta_bins'], options['phi_symmetry'], options['c_azimuth'])
-    n_a_in = int(len(angle_vector)/2)
+    grid = angle_grid(options['n_theta_bins'], options['phi_symmetry'], options['c_azimuth'])
+    theta_intv, phi_intv, angle_vector = grid.theta_intv, grid.phi_intv, grid.angle_vector
+    n_a_in = grid.n_a_in
 
     num_wl = len(options['wavelengths'])
 
@@ -169,8 +408,23 @@ def matrix_multiplication(bulk_mats, bulk_thick, options,
 
     thetas = angle_vector[:n_a_in, 1]
 
-    v0 = make_v0(options['theta_in'], options['phi_in'], num_wl,
-                 options['n_theta_bins'], options['c_azimuth'], options['phi_symmetry'])
+    if incidence is not None:
+        v0 = np.repeat(np.asarray(incidence, dtype=float)[None], num_wl, axis=0)
+
+    else:
+        v0 = make_v0(options['theta_in'], options['phi_in'], num_wl,
+                     options['n_theta_bins'], options['c_azimuth'], options['phi_symmetry'])
+
+    # with several incidences, the vectors have an additional dimension (the second one) and the results are
+    # angle-resolved
+    multi_incidence = v0.ndim == 3
+
+    if multi_incidence and incidence is None:
+        # incidence angles, added as coordinates of the results (phi_in can be 'all')
+        theta_in = np.asarray(options['theta_in'], dtype=float)
+        phi_in = np.broadcast_to(np.array(options['phi_in'], dtype=object), theta_in.shape)
+        if not any(isinstance(phi, str) for phi in phi_in):
+            phi_in = phi_in.astype(float)
 
     up2down, down2up = out_to_in_matrix(options['phi_symmetry'], angle_vector, theta_intv, phi_intv)
 
@@ -195,16 +449,9 @@ def matrix_multiplication(bulk_mats, bulk_thick, options,
         fullmat = load_npz(mat_path)
         absmat = load_npz(absmat_path)
 
-        if len(fullmat.shape) == 3:
-            Rf.append(fullmat[:, :n_a_in, :])
-            Tf.append(fullmat[:, n_a_in:, :])
-            Af.append(absmat)
-
-        else:
-            #print(fullmat.shape)
-            Rf.append(fullmat[:n_a_in, :])
-            Tf.append(fullmat[n_a_in:, :])
-            Af.append(absmat)
+        Rf.append(row_block(fullmat, 0, n_a_in))
+        Tf.append(row_block(fullmat, n_a_in, fullmat.shape[-2]))
+        Af.append(absmat)
 
 
         if calc_prof_list[i1] is not None:
@@ -238,15 +485,9 @@ def matrix_multiplication(bulk_mats, bulk_thick, options,
         fullmat = load_npz(mat_path)
         absmat = load_npz(absmat_path)
 
-        if len(fullmat.shape) == 3:
-            Rb.append(fullmat[:, n_a_in:, :])
-            Tb.append(fullmat[:, :n_a_in, :])
-            Ab.append(absmat)
-
-        else:
-            Rb.append(fullmat[n_a_in:, :])
-            Tb.append(fullmat[:n_a_in, :])
-            Ab.append(absmat)
+        Rb.append(row_block(fullmat, n_a_in, fullmat.shape[-2]))
+        Tb.append(row_block(fullmat, 0, n_a_in))
+        Ab.append(absmat)
 
 
         if calc_prof_list[i1] is not None:
@@ -263,12 +504,34 @@ def matrix_multiplication(bulk_mats, bulk_thick, options,
             Pb.append([])
             Ib.append([])
 
+    # the matrices are converted once into scipy sparse matrices which act on the vectors at all the wavelengths in a
+    # single product (see batch_wl)
+    Rf, Tf, Af, Rb, Tb, Ab, D = [[batch_wl(x) for x in mats] for mats in [Rf, Tf, Af, Rb, Tb, Ab, D]]
+    up2down, down2up = batch_wl(up2down), batch_wl(down2up)
+    u2d_index, d2u_index = permutation_index(up2down), permutation_index(down2up)
+
     len_calcs = np.array([len(x) if x is not None else 0 for x in calc_prof_list])
     #print(len_calcs)
     #print(np.any(len_calcs > 0))
 
+    # with bulk_solver = 'direct' or 'iterative', the sum over all the passes through each bulk layer is calculated by
+    # solving a linear system instead of pass by pass (see bounce_series). If results_per_pass is False, only the
+    # totals are kept.
+    solver = options.get('bulk_solver', 'passes')
+    per_pass = options.get('results_per_pass', True) and solver == 'passes'
+
     if np.any(len_calcs > 0):
         #print('a')
+        if multi_incidence:
+            raise ValueError('Absorption profiles in the interfaces cannot be calculated for several incidences at '
+                             'once: run calculate_RAT for each incidence separately.')
+
+        if solver != 'passes':
+            warn('The absorption profiles in the interfaces are calculated pass by pass, so bulk_solver = '
+                 '\'passes\' will be used.')
+            solver = 'passes'
+            per_pass = options.get('results_per_pass', True)
+
         a = [[] for _ in range(n_interfaces)]
         a_prof = [[] for _ in range(n_interfaces)]
         vr = [[] for _ in range(n_bulks)]
@@ -287,8 +550,8 @@ def matrix_multiplication(bulk_mats, bulk_thick, options,
             #z = xr.DataArray(np.arange(0, bulk_thick[i1], options['depth_spacing']*1e-9), dims='z')
             # v0 is actually travelling down, but no reason to start in 'outgoing' ray format.
             vf_1[i1] = dot_wl(Tf[i1], v0) # pass through front surface
-            vr[i1].append(dot_wl(Rf[i1], v0)) # reflected from front surface
-            a[i1].append(dot_wl(Af[i1], v0)) # absorbed in front surface at first interaction
+            add_pass(vr[i1], dot_wl(Rf[i1], v0), per_pass) # reflected from front surface
+            add_pass(a[i1], dot_wl(Af[i1], v0), per_pass) # absorbed in front surface at first interaction
             #print(v0)
             #print(If[i1])
 
@@ -299,7 +562,7 @@ def matrix_multiplication(bulk_mats, bulk_thick, options,
                 int_power = xr.dot(v_xr, If[i1], dims = 'global_index')
                 scale = (np.sum(dot_wl(Af[i1],v0), 1)/int_power).fillna(0)
 
-                a_prof[i1].append((scale*xr.dot(v_xr, Pf[i1], dims = 'global_index')).data)
+                add_pass(a_prof[i1], (scale*xr.dot(v_xr, Pf[i1], dims = 'global_index')).data, per_pass)
 
             power = np.sum(vf_1[i1], axis=1)
 
@@ -324,10 +587,10 @@ def matrix_multiplication(bulk_mats, bulk_thick, options,
                     #('front profile')
 
 
-                    a_prof[i1+1].append((scale * xr.dot(v_xr, Pf[i1+1], dims='global_index')).data)
+                    add_pass(a_prof[i1+1], (scale * xr.dot(v_xr, Pf[i1+1], dims='global_index')).data, per_pass)
 
                 #remaining_power.append(np.sum(vb_1, axis=1))
-                A[i1].append(np.sum(vf_1[i1], 1) - np.sum(vb_1[i1], 1))
+                add_pass(A[i1], np.sum(vf_1[i1], 1) - np.sum(vb_1[i1], 1), per_pass)
 
                 nz_thetas = vf_1[i1] != 0
 
@@ -342,11 +605,11 @@ def matrix_multiplication(bulk_mats, bulk_thick, options,
                                                 'global_index': np.arange(0, n_a_in)})
                     int_power = xr.dot(v_xr, Ib[i1], dims='global_index')
                     scale = (np.sum(dot_wl(Ab[i1], vf_2[i1]), 1) / int_power).fillna(0)
-                    a_prof[i1].append((scale * xr.dot(v_xr, Pb[i1], dims='global_index')).data)
+                    add_pass(a_prof[i1], (scale * xr.dot(v_xr, Pb[i1], dims='global_index')).data, per_pass)
 
                 #remaining_power.append(np.sum(vf_2, axis=1))
 
-                A[i1].append(np.sum(vb_2[i1], 1) - np.sum(vf_2[i1], 1))
+                add_pass(A[i1], np.sum(vb_2[i1], 1) - np.sum(vf_2[i1], 1), per_pass)
 
                 vf_2[i1] = dot_wl_u2d(up2down, vf_2[i1]) # prepare for rear incidence
                 vf_1[i1] = dot_wl(Rb[i1], vf_2[i1]) # reflect from front surface
@@ -354,10 +617,10 @@ def matrix_multiplication(bulk_mats, bulk_thick, options,
 
                 # nz_thetas = vb_2[i1] != 0
 
-                vr[i1].append(dot_wl(Tb[i1], vf_2[i1]))  # matrix travelling up in medium 0, i.e. reflected overall by being transmitted through front surface
-                vt[i1].append(dot_wl(Tf[i1+1], vb_1[i1]))  # transmitted into medium below through back surface
-                a[i1+1].append(dot_wl(Af[i1+1], vb_1[i1]))  # absorbed in 2nd surface
-                a[i1].append(dot_wl(Ab[i1], vf_2[i1]))  # absorbed in 1st surface (from the back)
+                add_pass(vr[i1], dot_wl(Tb[i1], vf_2[i1]), per_pass)  # matrix travelling up in medium 0, i.e. reflected overall by being transmitted through front surface
+                add_pass(vt[i1], dot_wl(Tf[i1+1], vb_1[i1]), per_pass)  # transmitted into medium below through back surface
+                add_pass(a[i1+1], dot_wl(Af[i1+1], vb_1[i1]), per_pass)  # absorbed in 2nd surface
+                add_pass(a[i1], dot_wl(Ab[i1], vf_2[i1]), per_pass)  # absorbed in 1st surface (from the back)
 
                 i2+=1
 
@@ -367,7 +630,7 @@ def matrix_multiplication(bulk_mats, bulk_thick, options,
         A = [np.array(item) for item in A]
         a_prof = [np.array(item) for item in a_prof]
 
-        results_per_pass = {'r': vr, 't': vt, 'a': a, 'A': A, 'a_prof': a_prof}
+        results_per_pass = {'r': vr, 't': vt, 'a': a, 'A': A, 'a_prof': a_prof} if per_pass else None
 
         # for i2 in range(3):
         #     for i1 in range(n_interfaces):
@@ -440,67 +703,108 @@ def matrix_multiplication(bulk_mats, bulk_thick, options,
         for i1 in range(n_bulks):
 
             vf_1[i1] = dot_wl(Tf[i1], v0)  # pass through front surface
-            vr[i1].append(dot_wl(Rf[i1], v0))  # reflected from front surface
-            a[i1].append(dot_wl(Af[i1], v0))  # absorbed in front surface at first interaction
-            power = np.sum(vf_1[i1], axis=1)
+            add_pass(vr[i1], dot_wl(Rf[i1], v0), per_pass)  # reflected from front surface
+            add_pass(a[i1], dot_wl(Af[i1], v0), per_pass)  # absorbed in front surface at first interaction
+            power = np.sum(vf_1[i1], axis=-1)
+
+            if solver != 'passes':
+                # vf_1 is replaced by its sum over all the passes, so a single pass through the loop below gives the
+                # total R, T and absorption
+                vf_1[i1] = bounce_series(vf_1[i1], D[i1], Rf[i1 + 1], Rb[i1], up2down, down2up, solver)
+
+            # the operators applied at each pass are prepared once: the conversions between outgoing and incoming
+            # angles are permutations, applied by indexing (see permute_wl), the bulk absorption is applied by
+            # scaling the vectors by the diagonal of D, and the matrices applied to the vectors incident on the back
+            # surface (Rf, Tf, Af) and on the front surface (Rb, Tb, Ab) are stacked (see stack_wl), so that each pass
+            # only needs two sparse matrix products.
+            D_diag = D[i1].diagonal().reshape((num_wl, n_a_in))
+            if multi_incidence:
+                D_diag = D_diag[:, None, :]
+            back_mat, back_n_outs = stack_wl([Rf[i1 + 1], Tf[i1 + 1], Af[i1 + 1]], num_wl, n_a_in)
+            front_mat, front_n_outs = stack_wl([Rb[i1], Tb[i1], Ab[i1]], num_wl, n_a_in)
+
+            # the wavelengths at which the power remaining in the bulk has dropped below I_thresh are removed from the
+            # calculation: the vectors only contain the wavelengths selected by active, and the matrices are
+            # restricted to these wavelengths (see select_wl). The results of later passes are zero at the wavelengths
+            # removed. Since restricting the matrices has a cost, this is only done once at least a quarter of the
+            # wavelengths still in the calculation have converged.
+            active = np.ones(num_wl, dtype=bool)
+            D_a, back_a, front_a = D_diag, back_mat, front_mat
 
             # rep
             i2 = 1
 
-            while np.any(power > options['I_thresh']):
+            while solver != 'passes' or np.any(power > options['I_thresh']):
                 #print(i2)
 
+                keep = power > options['I_thresh']
+                if multi_incidence:
+                    # a wavelength is only removed once it has converged for all the incidences
+                    keep = np.any(keep, axis=1)
+
+                if solver == 'passes' and np.sum(keep) <= 0.75*len(keep):
+                    active[active] = keep
+                    vf_1[i1] = vf_1[i1][keep]
+                    D_a = D_diag[active]
+                    back_a, front_a = [select_wl(mat, active, n_a_in) for mat in [back_mat, front_mat]]
+
                 #print('before d2u', np.sum(vf_1[i1]))
-                vf_1[i1] = dot_wl_u2d(down2up, vf_1[i1]) # outgoing to incoming
+                vf_1[i1] = permute_wl(down2up, d2u_index, vf_1[i1]) # outgoing to incoming
                 #print('after 2du', np.sum(vf_1[i1]))
-                #print('vf_1 after', vf_1[i1])
-                vb_1[i1] = dot_wl(D[i1], vf_1[i1])  # pass through bulk, downwards
-                #print('before back ref', np.sum(vb_1[i1]))
+                vb_1[i1] = D_a*vf_1[i1]  # pass through bulk, downwards
                 # remaining_power.append(np.sum(vb_1, axis=1))
-                A[i1].append(np.sum(vf_1[i1], 1) - np.sum(vb_1[i1], 1))
+                add_pass(A[i1], np.sum(vf_1[i1], -1) - np.sum(vb_1[i1], -1), per_pass, active)
 
-                vb_2[i1] = dot_wl(Rf[i1 + 1], vb_1[i1])  # reflect from back surface
+                # reflect from back surface, transmitted into medium below, absorbed in 2nd surface
+                vb_2[i1], v_trans, a_back = split_wl(dot_wl(back_a, vb_1[i1]), back_n_outs)
                 #print('after back ref', np.sum(vb_2[i1]))
-                vf_2[i1] = dot_wl(D[i1], vb_2[i1]) # pass through bulk, upwards
-                #print('vb_2', vb_2[i1])
-                #print('after u2d', np.sum(vf_2[i1]))
-                vf_2[i1] = dot_wl_u2d(up2down, vf_2[i1]) # prepare for rear incidence
+                vf_2[i1] = D_a*vb_2[i1] # pass through bulk, upwards
+                vf_2[i1] = permute_wl(up2down, u2d_index, vf_2[i1]) # prepare for rear incidence
                 #print('after u2d/before front ref', np.sum(vf_2[i1]))
-                vf_1[i1] = dot_wl(Rb[i1], vf_2[i1]) # reflect from front surface
+                # reflect from front surface, transmitted into medium 0, absorbed in 1st surface (from the back)
+                vf_1[i1], v_refl, a_front = split_wl(dot_wl(front_a, vf_2[i1]), front_n_outs)
                 #print('after front ref', np.sum(vf_1[i1]))
-                #print('Rf, Rb, and vf2', Rf[i1][20].todense(), Rb[i1][20].todense(), vf_2[i1][20])
-                #print('powersrem', np.sum(vb_2[i1], 1), np.sum(vf_2[i1], 1), np.sum(vf_1[i1], 1))
                 # remaining_power.append(np.sum(vf_2, axis=1))
-                A[i1].append(np.sum(vb_2[i1], 1) - np.sum(vf_2[i1], 1))
-                power = np.sum(vf_1[i1], axis=1)
-                print('After iteration', i2, ': maximum power fraction remaining =', np.max(power))
+                add_pass(A[i1], np.sum(vb_2[i1], -1) - np.sum(vf_2[i1], -1), per_pass, active)
+                power = np.sum(vf_1[i1], axis=-1)
+                if solver == 'passes':
+                    print('After iteration', i2, ': maximum power fraction remaining =', np.max(power))
 
-                vr[i1].append(dot_wl(Tb[i1], vf_2[i1]))  # matrix travelling up in medium 0, i.e. reflected overall by being transmitted through front surface
+                add_pass(vr[i1], v_refl, per_pass, active)  # matrix travelling up in medium 0, i.e. reflected overall by being transmitted through front surface
                 #print('lost in front ref', np.sum(vr[i1]))
-                #print('Tf, vb1', Tf[i1 + 1][20].todense(), vb_1[i1][20])
-                vt[i1].append(dot_wl(Tf[i1 + 1], vb_1[i1]))  # transmitted into medium below through back surface
+                add_pass(vt[i1], v_trans, per_pass, active)  # transmitted into medium below through back surface
                 #print('lost in back ref', np.sum(vt[i1]))
-                a[i1 + 1].append(dot_wl(Af[i1 + 1], vb_1[i1]))  # absorbed in 2nd surface
-                a[i1].append(dot_wl(Ab[i1], vf_2[i1]))  # absorbed in 1st surface (from the back)
+                add_pass(a[i1 + 1], a_back, per_pass, active)  # absorbed in 2nd surface
+                add_pass(a[i1], a_front, per_pass, active)  # absorbed in 1st surface (from the back)
 
                 i2 += 1
 
+                if solver != 'passes':
+                    break
+
         vr = [np.array(item) for item in vr]
         vt = [np.array(item) for item in vt]
         a = [np.array(item) for item in a]
         A = [np.array(item) for item in A]
 
-        results_per_pass = {'r': vr, 't': vt, 'a': a, 'A': A}
+        results_per_pass = {'r': vr, 't': vt, 'a': a, 'A': A} if per_pass else None
 
         sum_dims = ['bulk_index', 'wl']
         sum_coords = {'bulk_index': np.arange(0, n_bulks), 'wl': options['wavelengths']}
-        R = xr.DataArray(np.array([np.sum(item, (0,2)) for item in vr]),
+        if multi_incidence:
+            sum_dims.append('incidence')
+            sum_coords['incidence'] = np.arange(0, v0.shape[1])
+            if incidence is None:
+                sum_coords['theta_in'] = ('incidence', theta_in)
+                sum_coords['phi_in'] = ('incidence', phi_in)
+
+        R = xr.DataArray(np.array([np.sum(item, (0,-1)) for item in vr]),
                            dims=sum_dims, coords=sum_coords, name = 'R')
         if i2 > 1 :
             A_bulk = xr.DataArray(np.array([np.sum(item, 0) for item in A]),
                                dims=sum_dims, coords=sum_coords, name = 'A_bulk')
 
-            T = xr.DataArray(np.array([np.sum(item, (0,2)) for item in vt]),
+            T = xr.DataArray(np.array([np.sum(item, (0,-1)) for item in vt]),
                                dims=sum_dims, coords=sum_coords, name = 'T')
 
             RAT = xr.merge([R, A_bulk, T])
@@ -4,7 +4,7 @@ from rayflare.structure import Interface, RTgroup, BulkLayer
 from rayflare.ray_tracing.rt import RT
 from rayflare.rigorous_coupled_wave_analysis.rcwa import RCWA
 from rayflare.transfer_matrix_method.tmm import TMM
-from rayflare.angles import make_angle_vector
+from rayflare.angles import angle_grid
 from rayflare.matrix_formalism.ideal_cases import lambertian_matrix, mirror_matrix
 
 def process_structure(SC, options):
@@ -56,16 +56,15 @@ def process_structure(SC, options):
             # perfect mirror
 
             if struct.method == 'Mirror':
-                theta_intv, phi_intv, angle_vector = make_angle_vector(options['n_theta_bins'], options['phi_symmetry'],
-                                                                options['c_azimuth'])
-                mirror_matrix(angle_vector, theta_intv, phi_intv, struct.name, options, front_or_rear='front', save=True)
+                grid = angle_grid(options['n_theta_bins'], options['phi_symmetry'], options['c_azimuth'])
+                mirror_matrix(grid.angle_vector, grid.theta_intv, grid.phi_intv, struct.name, options,
+                              front_or_rear='front', save=True)
 
             if struct.method == 'Lambertian':
-                theta_intv, _, angle_vector = make_angle_vector(options['n_theta_bins'], options['phi_symmetry'],
-                                                                options['c_azimuth'])
+                grid = angle_grid(options['n_theta_bins'], options['phi_symmetry'], options['c_azimuth'])
 
                 # assuming this is a Lambertian reflector right now
-                lambertian_matrix(angle_vector, theta_intv, struct.name, options, 'front', save = True)
+                lambertian_matrix(grid.angle_vector, grid.theta_intv, struct.name, options, 'front', save = True)
 
 
             if struct.method == 'TMM':
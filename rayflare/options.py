@@ -15,6 +15,10 @@ class default_options(State):
         self.n_jobs = -1
         self.c_azimuth = 0.25
         self.only_incidence_angle = True
+
+        # Matrix multiplication options
+        self.bulk_solver = 'passes'
+        self.results_per_pass = True
         
         # RCWA options
         self.A_per_order = False
@@ -36,6 +40,23 @@ class default_options(State):
         self.avoid_edges = False
         self.randomize_surface = False
         self.random_ray_angles = False
+        self.ray_packets = False
+        self.n_rays_tol = None
+        self.n_rays_max = 100000
+        self.ray_sequence = 'random'
+        self.decision_sampling = 'random'
+        self.ray_splitting = False
+        self.splitting_max_depth = 8
+        self.russian_roulette = False
+        self.roulette_survival = 0.1
+        self.hero_wavelength = False
+        self.hero_n_tol = 1e-2
+        self.hero_max_band = 20
+        self.jit_kernel = False
+        self.load_balancing = True
+        self.shared_memory = True
+        self.checkpoint = False
         
         # TMM options
-        self.lookuptable_angles = 300
\ No newline at end of file
+        self.lookuptable_angles = 300
+        self.lookuptable_interpolate = False
\ No newline at end of file
@@ -0,0 +1,158 @@
+import math
+import numpy as np
+from rayflare.ray_tracing.rt import RTSurface
+from rayflare.ray_tracing.ray_packets import periodic_axes
+
+
+class FacetedSurface(RTSurface):
+
+    analytic = True
+
+    def __init__(self, Points):
+        """Surface made of planar facets which is either the lower envelope (e.g. upright pyramids, V-groove ridges)
+        or the upper envelope (e.g. inverted pyramids) of the planes containing its facets. Then the region below
+        (or above) the surface inside the unit cell is convex, and the intersections of rays with the surface are
+        found in closed form by clipping the rays against the facet planes, instead of testing every triangle.
+        The ray-tracer uses this automatically (see check_intersect and check_intersect_packet). The surface is
+        still triangulated as for RTSurface, and the facets are identified by the index of one of their triangles,
+        so that the normals are the same as for the equivalent RTSurface.
+
+        :param Points: array of shape (n_points, 3) with the x, y and z coordinates of the points on the surface
+        """
+        RTSurface.__init__(self, Points)
+
+        # planes n.r = c containing the triangles, with upward normals n
+        normals = self.crossP / np.linalg.norm(self.crossP, axis=1)[:, None]
+        normals = normals * np.sign(normals[:, 2])[:, None]
+        offsets = np.sum(normals * self.P_0s, axis=1)
+        _, facet_triangle = np.unique(np.round(np.column_stack((normals, offsets)), 9), axis=0, return_index=True)
+
+        normals = normals[facet_triangle]
+        offsets = offsets[facet_triangle]
+
+        # height of each facet plane at the centroid of each triangle
+        centroids = (self.P_0s + self.P_1s + self.P_2s) / 3
+        z_planes = (offsets[None, :] - centroids[:, :1] * normals[None, :, 0] -
+                    centroids[:, 1:2] * normals[None, :, 1]) / normals[None, :, 2]
+
+        if np.allclose(np.min(z_planes, axis=1), centroids[:, 2]):
+            # lower envelope: the region below the surface, n.r <= c for all facets, is convex
+            sign = 1
+        elif np.allclose(np.max(z_planes, axis=1), centroids[:, 2]):
+            # upper envelope: the region above the surface, n.r >= c for all facets, is convex
+            sign = -1
+        else:
+            raise ValueError('The surface is neither the lower nor the upper envelope of its facet planes.')
+
+        # the convex region is n.r <= c, with n, c the outward normals and offsets below
+        self.facet_normals = sign * normals
+        self.facet_offsets = sign * offsets
+        self.facet_triangle = facet_triangle
+        self.cell_origin = np.min(Points[:, :2], axis=0)
+
+    def intersect(self, r_a, d):
+        """Finds the closest intersection of each ray with the surface in the unit cell.
+
+        :param r_a: starting points of the rays, array of shape (n_rays, 3)
+        :param d: directions of the rays, array of shape (n_rays, 3)
+
+        :return: t: distance to the intersection along the ray (inf if the ray misses the surface) \
+        ind: index of the triangle intersected
+        """
+        a = d @ self.facet_normals.T
+        b = self.facet_offsets[None, :] - r_a @ self.facet_normals.T
+
+        # the ray is inside the convex region for t_in <= t <= t_out (Cyrus-Beck clipping)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_k = b / a
+        t_in = np.max(np.where(a < 0, t_k, -np.inf), axis=1)
+        t_out = np.min(np.where(a > 0, t_k, np.inf), axis=1)
+        ind_in = np.argmax(np.where(a < 0, t_k, -np.inf), axis=1)
+        ind_out = np.argmin(np.where(a > 0, t_k, np.inf), axis=1)
+        crosses = (t_in <= t_out) & ~np.any((a == 0) & (b < 0), axis=1)
+
+        # the surface is only the boundary of the convex region inside the unit cell (which is unbounded along the
+        # invariant axis, if there is one)
+        eps = 1e-10 * max(self.Lx, self.Ly)
+        L = np.array([self.Lx, self.Ly])
+        bounded = periodic_axes(self)
+
+        def in_cell(t):
+            with np.errstate(invalid='ignore'):
+                xy = r_a[:, :2] + t[:, None] * d[:, :2] - self.cell_origin
+                return np.all((xy >= -eps) & (xy <= L + eps) | ~bounded, axis=1)
+
+        enter = crosses & (t_in > 0) & np.isfinite(t_in) & in_cell(t_in)
+        leave = crosses & ~enter & (t_out > 0) & np.isfinite(t_out) & in_cell(t_out)
+
+        t = np.where(enter, t_in, np.where(leave, t_out, np.inf))
+        ind = self.facet_triangle[np.where(enter, ind_in, ind_out)]
+
+        return t, ind
+
+    def offset(self, dz):
+        Points = self.Points.astype(float)
+        Points[:, 2] = Points[:, 2] + dz
+        surf = FacetedSurface(Points)
+        surf.invariant_axis = self.invariant_axis
+        return surf
+
+
+class PlaneSurface(FacetedSurface):
+    def __init__(self, size=1):
+        """Planar surface at z = 0, with a square unit cell.
+
+        :param size: side of the unit cell
+        """
+        Lx = 1*size
+        Ly = 1*size
+        x = np.array([0, Lx, Lx, 0])
+        y = np.array([0, Ly, 0, Ly])
+        z = np.array([0, 0, 0, 0])
+
+        FacetedSurface.__init__(self, np.vstack([x, y, z]).T)
+
+
+class PyramidSurface(FacetedSurface):
+    def __init__(self, elevation_angle=55, upright=True, size=1):
+        """Square-based pyramid filling a square unit cell, with its base at z = 0.
+
+        :param elevation_angle: angle between the facets and the horizontal, in degrees
+        :param upright: whether the pyramid points up (apex at z > 0) or down (inverted pyramid)
+        :param size: side of the unit cell
+        """
+        char_angle = math.radians(elevation_angle)
+        Lx = size*1
+        Ly = size*1
+        h = Lx*math.tan(char_angle)/2
+        x = np.array([0, Lx/2, Lx, 0, Lx])
+        y = np.array([0, Ly/2, 0, Ly, Ly])
+        z = np.array([0, h if upright else -h, 0, 0, 0])
+
+        FacetedSurface.__init__(self, np.vstack([x, y, z]).T)
+
+
+class VGrooveSurface(FacetedSurface):
+    def __init__(self, elevation_angle=55, width=1, direction='y', upright=True):
+        """V-groove running along the x or y direction, in a square unit cell, with its base at z = 0. The surface is
+        invariant along the direction of the groove, so the ray-tracing is done in 2D (see RTSurface.invariant_axis).
+
+        :param elevation_angle: angle between the facets and the horizontal, in degrees
+        :param width: width of the groove (and side of the unit cell)
+        :param direction: direction along which the groove runs ('x' or 'y')
+        :param upright: whether the ridge of the groove points up (z > 0) or down
+        """
+        char_angle = math.radians(elevation_angle)
+        h = width*math.tan(char_angle)/2
+        if direction == 'y':
+            x = np.array([0, width, 0, width, width/2, width/2])
+            y = np.array([0, 0, width, width, 0, width])
+
+        if direction == 'x':
+            y = np.array([0, width, 0, width, width/2, width/2])
+            x = np.array([0, 0, width, width, 0, width])
+
+        z = np.array([0, 0, 0, 0, h, h]) if upright else np.array([0, 0, 0, 0, -h, -h])
+
+        FacetedSurface.__init__(self, np.vstack([x, y, z]).T)
+        self.invariant_axis = direction
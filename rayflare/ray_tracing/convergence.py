@@ -0,0 +1,58 @@
+import numpy as np
+
+
+class RunningStats:
+    """Running mean and variance of a set of quantities (e.g. the reflection, transmission and absorption per layer
+    of each ray), updated with batches of samples using Welford's algorithm in the form used to combine the
+    statistics of two sets of samples (Chan et al.). The samples themselves do not need to be stored.
+
+    :param n_quantities: number of quantities (columns of the samples passed to update)
+    """
+    def __init__(self, n_quantities):
+        self.n = 0
+        self.mean = np.zeros(n_quantities)
+        self.M2 = np.zeros(n_quantities)
+
+    def update(self, samples):
+        """Adds a batch of samples.
+
+        :param samples: array of shape (n_samples, n_quantities)
+        """
+        samples = np.real(samples).reshape((-1, len(self.mean)))
+        m = len(samples)
+
+        if m == 0:
+            return
+
+        mean_b = np.mean(samples, 0)
+        M2_b = np.sum((samples - mean_b)**2, 0)
+        delta = mean_b - self.mean
+        n = self.n + m
+
+        self.mean = self.mean + delta*m/n
+        self.M2 = self.M2 + M2_b + delta**2*self.n*m/n
+        self.n = n
+
+    def merge(self, other):
+        """Combines these statistics with those of another RunningStats for the same quantities, as if all the
+        samples had been added to this one."""
+        if other.n == 0:
+            return
+
+        delta = other.mean - self.mean
+        n = self.n + other.n
+
+        self.mean = self.mean + delta*other.n/n
+        self.M2 = self.M2 + other.M2 + delta**2*self.n*other.n/n
+        self.n = n
+
+    def std_error(self):
+        """Standard error of the mean of each quantity (inf if fewer than two samples have been added)."""
+        if self.n < 2:
+            return np.full(len(self.mean), np.inf)
+
+        return np.sqrt(self.M2/(self.n - 1)/self.n)
+
+    def converged(self, tol, quantities=slice(None)):
+        """Whether the standard error of the selected quantities is below tol."""
+        return np.all(self.std_error()[quantities] <= tol)
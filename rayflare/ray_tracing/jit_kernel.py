@@ -0,0 +1,311 @@
+import numpy as np
+import cmath
+import math
+from rayflare.ray_tracing.ray_packets import max_cells, periodic_axes
+from rayflare.ray_tracing.profile_tally import min_cos
+
+try:
+    from numba import njit
+    jit_available = True
+
+except ImportError:
+    jit_available = False
+
+    def njit(*args, **kwargs):
+        # without numba, the kernel is plain Python: it gives the same results, but much more slowly than
+        # single_ray_stack, so rt_structure only uses it if numba is installed
+        return lambda f: f
+
+
+pol_codes = {'s': 0, 'p': 1, 'u': 2}
+
+
+def jit_supported(surfaces):
+    """Whether the surfaces can be traced with the compiled kernel, which tests the triangles of each surface
+    directly: this is not possible for surfaces which are invariant along one axis, since their triangles only cover
+    the unit cell along that axis (see RTSurface.invariant_axis)."""
+    return all(surf.invariant_axis is None for surf in surfaces)
+
+
+def surface_arrays(surfaces):
+    """Packs the triangles and unit cells of a list of RTSurfaces into flat arrays which can be passed to the compiled
+    kernel. The triangles of surface i1 are tri_start[i1]:tri_start[i1 + 1].
+
+    :return: P_0s, P_1s, P_2s, crossP: corners and cross products of the triangles of all the surfaces \
+    tri_start: index of the first triangle of each surface (plus the total number of triangles) \
+    cells: array of shape (n_surfaces, 7) with Lx, Ly, the x and y origin of the unit cell, z_min, z_max and zcov \
+    periodic: array of shape (n_surfaces, 2), whether each surface is periodic along x and y
+    """
+    P_0s = np.concatenate([surf.P_0s for surf in surfaces]).astype(float)
+    P_1s = np.concatenate([surf.P_1s for surf in surfaces]).astype(float)
+    P_2s = np.concatenate([surf.P_2s for surf in surfaces]).astype(float)
+    crossP = np.concatenate([surf.crossP for surf in surfaces]).astype(float)
+    tri_start = np.cumsum([0] + [len(surf.P_0s) for surf in surfaces])
+    cells = np.array([[surf.Lx, surf.Ly, np.min(surf.Points[:, 0]), np.min(surf.Points[:, 1]), surf.z_min,
+                       surf.z_max, surf.zcov[0]] for surf in surfaces], dtype=float)
+    periodic = np.array([periodic_axes(surf) for surf in surfaces])
+
+    return P_0s, P_1s, P_2s, crossP, tri_start, cells, periodic
+
+
+def trace_rays_jit(xs, ys, nks, alphas, r_a_0, surfaces, widths, I_thresh, pol, randomize, tally, roulette=0):
+    """Traces rays one at a time through a stack of surfaces, like calling single_ray_stack for each ray (with the
+    Fresnel equations at the interfaces), but with the whole calculation compiled by numba. The random numbers are
+    drawn by numba's generator, which is seeded from numpy's global random state, so np.random.seed makes the results
+    reproducible.
+
+    :param xs: x positions at which the rays are launched (array, one entry per ray)
+    :param ys: y positions at which the rays are launched (array, one entry per ray)
+    :param nks: complex refractive indices of the media in the stack, including incidence and transmission media
+    :param alphas: absorption coefficients (in um^-1) of the media in the stack
+    :param r_a_0: vector which, when added to the launch position, gives the starting point of the rays
+    :param surfaces: list of RTSurface objects (offset in z by the cumulative layer widths)
+    :param widths: widths of the media in um (0 for the incidence and transmission media)
+    :param I_thresh: rays with intensity below this threshold are considered absorbed
+    :param pol: polarization of the light ('s', 'p' or 'u')
+    :param randomize: whether to randomize the position of the ray on the surface after the first pass
+    :param tally: ProfileTally to which the passes through the layers are added
+    :param roulette: Russian roulette survival probability for rays whose intensity drops below I_thresh (0: no \
+    Russian roulette)
+
+    :return: I, A_per_layer, thetas, phis, n_passes, n_interactions: as returned by single_ray_stack, for each ray
+    """
+    P_0s, P_1s, P_2s, crossP, tri_start, cells, periodic = surface_arrays(surfaces)
+
+    return trace_rays_kernel(np.asarray(xs, dtype=float), np.asarray(ys, dtype=float),
+                             np.asarray(nks, dtype=complex), np.real(np.asarray(alphas)).astype(float),
+                             np.asarray(r_a_0, dtype=float), np.asarray(widths, dtype=float), float(I_thresh),
+                             pol_codes.get(pol, 2), randomize, float(roulette), P_0s, P_1s, P_2s, crossP, tri_start,
+                             cells, periodic, tally.weight, tally.weight_a, tally.n_bins, min_cos,
+                             np.random.randint(2**31))
+
+
+@njit(cache=True)
+def trace_rays_kernel(xs, ys, nks, alphas, r_a_0, widths, I_thresh, pol, randomize, roulette, P_0s, P_1s, P_2s,
+                      crossP, tri_start, cells, periodic, tally_weight, tally_weight_a, n_bins, tally_min_cos, seed):
+    np.random.seed(seed)
+    n_rays = len(xs)
+    n_layers = len(widths)
+
+    Is = np.zeros(n_rays)
+    A_per_ray = np.zeros((n_rays, n_layers))
+    thetas = np.zeros(n_rays)
+    phis = np.zeros(n_rays)
+    n_passes = np.zeros(n_rays)
+    n_interactions = np.zeros(n_rays)
+
+    for i1 in range(n_rays):
+        direction = 1
+        mat_index = 0
+        surf_index = 0
+        I = 1.0
+        n_pass = 0
+        n_int = 0
+        theta = 0.0
+        phi = 0.0
+
+        r_b = np.array([xs[i1], ys[i1], 0.0])
+        r_a = r_a_0 + r_b
+        d = (r_b - r_a) / np.linalg.norm(r_b - r_a)
+
+        stop = False
+        while not stop:
+            Lx, Ly, z_min, z_max, zcov = cells[surf_index, 0], cells[surf_index, 1], cells[surf_index, 4], \
+                                         cells[surf_index, 5], cells[surf_index, 6]
+
+            if randomize and n_pass > 0:
+                h = z_max - z_min + 0.1
+                n_z = math.ceil(abs(h / d[2]))
+                r_a = np.array([np.random.random() * Lx, np.random.random() * Ly, zcov]) - n_z * d
+            else:
+                r_a[0] = r_a[0] - Lx * ((r_a[0] + d[0] * (zcov - r_a[2]) / d[2]) // Lx)
+                r_a[1] = r_a[1] - Ly * ((r_a[1] + d[1] * (zcov - r_a[2]) / d[2]) // Ly)
+
+            if direction == 1:
+                ni = nks[mat_index]
+                nj = nks[mat_index + 1]
+            else:
+                ni = nks[mat_index - 1]
+                nj = nks[mat_index]
+
+            res, theta, phi, n_int = interface_kernel(r_a, d, ni, nj, surf_index, direction, pol, n_int, P_0s, P_1s,
+                                                      P_2s, crossP, tri_start, cells, periodic)
+
+            if res == 0:
+                direction = -direction
+                surf_index = surf_index + direction
+            else:
+                surf_index = surf_index + direction
+                mat_index = mat_index + direction
+
+            # add the pass to the tally (as in ProfileTally.add), then traverse the layer
+            alpha = alphas[mat_index]
+            cos_th = max(abs(math.cos(theta)), tally_min_cos)
+            a = alpha / cos_th
+            tally_bin = min(int(math.log(cos_th) / math.log(tally_min_cos) * n_bins), n_bins - 1)
+            tally_dir = 0 if direction == 1 else 1
+            tally_weight[mat_index, tally_dir, tally_bin] += I * a
+            tally_weight_a[mat_index, tally_dir, tally_bin] += I * a * a
+
+            I_b = I
+            I = I * math.exp(-alpha * widths[mat_index] / abs(math.cos(theta)))
+            A_per_ray[i1, mat_index] += I_b - I
+            stop = I < I_thresh
+
+            if stop and roulette > 0 and np.random.random() < roulette:
+                stop = False
+                I = I / roulette
+
+            if stop:
+                theta = np.nan
+
+            n_pass += 1
+
+            if direction == 1 and mat_index == n_layers - 1:
+                stop = True
+            elif direction == -1 and mat_index == 0:
+                stop = True
+
+        Is[i1] = I
+        thetas[i1] = theta
+        phis[i1] = phi
+        n_passes[i1] = n_pass
+        n_interactions[i1] = n_int
+
+    return Is, A_per_ray, thetas, phis, n_passes, n_interactions
+
+
+@njit(cache=True)
+def interface_kernel(r_a, d, ni, nj, s, side, pol, n_interactions, P_0s, P_1s, P_2s, crossP, tri_start, cells,
+                     periodic):
+    # compiled equivalent of single_interface_check with the Fresnel equations. r_a and d are updated in place.
+    # Returns final_res (0: reflection, 1: transmission), the outgoing theta and phi and the number of interactions.
+    d0_z = d[2]
+
+    while True:
+        t, k = periodic_intersect_kernel(r_a, d, s, P_0s, P_1s, P_2s, crossP, tri_start, cells, periodic)
+
+        if k < 0:
+            o_t = math.acos(min(max(d[2] / np.linalg.norm(d) ** 2, -1.0), 1.0))
+            o_p = math.atan2(d[1], d[0])
+            final_res = 1 if np.sign(d0_z) == np.sign(d[2]) else 0
+            return final_res, o_t, o_p, n_interactions
+
+        n_interactions += 1
+
+        intersn = r_a + t * d
+        N = crossP[k] / np.linalg.norm(crossP[k])
+        theta = abs(math.atan(np.linalg.norm(np.cross(N, -d)) / np.dot(N, -d)))
+        N = N * side
+
+        if side == 1:
+            n0, n1 = ni, nj
+        else:
+            n0, n1 = nj, ni
+
+        ratio = min(max(n1.real / n0.real, -1.0), 1.0)
+        if theta > math.asin(ratio):
+            R = 1.0
+        else:
+            R = fresnel_R_kernel(n0, n1, theta, pol)
+
+        d_dot_N = np.dot(d, N)
+        if np.random.random() <= R:
+            d_new = d - 2 * d_dot_N * N
+        else:
+            tr_par = (n0.real / n1.real) * (d - d_dot_N * N)
+            d_new = tr_par - math.sqrt(max(1 - np.dot(tr_par, tr_par), 0.0)) * N
+            side = -side
+
+        d[:] = d_new / np.linalg.norm(d_new)
+        r_a[:] = intersn + d / 1e9
+
+
+@njit(cache=True)
+def fresnel_R_kernel(n1, n2, theta, pol):
+    # compiled equivalent of calc_R
+    theta_t = cmath.asin((n1 / n2) * math.sin(theta))
+    Rs = abs((n1 * math.cos(theta) - n2 * cmath.cos(theta_t)) / (n1 * math.cos(theta) + n2 * cmath.cos(theta_t))) ** 2
+    Rp = abs((n1 * cmath.cos(theta_t) - n2 * math.cos(theta)) / (n1 * cmath.cos(theta_t) + n2 * math.cos(theta))) ** 2
+    if pol == 0:
+        return Rs
+    if pol == 1:
+        return Rp
+    return (Rs + Rp) / 2
+
+
+@njit(cache=True)
+def periodic_intersect_kernel(r_a, d, s, P_0s, P_1s, P_2s, crossP, tri_start, cells, periodic):
+    # compiled equivalent of check_intersect_periodic: follows the ray through the unit cells of surface s it crosses
+    # in order. Returns the distance t to the closest intersection and the index of the triangle intersected (-1 if
+    # the ray does not intersect the surface).
+    L = cells[s, :2]
+    origin = cells[s, 2:4]
+    z_min, z_max = cells[s, 4], cells[s, 5]
+    eps = 1e-9 * max(L[0], L[1])
+
+    if d[2] != 0:
+        t_lo = (z_min - eps - r_a[2]) / d[2]
+        t_hi = (z_max + eps - r_a[2]) / d[2]
+        t_0 = max(min(t_lo, t_hi), 0.0)
+        t_1 = max(t_lo, t_hi)
+    elif z_min - eps <= r_a[2] <= z_max + eps:
+        t_0, t_1 = 0.0, np.inf
+    else:
+        return np.inf, -1
+
+    if t_1 < t_0:
+        return np.inf, -1
+
+    cell = np.floor((r_a[:2] + t_0 * d[:2] - origin) / L)
+    step = np.zeros(2)
+    t_next = np.full(2, np.inf)
+    t_delta = np.full(2, np.inf)
+    for i1 in range(2):
+        if periodic[s, i1] and d[i1] != 0:
+            step[i1] = np.sign(d[i1])
+            t_next[i1] = (origin[i1] + (cell[i1] + (1 if step[i1] > 0 else 0)) * L[i1] - r_a[i1]) / d[i1]
+            t_delta[i1] = L[i1] / abs(d[i1])
+
+    shifted = np.zeros(3)
+    for _ in range(max_cells):
+        shifted[0] = r_a[0] - cell[0] * L[0]
+        shifted[1] = r_a[1] - cell[1] * L[1]
+        shifted[2] = r_a[2]
+
+        t, k = intersect_kernel(shifted, d, tri_start[s], tri_start[s + 1], P_0s, P_1s, P_2s, crossP)
+        if k >= 0:
+            return t, k
+
+        axis = 0 if t_next[0] <= t_next[1] else 1
+        if t_next[axis] > t_1:
+            return np.inf, -1
+        cell[axis] += step[axis]
+        t_next[axis] += t_delta[axis]
+
+    return np.inf, -1
+
+
+@njit(cache=True)
+def intersect_kernel(r_a, d, start, end, P_0s, P_1s, P_2s, crossP):
+    # compiled equivalent of check_intersect for triangles start:end: returns the distance to the closest
+    # intersection and the index of the triangle (-1 if there is no intersection)
+    t_min = np.inf
+    k_min = -1
+
+    for k in range(start, end):
+        denom = -(d[0] * crossP[k, 0] + d[1] * crossP[k, 1] + d[2] * crossP[k, 2])
+        if denom == 0:
+            continue
+
+        pref = 1 / denom
+        corner = r_a - P_0s[k]
+        t = pref * np.dot(crossP[k], corner)
+        u = pref * np.dot(np.cross(P_2s[k] - P_0s[k], -d), corner)
+        v = pref * np.dot(np.cross(-d, P_1s[k] - P_0s[k]), corner)
+
+        if u + v <= 1 and u >= -1e-10 and v >= -1e-10 and 0 < t < t_min:
+            t_min = t
+            k_min = k
+
+    return t_min, k_min
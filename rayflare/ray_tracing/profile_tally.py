@@ -0,0 +1,81 @@
+import numpy as np
+
+# the path angle bins are evenly spaced in log(|cos(theta)|) between min_cos and 1
+n_tally_bins = 400
+min_cos = 1e-4
+# maximum number of exponentials evaluated at once when calculating the profile
+max_evaluations = 2000000
+
+
+class ProfileTally:
+    """Accumulates the information needed to calculate the absorption profile in a stack of layers without evaluating
+    the profile for every pass of every ray through a layer. A ray with intensity I travelling through a layer with
+    absorption coefficient alpha at polar angle theta absorbs
+
+    DA(z') = (alpha/|cos(theta)|) * I * exp(-alpha*z'/|cos(theta)|)
+
+    where z' is the distance from the surface at which the ray entered the layer. For each layer and direction of
+    travel, the passes are binned by path angle, storing the sums of I*alpha/|cos(theta)| and
+    I*(alpha/|cos(theta)|)**2. The profile is only evaluated once, at the end, on any depth mesh (using the
+    weighted mean of alpha/|cos(theta)| in each bin), so the cost of tracing does not depend on the depth resolution.
+
+    :param widths: widths of the layers in the stack (including the incidence and transmission medium, with width 0), \
+    in the same units as the depths at which the profile will be evaluated.
+    :param n_bins: number of path angle bins.
+    """
+    def __init__(self, widths, n_bins=n_tally_bins):
+        self.widths = np.array(widths)
+        self.layer_start = np.cumsum(self.widths) - self.widths
+        self.n_bins = n_bins
+        # indexed as (layer, direction (0: down, 1: up), path angle bin)
+        self.weight = np.zeros((len(widths), 2, n_bins))
+        self.weight_a = np.zeros((len(widths), 2, n_bins))
+
+    def add(self, layer, direction, theta, alpha, I_i):
+        """Adds passes through a layer. All arguments can be scalars or arrays of the same length.
+
+        :param layer: index of the layer
+        :param direction: direction of travel (1: downwards, -1: upwards)
+        :param theta: polar angle of the rays in the layer
+        :param alpha: absorption coefficient of the layer (in units of 1/the units of widths)
+        :param I_i: intensity of the rays when they enter the layer
+        """
+        cos_th = np.maximum(np.abs(np.cos(np.real(theta))), min_cos)
+        a = np.real(alpha) / cos_th
+        w = np.real(I_i) * a
+
+        bins = np.minimum((np.log(cos_th) / np.log(min_cos) * self.n_bins).astype(int), self.n_bins - 1)
+        dirs = np.where(np.asarray(direction) == 1, 0, 1)
+
+        np.add.at(self.weight, (layer, dirs, bins), w)
+        np.add.at(self.weight_a, (layer, dirs, bins), w * a)
+
+    def merge(self, other):
+        """Adds the passes stored in another ProfileTally (with the same layers) to this one."""
+        self.weight += other.weight
+        self.weight_a += other.weight_a
+
+    def profile(self, z_pos):
+        """Evaluates the absorption profile (absorbed intensity per unit depth) at the depths z_pos, measured from
+        the top of the stack."""
+        profile = np.zeros(len(z_pos))
+
+        for layer, (start, width) in enumerate(zip(self.layer_start, self.widths)):
+            in_layer = (z_pos >= start) & (z_pos < start + width)
+
+            if not np.any(in_layer):
+                continue
+
+            for i1, z_prime in enumerate([z_pos[in_layer] - start, start + width - z_pos[in_layer]]):
+                w = self.weight[layer, i1]
+                non_zero = w > 0
+
+                if np.any(non_zero):
+                    a = self.weight_a[layer, i1, non_zero] / w[non_zero]
+                    DA = np.zeros(len(z_prime))
+                    chunk = max(1, max_evaluations // np.sum(non_zero))
+                    for j1 in range(0, len(z_prime), chunk):
+                        DA[j1:j1 + chunk] = np.sum(w[non_zero] * np.exp(-a * z_prime[j1:j1 + chunk, None]), axis=1)
+                    profile[in_layer] += DA
+
+        return profile
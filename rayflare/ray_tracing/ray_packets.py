@@ -0,0 +1,827 @@
+import numpy as np
+from rayflare.ray_tracing.profile_tally import ProfileTally
+from rayflare.ray_tracing.sampling import decision_numbers
+
+
+# maximum number of ray-triangle pairs tested at once in check_intersect_packet; limits memory use for
+# surfaces with many triangles
+max_pairs = 2000000
+
+# maximum number of unit cells crossed by a ray in check_intersect_periodic(_packet) before it is considered to have
+# missed the surface (only reached by rays travelling parallel to the xy plane inside the surface)
+max_cells = 10000
+
+
+def ray_packet_stack(xs, ys, nks, alphas, r_a_0, surfaces, widths, z_pos, I_thresh, pol='u', randomize=False,
+                     tally=None, decision_sampling='random', splitting=False, max_depth=8, roulette=0,
+                     first_hit=None):
+    """Traces a packet of rays through a stack of textured surfaces (vectorized equivalent of single_ray_stack).
+    All the rays start travelling downwards from the incidence medium, with starting position (xs[i], ys[i]).
+    Rays which are absorbed or which leave the stack are dropped from the set of active rays. If splitting is True,
+    rays split into reflected and transmitted branches at each surface (see packet_interface_check), so the returned
+    per-ray arrays have one entry per branch.
+
+    If nks and alphas have a second axis, each ray carries an intensity for each of a band of wavelengths with similar
+    refractive indices (hero-wavelength tracing). The paths of the rays are calculated with the refractive indices
+    of the hero wavelength (the middle of the band), and the absorption in the layers is calculated for each
+    wavelength. Reflection or transmission at each interaction is chosen with the probability averaged over the band,
+    and the intensity at each wavelength is multiplied by the ratio of its probability to the average (see
+    decide_RT_Fresnel_band). This gives the right reflection and transmission probabilities at each wavelength, but
+    the rays follow the paths of the hero wavelength, so hero-wavelength tracing is an approximation: it is only
+    accurate where the results change smoothly with the refractive index over the band. Where a small change in n
+    moves the rays across a critical angle (e.g. for light escaping through textured surfaces at weakly absorbed
+    wavelengths), the results at the other wavelengths of the band can be significantly wrong.
+
+    :param xs: x positions at which the rays are launched (array, one entry per ray)
+    :param ys: y positions at which the rays are launched (array, one entry per ray)
+    :param nks: complex refractive indices of the media in the stack, including incidence and transmission media. \
+    For hero-wavelength tracing, an array of shape (n_media, n_wavelengths).
+    :param alphas: absorption coefficients (in um^-1) of the media in the stack, with the same shape as nks
+    :param r_a_0: vector which, when added to the launch position, gives the starting point of the rays
+    :param surfaces: list of RTSurface objects (offset in z by the cumulative layer widths)
+    :param widths: widths of the media in um (0 for the incidence and transmission media)
+    :param z_pos: depths (in um) at which the absorption profile is calculated
+    :param I_thresh: rays with intensity below this threshold are considered absorbed. With splitting, branches are \
+    not stopped in the layers; branches with weight below I_thresh are terminated by Russian roulette at the surfaces.
+    :param pol: polarization of the light ('s', 'p' or 'u')
+    :param randomize: whether to randomize the position of the ray on the surface after the first pass
+    :param tally: a ProfileTally to which the passes through the layers are added (a list with one ProfileTally per \
+    wavelength for hero-wavelength tracing). If None, a new tally is used and the profile is evaluated at z_pos.
+    :param decision_sampling: how the random numbers deciding reflection/transmission are generated (see \
+    rayflare.ray_tracing.sampling.decision_numbers)
+    :param splitting: whether to split the rays into reflected and transmitted branches instead of making a random \
+    decision at each interaction with a surface
+    :param max_depth: number of times a branch can split before only one of its children is kept (if splitting is True)
+    :param roulette: if > 0, rays whose intensity drops below I_thresh in a layer survive with probability roulette, \
+    with their intensity scaled by 1/roulette (Russian roulette), instead of always being stopped (not used with \
+    splitting, since the branches are not stopped in the layers)
+    :param first_hit: first intersection of the launched rays with the first surface, as returned by \
+    first_intersection_packet. This does not depend on the wavelength, so it can be calculated once for all the \
+    wavelengths. If None, it is calculated here.
+
+    :return: I: final intensity of each ray (shape (n_rays, n_wavelengths) for hero-wavelength tracing) \
+    profile: absorption profile summed over all the rays (None if a tally was passed) \
+    A_per_layer: absorption in each layer for each ray, shape (n_rays, n_layers) (or (n_rays, n_layers, \
+    n_wavelengths)) \
+    thetas: final polar angle of each ray (NaN if the ray was absorbed) \
+    phis: final azimuthal angle of each ray \
+    n_passes: number of passes through layers for each ray \
+    n_interactions: number of interactions with surfaces for each ray \
+    origin: index of the launched ray each ray/branch comes from
+    """
+
+    n_rays = len(xs)
+    n_surf = len(surfaces)
+
+    # the intensities are stored for each wavelength of the band (a single one, if not using hero-wavelength tracing)
+    band = np.ndim(nks) == 2
+    nks = np.reshape(nks, (len(nks), -1))
+    alphas = np.reshape(alphas, (len(alphas), -1))
+    n_wl = nks.shape[1]
+    hero = n_wl // 2
+
+    if tally is None:
+        ray_tally = [ProfileTally(widths) for _ in range(n_wl)]
+    else:
+        ray_tally = tally if band else [tally]
+    A_per_layer = np.zeros((n_rays, len(widths), n_wl))
+
+    direction = np.ones(n_rays, dtype=int)  # 1 = travelling down, -1 = travelling up
+    mat_index = np.zeros(n_rays, dtype=int)
+    surf_index = np.zeros(n_rays, dtype=int)
+    I = np.ones((n_rays, n_wl))
+    thetas = np.zeros(n_rays)
+    phis = np.zeros(n_rays)
+    n_passes = np.zeros(n_rays, dtype=int)
+    n_interactions = np.zeros(n_rays, dtype=int)
+    active = np.ones(n_rays, dtype=bool)
+    origin = np.arange(n_rays)
+
+    r_b = np.column_stack((xs, ys, np.zeros(n_rays)))
+    r_a = r_a_0[None, :] + r_b
+    d = (r_b - r_a) / np.linalg.norm(r_b - r_a, axis=1)[:, None]
+
+    while np.any(active):
+        for i1 in range(n_surf):
+            grp = np.where(active & (surf_index == i1))[0]
+
+            if len(grp) == 0:
+                continue
+
+            surf = surfaces[i1]
+
+            r_a_g = r_a[grp]
+            d_g = d[grp]
+
+            if randomize:
+                rand = n_passes[grp] > 0
+                if np.any(rand):
+                    h = surf.z_max - surf.z_min + 0.1
+                    n_rand = np.sum(rand)
+                    r_b_r = np.column_stack((np.random.rand(n_rand) * surf.Lx, np.random.rand(n_rand) * surf.Ly,
+                                             np.full(n_rand, surf.zcov[0])))
+                    n_z = np.ceil(np.abs(h / d_g[rand, 2]))
+                    r_a_g[rand] = r_b_r - n_z[:, None] * d_g[rand]
+                    r_a_g[~rand] = move_into_cell(r_a_g[~rand], d_g[~rand], surf)
+
+                else:
+                    r_a_g = move_into_cell(r_a_g, d_g, surf)
+
+            else:
+                r_a_g = move_into_cell(r_a_g, d_g, surf)
+
+            # surface i1 is between medium i1 (above) and i1 + 1 (below)
+            if splitting:
+                res, theta, phi, r_a_g, d_g, _, n_int, parent, weight, _ = \
+                    packet_interface_check(r_a_g, d_g, nks[i1, 0], nks[i1 + 1, 0], surf, direction[grp], pol,
+                                           decision_sampling=decision_sampling, splitting=True, weight=I[grp, 0],
+                                           I_thresh=I_thresh, max_depth=max_depth, first_hit=first_hit)
+
+                # add the new branches, which start as copies of the ray they split from
+                src = grp[parent[len(grp):]]
+                new_rays = np.arange(len(I), len(I) + len(src))
+                direction, mat_index, surf_index, I, thetas, phis, n_passes, n_interactions, active, r_a, d, \
+                    origin = [np.concatenate((x, x[src])) for x in [direction, mat_index, surf_index, I, thetas,
+                                                                    phis, n_passes, n_interactions, active, r_a, d,
+                                                                    origin]]
+                grp = np.concatenate((grp, new_rays))
+                I[grp] = weight[:, None]
+
+            elif band:
+                res, theta, phi, r_a_g, d_g, _, n_int, band_factor = \
+                    packet_interface_check(r_a_g, d_g, nks[i1, hero], nks[i1 + 1, hero], surf, direction[grp], pol,
+                                           decision_sampling=decision_sampling, first_hit=first_hit,
+                                           band_n=(nks[i1], nks[i1 + 1]))
+                I[grp] = I[grp] * band_factor
+
+            else:
+                res, theta, phi, r_a_g, d_g, _, n_int = packet_interface_check(r_a_g, d_g, nks[i1, 0],
+                                                                              nks[i1 + 1, 0],
+                                                                              surf, direction[grp], pol,
+                                                                              decision_sampling=decision_sampling,
+                                                                              first_hit=first_hit)
+
+            # the first interaction of the launched rays is only used once
+            first_hit = None
+            n_interactions[grp] += n_int
+            r_a[grp] = r_a_g
+            d[grp] = d_g
+
+            if splitting:
+                # branches terminated by Russian roulette
+                killed = I[grp, 0] == 0
+                thetas[grp[killed]] = np.nan
+                active[grp[killed]] = False
+                grp, res, theta, phi = grp[~killed], res[~killed], theta[~killed], phi[~killed]
+
+            refl = res == 0
+            direction[grp[refl]] = -direction[grp[refl]]
+            surf_index[grp] = surf_index[grp] + direction[grp]
+            mat_index[grp[~refl]] = mat_index[grp[~refl]] + direction[grp[~refl]]
+
+            # traverse the layer the rays are now in. A ray is stopped once its intensity is below I_thresh at all
+            # the wavelengths.
+            for mat in np.unique(mat_index[grp]):
+                in_mat = grp[mat_index[grp] == mat]
+                th_m = theta[mat_index[grp] == mat]
+                I_b = I[in_mat]
+                for i2 in range(n_wl):
+                    ray_tally[i2].add(mat, direction[in_mat], th_m, alphas[mat, i2], I_b[:, i2])
+                # with splitting, branches are not stopped in the layers: low-weight branches are terminated without
+                # bias by the Russian roulette at the next interface (see split_weights)
+                stop, I_new = traverse_packet(widths[mat], th_m[:, None], alphas[mat], I_b,
+                                              0 if splitting else I_thresh)
+                stop = np.all(stop, axis=1)
+                np.add.at(A_per_layer, (origin[in_mat], mat), np.real(I_b - I_new))
+
+                if roulette > 0:
+                    survive = stop & (np.random.random(len(stop)) < roulette)
+                    I_new = np.where(survive[:, None], I_new / roulette, I_new)
+                    stop = stop & ~survive
+
+                I[in_mat] = np.real(I_new)
+                thetas[in_mat] = np.where(stop, np.nan, th_m)
+                active[in_mat[stop]] = False
+
+            phis[grp] = phi
+            n_passes[grp] += 1
+
+            # rays which have left the stack
+            finished = ((direction[grp] == 1) & (mat_index[grp] == len(widths) - 1)) | \
+                       ((direction[grp] == -1) & (mat_index[grp] == 0))
+            active[grp[finished]] = False
+
+    # the absorption profile is only evaluated once, for all the rays
+    profile = np.stack([x.profile(z_pos) for x in ray_tally], axis=-1) if tally is None else None
+
+    if not band:
+        I, A_per_layer = I[:, 0], A_per_layer[:, :, 0]
+        profile = None if profile is None else profile[:, 0]
+
+    return I, profile, A_per_layer, thetas, phis, n_passes, n_interactions, origin
+
+
+def ray_packet_interface(xs, ys, nks, r_a_0s, surfaces, pol, wl, Fr_or_TMM, lookuptable, decision_sampling='random',
+                         first_hit=None):
+    """Traces a packet of rays incident on a single interface (vectorized equivalent of single_ray_interface).
+
+    :param xs: x positions at which the rays are launched (array, one entry per ray)
+    :param ys: y positions at which the rays are launched (array, one entry per ray)
+    :param nks: complex refractive indices of the incidence and transmission media
+    :param r_a_0s: array of shape (n_rays, 3); added to the launch position, gives the starting point of each ray
+    :param surfaces: list containing the RTSurface of the interface
+    :param pol: polarization of the light ('s', 'p' or 'u')
+    :param wl: wavelength in m
+    :param Fr_or_TMM: whether to use the Fresnel equations (0) or a TMM lookup table (1)
+    :param lookuptable: TMMLookupTable (only used if Fr_or_TMM = 1)
+    :param decision_sampling: how the random numbers deciding reflection/transmission/absorption are generated (see \
+    rayflare.ray_tracing.sampling.decision_numbers)
+    :param first_hit: first intersection of the rays with the surface, as returned by first_intersection_packet \
+    (calculated here if None)
+
+    :return: theta_out: polar angle of the outgoing rays (10 if the ray was absorbed in the interface layers) \
+    phi_out: azimuthal angle of the outgoing rays \
+    A_surface_layers: absorption per interface layer (only non-zero for absorbed rays) \
+    theta_local: local incidence angle for absorbed rays (10 for rays which were not absorbed)
+    """
+
+    n_rays = len(xs)
+    surf = surfaces[0]
+
+    r_a, d = launch_rays(xs, ys, r_a_0s, surf)
+
+    res, theta, phi, r_a, d, theta_loc, _, A = packet_interface_check(r_a, d, nks[0], nks[1], surf,
+                                                                      np.ones(n_rays, dtype=int), pol,
+                                                                      wl, Fr_or_TMM, lookuptable,
+                                                                      return_A=True,
+                                                                      decision_sampling=decision_sampling,
+                                                                      first_hit=first_hit)
+
+    absorbed = res == 2
+    theta_out = np.where(absorbed, 10, theta)
+    theta_local = np.where(absorbed, np.real(theta_loc), 10)
+
+    return theta_out, phi, A, theta_local
+
+
+def ray_packet_interface_split(xs, ys, nks, r_a_0s, surfaces, pol, wl, Fr_or_TMM, lookuptable, I_thresh,
+                               max_depth=8, decision_sampling='random', first_hit=None):
+    """Traces a packet of rays incident on a single interface like ray_packet_interface, but splitting the rays into
+    reflected and transmitted branches at each interaction instead of making a random decision (see
+    packet_interface_check). Parameters are the same as for ray_packet_interface, plus:
+
+    :param I_thresh: branches with weight below this threshold are terminated by Russian roulette
+    :param max_depth: number of times a branch can split before only one of its children is kept
+
+    :return: theta_out: polar angle of each outgoing branch \
+    phi_out: azimuthal angle of each outgoing branch \
+    weight: weight of each branch (0 for branches terminated by Russian roulette) \
+    ray: index of the launched ray each branch comes from \
+    events: (ray index, local incidence angle, weight, absorption per layer per unit weight) for each interaction \
+    with absorption in the interface layers
+    """
+
+    n_rays = len(xs)
+    surf = surfaces[0]
+
+    r_a, d = launch_rays(xs, ys, r_a_0s, surf)
+
+    _, theta, phi, _, _, _, _, ray, weight, events = packet_interface_check(r_a, d, nks[0], nks[1], surf,
+                                                                           np.ones(n_rays, dtype=int), pol,
+                                                                           wl, Fr_or_TMM, lookuptable,
+                                                                           decision_sampling=decision_sampling,
+                                                                           splitting=True, I_thresh=I_thresh,
+                                                                           max_depth=max_depth, first_hit=first_hit)
+
+    return theta, phi, weight, ray, events
+
+
+def launch_rays(xs, ys, r_a_0s, surf):
+    """Starting points and directions of the rays launched from (xs, ys, 0) + r_a_0s towards (xs, ys, 0), translated so
+    that they cross the unit cell of surf (see move_into_cell)."""
+    r_b = np.column_stack((xs, ys, np.zeros(len(xs))))
+    r_a = r_a_0s + r_b
+    d = (r_b - r_a) / np.linalg.norm(r_b - r_a, axis=1)[:, None]
+
+    return move_into_cell(r_a, d, surf), d
+
+
+def first_intersection_packet(xs, ys, r_a_0s, surf):
+    """First intersection of the rays launched from (xs, ys, 0) + r_a_0s towards (xs, ys, 0) with the surface surf.
+    This only depends on the geometry, not on the wavelength, so it can be calculated once and passed as first_hit to
+    ray_packet_stack, ray_packet_interface or ray_packet_interface_split for each wavelength.
+
+    :param xs: x positions at which the rays are launched (array, one entry per ray)
+    :param ys: y positions at which the rays are launched (array, one entry per ray)
+    :param r_a_0s: array of shape (n_rays, 3) or (3,); added to the launch position, gives the starting point of each ray
+    :param surf: RTSurface the rays are incident on
+
+    :return: t: distance along each ray to the intersection (inf if the ray misses the surface) \
+    ind: index of the triangle intersected
+    """
+    r_a, d = launch_rays(xs, ys, r_a_0s, surf)
+
+    return check_intersect_periodic_packet(r_a, d, surf)
+
+
+def move_into_cell(r_a, d, surf):
+    """Translates the rays so that they cross the plane z = zcov inside the unit cell [0, Lx) x [0, Ly)."""
+    r_a = r_a.copy()
+    z_dist = (surf.zcov[0] - r_a[:, 2]) / d[:, 2]
+    r_a[:, 0] = r_a[:, 0] - surf.Lx * ((r_a[:, 0] + d[:, 0] * z_dist) // surf.Lx)
+    r_a[:, 1] = r_a[:, 1] - surf.Ly * ((r_a[:, 1] + d[:, 1] * z_dist) // surf.Ly)
+    return r_a
+
+
+def packet_interface_check(r_a, d, ni, nj, tri, side, pol, wl=None, Fr_or_TMM=0, lookuptable=None,
+                           return_A=False, decision_sampling='random', splitting=False, weight=None, I_thresh=0,
+                           max_depth=8, first_hit=None, band_n=None):
+    """Vectorized equivalent of single_interface_check: follows all the rays in the packet until they have been
+    reflected, transmitted or absorbed by the surface tri. The next intersection of each ray with the periodic surface
+    is found by check_intersect_periodic_packet; a ray which does not intersect the surface again has left it.
+
+    If splitting is True, the rays are not sent one way or the other at each interaction: a ray with weight w splits
+    into a reflected branch with weight w*R and a transmitted branch with weight w*T, and the absorbed part w*A (for a
+    TMM lookup table) is recorded as an absorption event. The transmitted branches are added to the end of the
+    arrays. Once a branch has split max_depth times, only one of its children survives (chosen randomly, with
+    probability proportional to its weight), carrying the weight of both. Branches with weight below I_thresh are
+    terminated by Russian roulette: they survive with probability weight/I_thresh, with weight I_thresh.
+
+    If first_hit (the result of check_intersect_periodic_packet for r_a and d, e.g. from first_intersection_packet) is
+    passed, it is used for the first intersection of the rays instead of being calculated again.
+
+    If band_n = (ni_band, nj_band), the refractive indices of the two media at each wavelength of a band, is passed
+    (hero-wavelength tracing, with ni and nj the refractive indices at the hero wavelength), the decisions are made
+    with decide_RT_Fresnel_band and the factor by which the intensity of each ray at each wavelength must be
+    multiplied is returned as band_factor (shape (n_rays, n_wavelengths)) instead of A.
+
+    :return: final_res: 0 for reflection, 1 for transmission, 2 for absorption in the interface layers \
+    o_t, o_p: polar and azimuthal angle of the outgoing rays \
+    r_a, d: final position and direction of the rays \
+    theta_loc: local incidence angle (relative to the texture) of the last interaction \
+    n_interactions: number of intersections with the surface for each ray \
+    A: absorption per interface layer (only if return_A is True and splitting is False) \
+    If splitting is True, three more values are returned instead of A: parent: index of the ray each branch comes \
+    from; weight: final weight of each branch (0 for terminated branches); events: (ray index, local incidence \
+    angle, weight, absorption per layer per unit weight) for each interaction with absorption in the interface layers
+    """
+
+    n_rays = r_a.shape[0]
+    Lx = tri.Lx
+    Ly = tri.Ly
+
+    r_a = r_a.copy()
+    d = d.copy()
+    side = side.copy()
+    d0_z = d[:, 2].copy()
+
+    final_res = np.zeros(n_rays, dtype=int)
+    theta_loc = np.zeros(n_rays)
+    n_interactions = np.zeros(n_rays, dtype=int)
+    n_layers = lookuptable.n_layers if Fr_or_TMM == 1 else 0
+    A = np.zeros((n_rays, n_layers))
+
+    if band_n is not None:
+        band_factor = np.ones((n_rays, len(band_n[0])))
+
+    if splitting:
+        weight = np.ones(n_rays) if weight is None else np.array(weight, dtype=float)
+        parent = np.arange(n_rays)
+        depth = np.zeros(n_rays, dtype=int)
+        events = []
+
+    unit_normals = tri.crossP / np.linalg.norm(tri.crossP, axis=1)[:, None]
+
+    act = np.arange(n_rays)
+
+    while len(act) > 0:
+        if first_hit is not None:
+            (t, ind), first_hit = first_hit, None
+        else:
+            t, ind = check_intersect_periodic_packet(r_a[act], d[act], tri)
+        hit = np.isfinite(t)
+        new_rays = np.array([], dtype=int)
+
+        # rays which intersect the surface
+        h = act[hit]
+        if len(h) > 0:
+            n_interactions[h] += 1
+
+            intersn = r_a[h] + t[hit][:, None] * d[h]
+            N = unit_normals[ind[hit]] * side[h][:, None]
+            theta = local_angle(N, d[h])
+            theta_loc[h] = theta
+
+            n0 = np.where(side[h] == 1, ni, nj)
+            n1 = np.where(side[h] == 1, nj, ni)
+            rnd = decision_numbers(len(h), decision_sampling)
+
+            if splitting:
+                w_R, w_T, A_h = split_weights(n0, n1, theta, side[h], pol, wl, Fr_or_TMM, lookuptable,
+                                              weight[h], depth[h] >= max_depth, rnd, I_thresh)
+
+                if Fr_or_TMM > 0:
+                    events.append((parent[h], np.real(theta), weight[h], A_h))
+
+                d_R = refract_packet(n0, n1, d[h], N, np.ones(len(h), dtype=bool))
+                d_T = refract_packet(n0, n1, d[h], N, np.zeros(len(h), dtype=bool))
+
+                # the ray continues as the reflected branch if it survives, otherwise as the transmitted branch.
+                # If both survive, a copy of the ray is added for the transmitted branch.
+                reflect = w_R > 0
+                clone = reflect & (w_T > 0)
+                killed = (w_R == 0) & (w_T == 0)
+
+                new_rays = np.arange(len(r_a), len(r_a) + np.sum(clone))
+                src = h[clone]
+                r_a, d, side, d0_z, final_res, theta_loc, n_interactions, A, weight, parent, depth = \
+                    [np.concatenate((x, x[src])) for x in
+                     [r_a, d, side, d0_z, final_res, theta_loc, n_interactions, A, weight, parent, depth]]
+
+                d[new_rays] = d_T[clone]
+                side[new_rays] = -side[src]
+                weight[new_rays] = w_T[clone]
+                r_a[new_rays] = np.real(intersn[clone] + d_T[clone] / 1e9)
+
+                d_new = np.where(reflect[:, None], d_R, d_T)
+                side_new = np.where(reflect, side[h], -side[h])
+                weight[h] = np.where(reflect, w_R, w_T)
+                depth[h] += 1
+                depth[new_rays] += 1
+                absorbed = np.zeros(len(h), dtype=bool)
+
+            elif band_n is not None:
+                n0_band = np.where(side[h][:, None] == 1, band_n[0], band_n[1])
+                n1_band = np.where(side[h][:, None] == 1, band_n[1], band_n[0])
+                d_new, side_new, factor = decide_RT_Fresnel_band(n0, n1, n0_band, n1_band, theta, d[h], N, side[h],
+                                                                 pol, rnd)
+                band_factor[h] = band_factor[h] * factor
+                absorbed = np.zeros(len(h), dtype=bool)
+
+            elif Fr_or_TMM == 0:
+                d_new, side_new = decide_RT_Fresnel_packet(n0, n1, theta, d[h], N, side[h], pol, rnd)
+                absorbed = np.zeros(len(h), dtype=bool)
+            else:
+                d_new, side_new, absorbed, A_h = decide_RT_TMM_packet(n0, n1, theta, d[h], N, side[h], pol, rnd,
+                                                                      wl, lookuptable)
+                A[h[absorbed]] = A_h[absorbed]
+
+            d[h] = d_new
+            side[h] = side_new
+            # make sure the ray-tracer doesn't immediately just find the same intersection again
+            r_a[h] = np.real(intersn + d_new / 1e9)
+
+            final_res[h[absorbed]] = 2
+            act_done = h[absorbed]
+
+            if splitting:
+                act_done = h[killed]
+
+        else:
+            act_done = np.array([], dtype=int)
+
+        # rays which do not intersect the surface again have left it: transmitted if they are still travelling in the
+        # same direction as when they arrived, otherwise reflected
+        left = act[~hit]
+        final_res[left] = np.where(np.sign(d0_z[left]) == np.sign(d[left, 2]), 1, 0)
+
+        act = np.concatenate((np.setdiff1d(act, np.concatenate((act_done, left))), new_rays))
+
+    # translate back into unit cell before next ray
+    r_a = wrap_into_cell(r_a, Lx, Ly)
+
+    o_t = np.real(np.arccos(np.clip(d[:, 2] / np.linalg.norm(d, axis=1) ** 2, -1, 1)))
+    o_p = np.arctan2(d[:, 1], d[:, 0])
+
+    if splitting:
+        if len(events) > 0:
+            events = tuple(np.concatenate(x) for x in zip(*events))
+        else:
+            events = (np.array([], dtype=int), np.array([]), np.array([]), np.zeros((0, n_layers)))
+        return final_res, o_t, o_p, r_a, d, theta_loc, n_interactions, parent, weight, events
+
+    if return_A:
+        return final_res, o_t, o_p, r_a, d, theta_loc, n_interactions, A
+
+    if band_n is not None:
+        return final_res, o_t, o_p, r_a, d, theta_loc, n_interactions, band_factor
+
+    return final_res, o_t, o_p, r_a, d, theta_loc, n_interactions
+
+
+def split_weights(n0, n1, theta, side, pol, wl, Fr_or_TMM, lookuptable, weight, deep, rnd, I_thresh):
+    """Weights of the reflected and transmitted branches when rays with the given weights split at an interface
+    (see packet_interface_check). For the rays where deep is True, only one branch (chosen using the random numbers
+    rnd) survives, carrying the combined weight of both.
+
+    :return: w_R, w_T: weights of the reflected and transmitted branches (0 if the branch does not survive) \
+    A_per_layer: absorption in each interface layer per unit weight
+    """
+    if Fr_or_TMM == 0:
+        R = fresnel_R_packet(n0, n1, theta, pol)
+        T = 1 - R
+        A_per_layer = np.zeros((len(theta), 0))
+    else:
+        R, T, A_per_layer = lookuptable.lookup(side, pol, np.abs(theta), wl)
+
+    w_R = weight * R
+    w_T = weight * T
+
+    # Russian roulette between the two branches
+    choose_R = rnd * (R + T) <= R
+    w_RT = w_R + w_T
+    w_R = np.where(deep, np.where(choose_R, w_RT, 0), w_R)
+    w_T = np.where(deep, np.where(choose_R, 0, w_RT), w_T)
+
+    return russian_roulette(w_R, I_thresh), russian_roulette(w_T, I_thresh), A_per_layer
+
+
+def russian_roulette(weight, I_thresh):
+    """Weights below I_thresh are set to I_thresh with probability weight/I_thresh, and to 0 otherwise. This terminates
+    low-weight rays without changing the expected weight."""
+    weight = np.array(weight, dtype=float)
+    low = (weight > 0) & (weight < I_thresh)
+
+    if np.any(low):
+        survive = np.random.random(np.sum(low)) < weight[low] / I_thresh
+        weight[low] = np.where(survive, I_thresh, 0)
+
+    return weight
+
+
+def wrap_into_cell(r_a, Lx, Ly):
+    """Translates positions which are outside the unit cell back into it (positions on the edges are unchanged)."""
+    r_a = r_a.copy()
+    r_a[:, 0] = np.where((r_a[:, 0] > Lx) | (r_a[:, 0] < 0), r_a[:, 0] % Lx, r_a[:, 0])
+    r_a[:, 1] = np.where((r_a[:, 1] > Ly) | (r_a[:, 1] < 0), r_a[:, 1] % Ly, r_a[:, 1])
+    return r_a
+
+
+def check_intersect_packet(r_a, d, tri):
+    """Finds the closest intersection of each ray with the triangles in tri (vectorized check_intersect).
+
+    :return: t: distance to the intersection along the ray (inf if the ray misses the surface) \
+    ind: index of the triangle intersected
+    """
+    if tri.analytic:
+        return tri.intersect(r_a, d)
+
+    n_rays = r_a.shape[0]
+    t_min = np.full(n_rays, np.inf)
+    ind = np.zeros(n_rays, dtype=int)
+
+    if tri.grid is not None:
+        return check_intersect_grid(r_a, d, tri, t_min, ind)
+
+    chunk = max(1, max_pairs // tri.size)
+
+    E1 = tri.P_1s - tri.P_0s
+    E2 = tri.P_2s - tri.P_0s
+
+    for start in range(0, n_rays, chunk):
+        sl = slice(start, start + chunk)
+        D = -d[sl, None, :]
+        corner = r_a[sl, None, :] - tri.P_0s[None, :, :]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pref = 1 / np.sum(D * tri.crossP[None, :, :], axis=2)
+            t = pref * np.sum(tri.crossP[None, :, :] * corner, axis=2)
+            u = pref * np.sum(np.cross(E2[None, :, :], D) * corner, axis=2)
+            v = pref * np.sum(np.cross(D, E1[None, :, :]) * corner, axis=2)
+
+            # get errors if set exactly to zero.
+            which_intersect = (u + v <= 1) & (u >= -1e-10) & (v >= -1e-10) & (t > 0)
+
+        t[~which_intersect] = np.inf
+        ind_chunk = np.argmin(t, axis=1)
+        t_min[sl] = t[np.arange(t.shape[0]), ind_chunk]
+        ind[sl] = ind_chunk
+
+    return t_min, ind
+
+
+def check_intersect_grid(r_a, d, tri, t_min, ind):
+    """check_intersect_packet for surfaces with an acceleration grid: only the (ray, triangle) pairs returned by
+    tri.candidate_triangles are tested."""
+    chunk = max(1, max_pairs // (4 * max(1, tri.size // int(np.prod(tri.grid)))))
+
+    for start in range(0, r_a.shape[0], chunk):
+        sl = slice(start, start + chunk)
+        ray, cand = tri.candidate_triangles(r_a[sl], d[sl])
+        D = -d[sl][ray]
+        corner = r_a[sl][ray] - tri.P_0s[cand]
+        crossP = tri.crossP[cand]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pref = 1 / np.sum(D * crossP, axis=1)
+            t = pref * np.sum(crossP * corner, axis=1)
+            u = pref * np.sum(np.cross(tri.P_2s[cand] - tri.P_0s[cand], D) * corner, axis=1)
+            v = pref * np.sum(np.cross(D, tri.P_1s[cand] - tri.P_0s[cand]) * corner, axis=1)
+
+            # get errors if set exactly to zero.
+            which_intersect = (u + v <= 1) & (u >= -1e-10) & (v >= -1e-10) & (t > 0)
+
+        ray, cand, t = ray[which_intersect], cand[which_intersect], t[which_intersect]
+        # closest intersection for each ray (lowest triangle index in case of ties, as in the dense calculation)
+        order = np.lexsort((cand, t, ray))
+        first = order[np.r_[True, ray[order][1:] != ray[order][:-1]]] if len(order) > 0 else order
+        t_min[start + ray[first]] = t[first]
+        ind[start + ray[first]] = cand[first]
+
+    return t_min, ind
+
+
+def check_intersect_periodic_packet(r_a, d, tri):
+    """Finds the closest intersection of each ray with the surface tri, repeated periodically in x and y with period
+    (tri.Lx, tri.Ly). The part of each ray between the planes z = tri.z_min and z = tri.z_max is followed through the
+    unit cells it crosses in order (a 2D digital differential analyzer over the xy lattice); in each cell, the ray is
+    translated back into the unit cell and tested against the triangles, and the first cell with an intersection gives
+    the closest one. The starting points r_a do not need to be inside the unit cell. For surfaces which are invariant along one axis (tri.invariant_axis), the rays are only followed
+    through the unit cells along the other axis, so the walk is 1D.
+
+    :param r_a: starting points of the rays, array of shape (n_rays, 3)
+    :param d: directions of the rays, array of shape (n_rays, 3)
+    :param tri: RTSurface
+
+    :return: t: distance to the intersection along the ray (inf if the ray does not intersect the surface) \
+    ind: index of the triangle intersected
+    """
+    n_rays = r_a.shape[0]
+    t_min = np.full(n_rays, np.inf)
+    ind = np.zeros(n_rays, dtype=int)
+
+    L = np.array([tri.Lx, tri.Ly])
+    origin = np.min(tri.Points[:, :2], axis=0)
+    eps = 1e-9 * max(tri.Lx, tri.Ly)
+
+    # range of t (r = r_a + t*d) for which the ray is between z_min and z_max
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_lo = (tri.z_min - eps - r_a[:, 2]) / d[:, 2]
+        t_hi = (tri.z_max + eps - r_a[:, 2]) / d[:, 2]
+    t_0 = np.maximum(np.fmin(t_lo, t_hi), 0)
+    t_1 = np.fmax(t_lo, t_hi)
+    flat = d[:, 2] == 0
+    inside = (r_a[:, 2] >= tri.z_min - eps) & (r_a[:, 2] <= tri.z_max + eps)
+    t_0[flat] = 0
+    t_1[flat] = np.where(inside[flat], np.inf, -np.inf)
+
+    act = np.where(t_1 >= t_0)[0]
+
+    # unit cell in which each ray enters the slab, and values of t at which it crosses the next cell boundary in x
+    # and y (t_next) and between successive boundaries (t_delta)
+    cell = np.floor((r_a[act, :2] + t_0[act, None] * d[act, :2] - origin) / L)
+    step = np.sign(d[act, :2]) * periodic_axes(tri)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_next = (origin + (cell + (step > 0)) * L - r_a[act, :2]) / d[act, :2]
+        t_delta = L / np.abs(d[act, :2])
+    t_next[step == 0] = np.inf
+    n_cells = 0
+
+    while len(act) > 0 and n_cells < max_cells:
+        shift = np.column_stack((cell * L, np.zeros(len(act))))
+        t, tri_ind = check_intersect_packet(r_a[act] - shift, d[act], tri)
+        hit = np.isfinite(t)
+        t_min[act[hit]] = t[hit]
+        ind[act[hit]] = tri_ind[hit]
+
+        # move the other rays into the next cell along their path, unless they have left the slab
+        axis = np.argmin(t_next, axis=1)
+        rows = np.arange(len(act))
+        keep = ~hit & (t_next[rows, axis] <= t_1[act])
+        cell[rows, axis] += step[rows, axis]
+        t_next[rows, axis] += t_delta[rows, axis]
+
+        act, cell, step, t_next, t_delta = act[keep], cell[keep], step[keep], t_next[keep], t_delta[keep]
+        n_cells += 1
+
+    return t_min, ind
+
+
+def periodic_axes(tri):
+    """Whether the rays have to be followed through the unit cells of tri along x and along y (not along the axis
+    along which tri is invariant, if any)."""
+    return np.array([tri.invariant_axis != 'x', tri.invariant_axis != 'y'])
+
+
+def local_angle(N, d):
+    """Angle (in radians) between the ray directions d and the surface normals N (vectorized version of the
+    calculation in check_intersect)."""
+    return np.arctan(np.linalg.norm(np.cross(N, -d), axis=1) / np.sum(N * -d, axis=1))
+
+
+def calc_R_packet(n1, n2, theta, pol):
+    theta_t = np.arcsin((n1 / n2) * np.sin(theta))
+    Rs = np.abs((n1 * np.cos(theta) - n2 * np.cos(theta_t)) / (n1 * np.cos(theta) + n2 * np.cos(theta_t))) ** 2
+    Rp = np.abs((n1 * np.cos(theta_t) - n2 * np.cos(theta)) / (n1 * np.cos(theta_t) + n2 * np.cos(theta))) ** 2
+    if pol == 's':
+        return Rs
+    if pol == 'p':
+        return Rp
+    else:
+        return (Rs + Rp) / 2
+
+
+def refract_packet(n0, n1, d, N, reflect):
+    """New (normalized) direction of the rays after reflection (where reflect is True) or refraction."""
+    d_dot_N = np.sum(d * N, axis=1)[:, None]
+    d_r = d - 2 * d_dot_N * N
+
+    # for now, ignore effect of k on refraction
+    tr_par = (np.real(n0) / np.real(n1))[:, None] * (d - d_dot_N * N)
+    tr_perp = -np.sqrt(np.clip(1 - np.linalg.norm(tr_par, axis=1) ** 2, 0, None))[:, None] * N
+    d_t = tr_par + tr_perp
+
+    d_new = np.real(np.where(reflect[:, None], d_r, d_t))
+
+    return d_new / np.linalg.norm(d_new, axis=1)[:, None]
+
+
+def fresnel_R_packet(n0, n1, theta, pol):
+    """Fresnel reflectance for rays going from n0 to n1, including total internal reflection."""
+    ratio = np.clip(np.real(n1) / np.real(n0), -1, 1)
+    R = np.ones(len(theta))
+    below_critical = np.abs(theta) <= np.arcsin(ratio)
+    R[below_critical] = calc_R_packet(n0[below_critical], n1[below_critical], np.abs(theta[below_critical]), pol)
+
+    return R
+
+
+def decide_RT_Fresnel_packet(n0, n1, theta, d, N, side, pol, rnd):
+    """Vectorized version of decide_RT_Fresnel."""
+    R = fresnel_R_packet(n0, n1, theta, pol)
+
+    reflect = rnd <= R
+    d = refract_packet(n0, n1, d, N, reflect)
+    side = np.where(reflect, side, -side)
+
+    return d, side
+
+
+def decide_RT_Fresnel_band(n0, n1, n0_band, n1_band, theta, d, N, side, pol, rnd):
+    """Decides whether rays carrying a band of wavelengths are reflected or transmitted (hero-wavelength tracing). The
+    rays are reflected with probability P equal to the reflectance R averaged over the wavelengths, and the new
+    directions are calculated with the refractive indices n0, n1 of the hero wavelength. The intensity at each
+    wavelength must then be multiplied by R/P (for reflected rays) or (1 - R)/(1 - P) (for transmitted rays): on
+    average, the fraction R of the intensity at each wavelength is reflected at this interaction, even if the hero
+    wavelength is totally internally reflected and the others are not (but the directions are only right for the
+    hero wavelength, see ray_packet_stack). In that case, a transmitted ray only carries the wavelengths which
+    are not totally internally reflected (the factor is 0 for the others), so its direction is calculated with the
+    refractive indices of the wavelength closest to the hero wavelength which is transmitted.
+
+    :param n0_band: refractive indices of the incidence medium at each wavelength, shape (n_rays, n_wavelengths)
+    :param n1_band: refractive indices of the transmission medium at each wavelength, shape (n_rays, n_wavelengths)
+
+    :return: d: new directions \
+    side: new sides \
+    factor: factor by which the intensity of each ray at each wavelength is multiplied, shape (n_rays, n_wavelengths)
+    """
+    R = np.stack([fresnel_R_packet(n0_band[:, i1], n1_band[:, i1], theta, pol) for i1 in range(n0_band.shape[1])],
+                 axis=1)
+    P = np.mean(R, axis=1)
+
+    reflect = rnd <= P
+
+    # transmitted rays for which the band straddles the critical angle of the hero wavelength
+    ratio = np.real(n1_band) / np.real(n0_band)
+    hero_ratio = (np.real(n1) / np.real(n0))[:, None]
+    below_critical = np.abs(theta)[:, None] <= np.arcsin(np.clip(ratio, -1, 1))
+    straddle = ~reflect & (np.abs(theta) > np.arcsin(np.clip(hero_ratio[:, 0], -1, 1)))
+    if np.any(straddle):
+        closest = np.argmin(np.where(below_critical, np.abs(ratio - hero_ratio), np.inf), axis=1)
+        rays = np.arange(len(theta))
+        n0 = np.where(straddle, n0_band[rays, closest], n0)
+        n1 = np.where(straddle, n1_band[rays, closest], n1)
+
+    d = refract_packet(n0, n1, d, N, reflect)
+    side = np.where(reflect, side, -side)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = np.where(reflect[:, None], R / P[:, None], (1 - R) / (1 - P[:, None]))
+
+    return d, side, np.nan_to_num(factor)
+
+
+def decide_RT_TMM_packet(n0, n1, theta, d, N, side, pol, rnd, wl, lookuptable):
+    """Vectorized version of decide_RT_TMM."""
+    R, T, A_per_layer = lookuptable.lookup(side, pol, np.abs(theta), wl)
+
+    reflect = rnd <= R
+    absorbed = rnd > R + T
+    d_new = refract_packet(n0, n1, d, N, reflect)
+    d = np.where(absorbed[:, None], d, d_new)
+    side = np.where(reflect | absorbed, side, -side)
+
+    return d, side, absorbed, A_per_layer
+
+
+def traverse_packet(width, theta, alpha, I_i, I_thresh):
+    """Vectorized version of traverse for rays in the same layer. The absorption profile is not calculated here;
+    the passes are added to a ProfileTally instead.
+
+    :return: stop: whether each ray has been absorbed \
+    I_back: intensity of each ray after traversing the layer
+    """
+    I_back = I_i * np.exp(-alpha * width / np.abs(np.cos(theta)))
+    stop = I_back < I_thresh
+
+    return stop, I_back
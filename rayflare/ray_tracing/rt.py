@@ -1,19 +1,28 @@
 import numpy as np
 import numpy.matlib
 import os
+import shutil
 from scipy.spatial import Delaunay
 from cmath import sin, cos, sqrt, acos, atan
 from math import atan2
 from random import random
 from itertools import product
 import xarray as xr
-from rayflare.angles import fold_phi, make_angle_vector
+from rayflare.angles import fold_phi, fold_phi_mirror, angle_grid, accumulate_bins
 from sparse import COO, save_npz, load_npz, stack
 from rayflare.config import results_path
-from joblib import Parallel, delayed
 from time import time
 from copy import deepcopy
 from warnings import warn
+from rayflare.ray_tracing.ray_packets import ray_packet_stack, ray_packet_interface, ray_packet_interface_split, \
+    first_intersection_packet, max_cells, periodic_axes
+from rayflare.ray_tracing.profile_tally import ProfileTally
+from rayflare.ray_tracing.convergence import RunningStats
+from rayflare.ray_tracing.sampling import sample_points
+from rayflare.ray_tracing import jit_kernel
+from rayflare.scheduling import run_tasks, iter_tasks, ray_blocks, ray_tracing_cost, SharedStore, checkpoint_paths, \
+    checkpoint_key
+from rayflare.transfer_matrix_method.lookup_table import TMMLookupTable
 
 
 def RT(group, incidence, transmission, surf_name, options, Fr_or_TMM = 0, front_or_rear = 'front',
@@ -88,6 +97,27 @@ def RT(group, incidence, transmission, surf_name, options, Fr_or_TMM = 0, front_
         c_az = options['c_azimuth']
         pol = options['pol']
         depth_spacing = options['depth_spacing']
+        ray_packets = options.get('ray_packets', False)
+        decision_sampling = options.get('decision_sampling', 'random')
+        splitting = options.get('ray_splitting', False)
+        max_depth = options.get('splitting_max_depth', 8)
+        I_thresh = options.get('I_thresh', 0) if splitting else 0
+
+        if splitting and not ray_packets:
+            warn('Ray splitting is only implemented for the ray packet tracer, which will be used.')
+
+        if any(text[0].invariant_axis is not None for text in group.textures) and phi_sym < np.pi/2:
+            warn('Textures which are invariant along one axis only have mirror symmetry, but options.phi_symmetry < '
+                 'pi/2 assumes a higher symmetry: the azimuthal angles are folded into 0 to phi_symmetry as for other '
+                 'textures. Set options.phi_symmetry to pi/2 to use the mirror symmetry instead.')
+
+        # if n_rays_tol is set, the rays are traced in batches (each covering all the incidence angles) until the
+        # standard error of the fraction of light reflected, transmitted and absorbed is below n_rays_tol
+        n_rays_tol = options.get('n_rays_tol', None)
+        if n_rays_tol is not None:
+            max_batches = max(1, int(np.ceil(options.get('n_rays_max', n_rays) / n_rays)))
+        else:
+            max_batches = 1
 
         if front_or_rear == 'front':
             side = 1
@@ -98,10 +128,13 @@ def RT(group, incidence, transmission, surf_name, options, Fr_or_TMM = 0, front_
             lookuptable = xr.open_dataset(os.path.join(structpath, surf_name + '.nc'))
             if front_or_rear == 'rear':
                 lookuptable = lookuptable.assign_coords(side=np.flip(lookuptable.side))
+            tmm_lookup = TMMLookupTable(lookuptable, options.get('lookuptable_interpolate', False))
         else:
             lookuptable = None
+            tmm_lookup = None
 
-        theta_intv, phi_intv, angle_vector = make_angle_vector(n_theta_bins, phi_sym, c_az)
+        grid = angle_grid(n_theta_bins, phi_sym, c_az)
+        angle_vector = grid.angle_vector
 
         if only_incidence_angle:
             print('Calculating matrix only for incidence theta/phi')
@@ -130,8 +163,9 @@ def RT(group, incidence, transmission, surf_name, options, Fr_or_TMM = 0, front_
 
         else:
             if options['random_ray_angles']:
-                thetas_in = np.random.random(n_angles)*np.pi/2
-                phis_in = np.random.random(n_angles)*2*np.pi
+                angles_rnd = sample_points(n_angles, 2, options.get('ray_sequence', 'random'))
+                thetas_in = angles_rnd[:, 0]*np.pi/2
+                phis_in = angles_rnd[:, 1]*2*np.pi
             else:
                 angles_in = angle_vector[:int(len(angle_vector)/2),:]
                 if n_angles/len(angles_in) < 1:
@@ -171,8 +205,8 @@ def RT(group, incidence, transmission, surf_name, options, Fr_or_TMM = 0, front_
         y_lim = surfaces[0].Ly
 
         if options['random_ray_position']:
-            xs = np.random.uniform(0, x_lim, nx)
-            ys = np.random.uniform(0, y_lim, ny)
+            xs = x_lim*sample_points(nx, 1, options.get('ray_sequence', 'random'))[:, 0]
+            ys = y_lim*sample_points(ny, 1, options.get('ray_sequence', 'random'))[:, 0]
 
         else:
             if options['avoid_edges']:
@@ -184,29 +218,69 @@ def RT(group, incidence, transmission, surf_name, options, Fr_or_TMM = 0, front_
 
         #print('n_th_in', len(thetas_in), len(xs))
 
-        if options['parallel']:
-            allres = Parallel(n_jobs=options['n_jobs'])(delayed(RT_wl)
-                                           (i1, wavelengths[i1], n_angles, nx, ny,
-                                            widths, thetas_in, phis_in, h,
-                                            xs, ys, nks, surfaces,
-                                            pol, phi_sym, theta_intv,
-                                            phi_intv, angle_vector, Fr_or_TMM, n_absorbing_layers,
-                                            lookuptable, calc_profile, depth_spacing, side)
-                                       for i1 in range(len(wavelengths)))
+        # the first intersection of each ray with the surface does not depend on the wavelength, so it is only
+        # calculated once and shared by all the wavelengths
+        first_hit = interface_first_hits(n_angles, thetas_in, phis_in, h, xs, ys, surfaces[0],
+                                         ray_packets or splitting)
+
+        # the result at each wavelength is saved as soon as it is calculated, so that an interrupted calculation can
+        # be resumed: only the missing wavelengths are calculated when RT is called again with the same options and
+        # structure (the file names include a hash of these)
+        if save and options.get('checkpoint', False):
+            checkpoint_folder = os.path.join(structpath, surf_name + front_or_rear + 'checkpoints')
+            key = checkpoint_key(options, nks, surfaces, widths, Fr_or_TMM, n_absorbing_layers, calc_profile,
+                                 only_incidence_angle, side, None if lookuptable is None else lookuptable.load())
+            checkpoints = checkpoint_paths(checkpoint_folder, wavelengths, key)
+        else:
+            checkpoints = None
+
+        # relative cost of tracing the rays at each wavelength: the media on either side of the interface are not
+        # traversed, so only the trapping of the rays by the refractive index contrast is taken into account
+        wl_costs = n_angles * ray_tracing_cost(nks, np.zeros(nks.shape), np.zeros(len(nks)))
+
+        # in parallel, the incidence angles at each wavelength are split into blocks of whole incidence bins, so that
+        # the blocks have similar costs. Each block fills different columns of the matrices, so the results of the
+        # blocks for each wavelength are simply added.
+        bins = incidence_bins(thetas_in[:n_angles], phis_in[:n_angles], grid, surfaces, phi_sym, side)
+        unique_bins = np.unique(bins)
 
+        if options['parallel'] and options.get('load_balancing', True):
+            n_blocks = ray_blocks(wl_costs, len(unique_bins), options['n_jobs'])
         else:
-            allres = [RT_wl(i1, wavelengths[i1], n_angles, nx, ny, widths,
-                            thetas_in, phis_in, h, xs, ys, nks, surfaces,
-                                     pol, phi_sym, theta_intv, phi_intv,
-                            angle_vector, Fr_or_TMM, n_absorbing_layers, lookuptable, calc_profile, depth_spacing, side)
-                      for i1 in range(len(wavelengths))]
+            n_blocks = np.ones(len(wavelengths), dtype=int)
+
+        tasks = [(i1, None if n_b == 1 else np.where(np.isin(bins, block))[0])
+                 for i1, n_b in enumerate(n_blocks) for block in np.array_split(unique_bins, n_b)]
+        costs = [wl_costs[i1] * (1 if angles is None else len(angles) / n_angles) for i1, angles in tasks]
+
+        if checkpoints is not None:
+            checkpoints = [checkpoints[i1] if n_b == 1 else checkpoints[i1][:-4] + '_{}of{}.pkl'.format(i2 + 1, n_b)
+                           for i1, n_b in enumerate(n_blocks) for i2 in range(n_b)]
+
+        # in parallel, the surfaces, lookup table and other arrays which are the same for all the wavelengths are
+        # written once to a temporary folder and memory-mapped by the workers, rather than pickled for each task
+        with SharedStore(options['parallel'] and options.get('shared_memory', True)) as store:
+            shared_args = [store.share(arg) for arg in
+                           [thetas_in, phis_in, nks, surfaces, lookuptable, first_hit]]
+            thetas_s, phis_s, nks_s, surfaces_s, lookuptable_s, first_hit_s = shared_args
+
+            block_res = run_tasks(RT_wl, [(i1, wavelengths[i1], n_angles, nx, ny, widths, thetas_s, phis_s, h, xs, ys,
+                                           nks_s, surfaces_s, pol, phi_sym, grid,
+                                           Fr_or_TMM, n_absorbing_layers, lookuptable_s, calc_profile, depth_spacing,
+                                           side, ray_packets,
+                                           tmm_lookup.wavelength(wavelengths[i1]) if tmm_lookup else None,
+                                           n_rays_tol, max_batches, decision_sampling, splitting, I_thresh,
+                                           max_depth, first_hit_s, angles)
+                                          for i1, angles in tasks],
+                                  costs, options['parallel'], options['n_jobs'], checkpoints)
+
+        allres = [None] * len(wavelengths)
+        for (i1, _), res in zip(tasks, block_res):
+            allres[i1] = res if allres[i1] is None else [x + y for x, y in zip(allres[i1], res)]
 
         allArrays = stack([item[0] for item in allres])
         absArrays = stack([item[1] for item in allres])
-
-        if save:
-            save_npz(savepath_RT, allArrays)
-            save_npz(savepath_A, absArrays)
+        output = (allArrays, absArrays)
 
         if Fr_or_TMM > 0:
             local_angles = stack([item[2] for item in allres])
@@ -224,138 +298,121 @@ def RT(group, incidence, transmission, surf_name, options, Fr_or_TMM = 0, front_
 
                 if save:
                     allres.to_netcdf(prof_mat_path)
-                    save_npz(savepath_prof, local_angles)
 
-                return allArrays, absArrays, local_angles, profile, intgr
+                output = (allArrays, absArrays, local_angles, profile, intgr)
 
             else:
-                return allArrays, absArrays, local_angles
-
-        else:
-            return allArrays, absArrays
-
-
-def RT_wl(i1, wl, n_angles, nx, ny, widths, thetas_in, phis_in, h, xs, ys, nks, surfaces,
-          pol, phi_sym, theta_intv, phi_intv, angle_vector, Fr_or_TMM, n_abs_layers, lookuptable, calc_profile, depth_spacing, side):
-    print('wavelength = ', wl*1e9)
+                output = (allArrays, absArrays, local_angles)
 
-    theta_out = np.zeros((n_angles, nx * ny))
-    phi_out = np.zeros((n_angles, nx * ny))
-    A_surface_layers = np.zeros((n_angles, nx*ny, n_abs_layers))
-    theta_local_incidence = np.zeros((n_angles, nx*ny))
-
-    for i2 in range(n_angles):
+        # the R/T matrix is saved last, since its existence is used to check whether the calculation is complete
+        if save:
+            save_npz(savepath_A, absArrays)
+            save_npz(savepath_RT, allArrays)
 
-        theta = thetas_in[i2]
-        phi = phis_in[i2]
-        r = abs((h + 1) / cos(theta))
-        r_a_0 = np.real(np.array([r * sin(theta) * cos(phi), r * sin(theta) * sin(phi), r * cos(theta)]))
-        for c, vals in enumerate(product(xs, ys)):
-            I, th_o, phi_o, surface_A = \
-                single_ray_interface(vals[0], vals[1], nks[:, i1],
-                           r_a_0, theta, phi, surfaces, pol, wl, Fr_or_TMM, lookuptable)
+        if checkpoints is not None:
+            shutil.rmtree(checkpoint_folder, ignore_errors=True)
 
-            if th_o < 0: # can do outside loup with np.where
-                th_o = -th_o
-                phi_o = phi_o + np.pi
-            theta_out[i2, c] = th_o
-            phi_out[i2, c] = phi_o
-            A_surface_layers[i2, c] = surface_A[0]
-            theta_local_incidence[i2, c] = np.real(surface_A[1])
+        return output
 
 
-    #phi_out[theta_out < 0] = phi_out + np.pi
-    #theta_out = abs(theta_out) # discards info about phi!
-    phi_out = fold_phi(phi_out, phi_sym)
-    phis_in = fold_phi(phis_in, phi_sym)
-
-    if side == -1:
-        not_absorbed = np.where(theta_out < (np.pi+0.1))
-        thetas_in = np.pi-thetas_in
-        #phis_in = np.pi-phis_in # unsure about this part
+def RT_wl(i1, wl, n_angles, nx, ny, widths, thetas_in, phis_in, h, xs, ys, nks, surfaces,
+          pol, phi_sym, grid, Fr_or_TMM, n_abs_layers, lookuptable, calc_profile, depth_spacing, side,
+          ray_packets=False, tmm_lookup=None, n_rays_tol=None, max_batches=1, decision_sampling='random',
+          splitting=False, I_thresh=0, max_depth=8, first_hit=None, angles=None):
+    # angles: indices of the incidence angles (in thetas_in and phis_in) for which rays are traced; all n_angles if
+    # None. The matrices then only have non-zero columns for the incidence bins of those angles.
+    print('wavelength = ', wl*1e9)
 
-        theta_out[not_absorbed] = np.pi-theta_out[not_absorbed]
-        #phi_out = np.pi-phi_out # unsure about this part
+    if Fr_or_TMM > 0 and tmm_lookup is None:
+        # RT normally passes the lookup table already sliced to this wavelength
+        tmm_lookup = TMMLookupTable(lookuptable).wavelength(wl)
 
-    #phi_out = fold_phi(phi_out, phi_sym)
-    #phis_in = fold_phi(phis_in, phi_sym)
+    thetas_in = thetas_in[:n_angles]
+    phis_in = phis_in[:n_angles]
 
-    #theta_out = abs(theta_out) # discards info about phi!
+    if angles is not None:
+        thetas_in, phis_in = thetas_in[angles], phis_in[angles]
+        if first_hit is not None:
+            rays = (angles[:, None] * nx * ny + np.arange(nx * ny)).flatten()
+            first_hit = tuple(x[rays] for x in first_hit) if isinstance(first_hit, tuple) else \
+                [first_hit[i2] for i2 in rays]
+        n_angles = len(angles)
 
+    n_rays = n_angles * nx * ny
 
+    # if n_rays_tol is set, the set of incidence angles and positions is traced repeatedly until the standard error of
+    # the fraction of rays reflected, transmitted and absorbed in each interface layer is below n_rays_tol
+    stats = RunningStats(2 + n_abs_layers)
+    batches = []
 
-    theta_local_incidence = np.abs(theta_local_incidence)
-    n_thetas = len(theta_intv) - 1
+    for i2 in range(max_batches):
+        theta_out, phi_out, weight, ray, events = \
+            interface_rays(i1, wl, n_angles, nx, ny, thetas_in, phis_in, h, xs, ys, nks, surfaces, pol, Fr_or_TMM,
+                           n_abs_layers, ray_packets, tmm_lookup, decision_sampling, splitting, I_thresh, max_depth,
+                           first_hit)
 
-    if Fr_or_TMM > 0:
-        # now we need to make bins for the absorption
-        theta_intv = np.append(theta_intv, 11)
-        phi_intv = phi_intv + [np.array([0])]
+        e_ray, e_theta, e_weight, e_A = events
+        stats.update(np.column_stack([np.bincount(ray, weight*(theta_out < np.pi/2), minlength=n_rays),
+                                      np.bincount(ray, weight*(theta_out > np.pi/2), minlength=n_rays)] +
+                                     [np.bincount(e_ray, e_weight*e_A[:, i3], minlength=n_rays)
+                                      for i3 in range(n_abs_layers)]))
 
-    # xarray: can use coordinates in calculations using apply!
-    binned_theta_in = np.digitize(thetas_in, theta_intv, right=True) - 1
+        # index the rays from all the batches together
+        batches.append((theta_out, phi_out, weight, ray + i2*n_rays, e_ray + i2*n_rays, e_theta, e_weight, e_A))
 
-    binned_theta_out = np.digitize(theta_out, theta_intv, right=True) - 1
-    #print(binned_theta_out, theta_out, theta_intv)
+        if n_rays_tol is None or stats.converged(n_rays_tol):
+            break
 
+    if n_rays_tol is not None:
+        print('rays traced:', stats.n, ', max. standard error:', np.max(stats.std_error()))
 
-    #print(binned_theta_in)
-    #print(binned_theta_out)
-    # -1 to give the correct index for the bins in phi_intv
+    theta_out, phi_out, weight, ray, e_ray, e_theta, e_weight, e_A = [np.concatenate(x) for x in zip(*batches)]
+    thetas_in = np.tile(thetas_in, len(batches))
+    phis_in = np.tile(phis_in, len(batches))
 
-    phi_in = xr.DataArray(phis_in,
-                          coords={'theta_bin': (['angle_in'], binned_theta_in)},
-                          dims=['angle_in'])
+    #phi_out[theta_out < 0] = phi_out + np.pi
+    #theta_out = abs(theta_out) # discards info about phi!
+    phi_out = fold_phi_surfaces(phi_out, surfaces, phi_sym)
 
-    bin_in = phi_in.groupby('theta_bin').apply(overall_bin,
-                                               args=(phi_intv, angle_vector[:, 0])).data
+    if side == -1:
+        theta_out = np.pi-theta_out
+        #phi_out = np.pi-phi_out # unsure about this part
 
-    phi_out = xr.DataArray(phi_out,
-                           coords={'theta_bin': (['angle_in', 'position'], binned_theta_out)},
-                           dims=['angle_in', 'position'])
+    angle_vector = grid.angle_vector
+    n_thetas = len(grid.theta_intv) - 1
+    n_a_in = grid.n_a_in
 
-    bin_out = phi_out.groupby('theta_bin').apply(overall_bin,
-                                                 args=(phi_intv, angle_vector[:, 0])).data
+    bin_in = incidence_bins(thetas_in, phis_in, grid, surfaces, phi_sym, side)
+    bin_in = np.repeat(bin_in, nx * ny)
 
+    # theta_out, phi_out and weight are for the rays (or branches) leaving the surface; absorption in the surface
+    # layers is described by the absorption events (e_ray, e_theta, e_weight, e_A)
+    bin_out = grid.angle_bin(theta_out, phi_out)
 
-    out_mat = np.zeros((len(angle_vector), int(len(angle_vector) / 2)))
-    # everything is coming in from above so we don't need 90 -> 180 in incoming bins
-    A_mat = np.zeros((n_abs_layers, int(len(angle_vector)/2)))
+    n_rays_in_bin = np.bincount(bin_in, minlength=n_a_in)
+    out_mat = accumulate_bins(bin_out, bin_in[ray], grid.n_bins, n_a_in, weight)
 
-    n_rays_in_bin = np.zeros(int(len(angle_vector) / 2))
-    n_rays_in_bin_abs = np.zeros(int(len(angle_vector) / 2))
+    e_bin = bin_in[e_ray]
+    n_rays_in_bin_abs = np.bincount(e_bin, e_weight, minlength=n_a_in)
+    A_mat = np.array([np.bincount(e_bin, e_weight*e_A[:, i3], minlength=n_a_in)
+                      for i3 in range(n_abs_layers)]).reshape((n_abs_layers, n_a_in))
 
-    binned_local_angles = np.digitize(theta_local_incidence, theta_intv, right=True) - 1
-    local_angle_mat = np.zeros((int((len(theta_intv) -1 )/ 2), int(len(angle_vector) / 2)))
+    binned_local_angles = grid.theta_bin(np.abs(e_theta))
+    local_angle_mat = accumulate_bins(binned_local_angles, e_bin, int(n_thetas / 2), n_a_in, e_weight)
 
-    if side == 1:
-        offset = 0
+    # without splitting, each absorption event absorbs the whole ray; with splitting, the absorbed intensity is the
+    # weight times the total absorption in the surface layers
+    if splitting:
+        abs_total = np.sum(A_mat, 0)
     else:
-        offset = int(len(angle_vector) / 2)
-
-    for l1 in range(len(thetas_in)):
-        for l2 in range(nx * ny):
-            n_rays_in_bin[bin_in[l1]-offset] += 1
-            if binned_theta_out[l1, l2] <= (n_thetas-1):
-                # reflected or transmitted
-                out_mat[bin_out[l1, l2], bin_in[l1]-offset] += 1
-                #print('RT bin in-offset', bin_in[l1]-offset)
-                #print(thetas_in[l1], binned_theta_out[l1, l2])
-
-            else:
-                # absorbed in one of the surface layers
-                n_rays_in_bin_abs[bin_in[l1]-offset] += 1
-                #print('A bin in', bin_in[l1]-offset, l1, l2)
-                per_layer = A_surface_layers[l1, l2]
-                A_mat[:, bin_in[l1]-offset] += per_layer
-                local_angle_mat[binned_local_angles[l1, l2], bin_in[l1]-offset] += 1
+        abs_total = n_rays_in_bin_abs
 
     # normalize
-    out_mat = np.divide(out_mat, n_rays_in_bin, where=n_rays_in_bin!=0)
-    overall_abs_frac = np.divide(n_rays_in_bin_abs, n_rays_in_bin, where=n_rays_in_bin!=0)
-    abs_scale = np.divide(overall_abs_frac, np.sum(A_mat, 0), where=np.sum(A_mat, 0)!=0)
+    out_mat = np.divide(out_mat, n_rays_in_bin, out=np.zeros_like(out_mat), where=n_rays_in_bin!=0)
+    overall_abs_frac = np.divide(abs_total, n_rays_in_bin, out=np.zeros(n_a_in), where=n_rays_in_bin!=0)
+    abs_scale = np.divide(overall_abs_frac, np.sum(A_mat, 0), out=np.zeros(n_a_in), where=np.sum(A_mat, 0)!=0)
     #print('A_mat', np.sum(A_mat, 0)/n_rays_in_bin_abs)
-    intgr = np.divide(np.sum(A_mat, 0), n_rays_in_bin_abs, where=n_rays_in_bin_abs!=0)
+    intgr = np.divide(np.sum(A_mat, 0), n_rays_in_bin_abs, out=np.zeros(n_a_in), where=n_rays_in_bin_abs!=0)
     A_mat = abs_scale*A_mat
     out_mat[np.isnan(out_mat)] = 0
     A_mat[np.isnan(A_mat)] = 0
@@ -364,14 +421,15 @@ def RT_wl(i1, wl, n_angles, nx, ny, widths, thetas_in, phis_in, h, xs, ys, nks,
     A_mat = COO(A_mat)
 
     if Fr_or_TMM > 0:
-        local_angle_mat = np.divide(local_angle_mat, np.sum(local_angle_mat, 0), where=np.sum(local_angle_mat, 0)!=0)
+        local_angle_mat = np.divide(local_angle_mat, np.sum(local_angle_mat, 0), out=np.zeros_like(local_angle_mat),
+                                    where=np.sum(local_angle_mat, 0)!=0)
         local_angle_mat[np.isnan(local_angle_mat)] = 0
         local_angle_mat = COO(local_angle_mat)
 
         #print(calc_profile)
 
         if calc_profile is not None:
-            n_a_in = int(len(angle_vector)/2)
+            n_a_in = grid.n_a_in
             thetas = angle_vector[:n_a_in, 1]
             unique_thetas = np.unique(thetas)
 
@@ -389,6 +447,123 @@ def RT_wl(i1, wl, n_angles, nx, ny, widths, thetas_in, phis_in, h, xs, ys, nks,
     else:
         return out_mat, A_mat
 
+def fold_phi_surfaces(phis, surfaces, phi_sym):
+    # folds the azimuthal angles into the symmetry element 0 to phi_sym of the angle grid. Textures which are
+    # invariant along one axis are not symmetric under rotations by pi/2, only under mirror reflections, which are
+    # used for phi_sym = pi/2; for other values of phi_sym, the angles are folded as for other textures (this assumes
+    # a higher symmetry than the texture has if phi_sym < pi/2, see RT)
+    if np.isclose(phi_sym, np.pi/2) and any(surf.invariant_axis is not None for surf in surfaces):
+        return fold_phi_mirror(phis)
+
+    return fold_phi(phis, phi_sym)
+
+
+def incidence_bins(thetas_in, phis_in, grid, surfaces, phi_sym, side):
+    # index of the incidence bin (column of the redistribution matrices) of each incidence angle
+    phis_in = fold_phi_surfaces(phis_in, surfaces, phi_sym)
+
+    if side == 1:
+        offset = 0
+    else:
+        thetas_in = np.pi-thetas_in
+        #phis_in = np.pi-phis_in # unsure about this part
+        offset = grid.n_a_in
+
+    # everything is coming in from above so we don't need 90 -> 180 in incoming bins
+    return grid.angle_bin(thetas_in, phis_in) - offset
+
+
+def interface_rays(i1, wl, n_angles, nx, ny, thetas_in, phis_in, h, xs, ys, nks, surfaces, pol, Fr_or_TMM,
+                   n_abs_layers, ray_packets, tmm_lookup, decision_sampling='random', splitting=False, I_thresh=0,
+                   max_depth=8, first_hit=None):
+    # traces rays for each of the n_angles incidence angles from each of the nx*ny positions. Returns the outgoing
+    # theta, phi and weight of the rays (or branches, if splitting) leaving the surface, the index
+    # (angle index * nx * ny + position index) of the ray each one comes from, and the absorption events in the
+    # surface layers as (ray index, local incidence angle, weight, absorption per layer per unit weight).
+    # first_hit is the first intersection of the rays with the surface, from interface_first_hits.
+    n_rays = n_angles * nx * ny
+
+    if ray_packets or splitting:
+        # trace the rays for all the incidence angles and positions together
+        xys = np.array(list(product(xs, ys)))
+        r_a_0s = launch_offsets(thetas_in[:n_angles], phis_in[:n_angles], h, nx*ny)
+
+        if splitting:
+            theta_out, phi_out, weight, ray, events = \
+                ray_packet_interface_split(np.tile(xys[:, 0], n_angles), np.tile(xys[:, 1], n_angles), nks[:, i1],
+                                           r_a_0s, surfaces, pol, wl, Fr_or_TMM, tmm_lookup, I_thresh, max_depth,
+                                           decision_sampling, first_hit)
+            left = weight > 0
+
+            return theta_out[left], phi_out[left], weight[left], ray[left], events
+
+        theta_out, phi_out, A_surface_layers, theta_local_incidence = \
+            ray_packet_interface(np.tile(xys[:, 0], n_angles), np.tile(xys[:, 1], n_angles), nks[:, i1],
+                                 r_a_0s, surfaces, pol, wl, Fr_or_TMM, tmm_lookup, decision_sampling, first_hit)
+
+    else:
+        theta_out = np.zeros(n_rays)
+        phi_out = np.zeros(n_rays)
+        A_surface_layers = np.zeros((n_rays, n_abs_layers))
+        theta_local_incidence = np.zeros(n_rays)
+
+        for i2 in range(n_angles):
+
+            theta = thetas_in[i2]
+            phi = phis_in[i2]
+            r_a_0 = launch_offset(theta, phi, h)
+            for c, vals in enumerate(product(xs, ys)):
+                I, th_o, phi_o, surface_A = \
+                    single_ray_interface(vals[0], vals[1], nks[:, i1],
+                               r_a_0, theta, phi, surfaces, pol, wl, Fr_or_TMM, tmm_lookup,
+                               None if first_hit is None else first_hit[i2*nx*ny + c])
+
+                if th_o < 0: # can do outside loup with np.where
+                    th_o = -th_o
+                    phi_o = phi_o + np.pi
+                theta_out[i2*nx*ny + c] = th_o
+                phi_out[i2*nx*ny + c] = phi_o
+                A_surface_layers[i2*nx*ny + c] = surface_A[0]
+                theta_local_incidence[i2*nx*ny + c] = np.real(surface_A[1])
+
+    # rays with theta_out outside the angle bins were absorbed in one of the surface layers
+    absorbed = theta_out > np.pi
+    ray = np.arange(n_rays)
+    events = (ray[absorbed], theta_local_incidence[absorbed], np.ones(np.sum(absorbed)), A_surface_layers[absorbed])
+
+    return theta_out[~absorbed], phi_out[~absorbed], np.ones(np.sum(~absorbed)), ray[~absorbed], events
+
+
+def interface_first_hits(n_angles, thetas_in, phis_in, h, xs, ys, surf, ray_packets):
+    # first intersection of the rays traced by interface_rays with the surface, in the same order as the rays. This
+    # does not depend on the wavelength, so it is calculated once and passed to interface_rays for each wavelength.
+    # If ray_packets, this is (t, ind) for all the rays together (see first_intersection_packet), otherwise a list
+    # with the result of first_intersection for each ray.
+    if ray_packets:
+        xys = np.array(list(product(xs, ys)))
+        r_a_0s = launch_offsets(thetas_in[:n_angles], phis_in[:n_angles], h, len(xys))
+        return first_intersection_packet(np.tile(xys[:, 0], n_angles), np.tile(xys[:, 1], n_angles), r_a_0s, surf)
+
+    return [first_intersection(x, y, launch_offset(thetas_in[i2], phis_in[i2], h), surf)
+            for i2 in range(n_angles) for x, y in product(xs, ys)]
+
+
+def launch_offset(theta, phi, h):
+    # vector which, added to the launch position (x, y, 0), gives the starting point of a ray with incidence angles
+    # theta and phi, above a surface with maximum height h
+    r = abs((h + 1) / cos(theta))
+    return np.real(np.array([r * sin(theta) * cos(phi), r * sin(theta) * sin(phi), r * cos(theta)]))
+
+
+def launch_offsets(thetas, phis, h, n_pos):
+    # same as launch_offset for each incidence angle, repeated for the n_pos launch positions
+    thetas_rays = np.repeat(thetas, n_pos)
+    phis_rays = np.repeat(phis, n_pos)
+    r = np.abs((h + 1) / np.cos(thetas_rays))
+    return np.column_stack((r * np.sin(thetas_rays) * np.cos(phis_rays),
+                            r * np.sin(thetas_rays) * np.sin(phis_rays), r * np.cos(thetas_rays)))
+
+
 class rt_structure:
     def __init__(self, textures, materials, widths, incidence, transmission):
 
@@ -409,21 +584,63 @@ class rt_structure:
         surfaces = []
 
         for i1, text in enumerate(surfs_no_offset):
-            points_loop = deepcopy(text.Points)
-            points_loop[:, 2] = points_loop[:, 2] - cum_width[i1]
-            surfaces.append(RTSurface(points_loop))
+            surfaces.append(text.offset(-cum_width[i1]))
 
         self.surfaces = surfaces
         self.surfs_no_offset= surfs_no_offset
         self.cum_width = cum_width
 
+        # (wavelengths, cost per ray) measured in the last calculation, used to schedule the next one
+        self.costs = None
+
+    def wavelength_costs(self, wavelengths, nks, alphas, widths):
+        """Relative cost of tracing a ray at each wavelength: interpolated from the costs measured in the last
+        calculation with this structure (the mean number of interactions with the surfaces per ray), if there was
+        one, otherwise estimated from the absorption in the stack (see rayflare.scheduling.ray_tracing_cost)."""
+        if self.costs is not None:
+            return np.interp(wavelengths, *self.costs)
+
+        return ray_tracing_cost(nks, alphas, widths)
+
     def calculate(self, options):
+        """Calculates the reflection, transmission and absorption (in each layer and as a function of depth) of the
+        structure at all the wavelengths in options, by ray-tracing.
+
+        :param options: user options
+
+        :return: dictionary with the results, with arrays indexed by wavelength (the per-ray results are padded with \
+        NaN or zero if a different number of rays was traced at each wavelength)
+        """
+        results = [None] * len(options['wavelengths'])
+
+        for i1, result in self.calculate_iter(options):
+            results[i1] = result
+
+        output = {key: np.array([result[key] for result in results]) for key in results[0]
+                  if key not in ['thetas', 'phis', 'n_passes', 'n_interactions']}
+        output['thetas'] = pad_stack([result['thetas'] for result in results], np.nan)
+        output['phis'] = pad_stack([result['phis'] for result in results], np.nan)
+        output['n_passes'] = pad_stack([result['n_passes'] for result in results], 0)
+        output['n_interactions'] = pad_stack([result['n_interactions'] for result in results], 0)
+
+        return output
+
+    def calculate_iter(self, options):
+        """Generator version of calculate: yields (index, result) for each wavelength as soon as the rays for that
+        wavelength (or band of wavelengths, with hero-wavelength tracing) have been traced, in the order in which the
+        calculations finish when options.parallel is True. index is the index of the wavelength in
+        options.wavelengths, and result is a dictionary with the same keys as the output of calculate, for that
+        wavelength. Closing the generator early (e.g. breaking out of a loop over it) cancels the calculations which
+        have not been started yet.
+
+        :param options: user options
+        """
         wavelengths = options['wavelengths']
         theta = options['theta_in']
         phi = options['phi_in']
         I_thresh = options['I_thresh']
     
-        widths = self.widths
+        widths = deepcopy(self.widths)
         widths.insert(0, 0)
         widths.append(0)
         widths = 1e6*np.array(widths)  # convert to um
@@ -447,8 +664,7 @@ class rt_structure:
             alphas[i1] = mat.k(wavelengths)*4*np.pi/(wavelengths*1e6)
     
         h = max(surfaces[0].Points[:, 2])
-        r = abs((h + 1) / cos(theta))
-        r_a_0 = np.real(np.array([r * sin(theta) * cos(phi), r * sin(theta) * sin(phi), r * cos(theta)]))
+        r_a_0 = launch_offset(theta, phi, h)
     
         x_lim = surfaces[0].Lx
         y_lim = surfaces[0].Ly
@@ -457,8 +673,8 @@ class rt_structure:
         ny = options['ny']
 
         if options['random_ray_position']:
-            xs = np.random.uniform(0, x_lim, nx)
-            ys = np.random.uniform(0, y_lim, ny)
+            xs = x_lim*sample_points(nx, 1, options.get('ray_sequence', 'random'))[:, 0]
+            ys = y_lim*sample_points(ny, 1, options.get('ray_sequence', 'random'))[:, 0]
 
         else:
 
@@ -473,117 +689,297 @@ class rt_structure:
         # need to calculate r_a and r_b
         # a total of n_rays will be traced; this is divided by the number of x and y points to scan so we know
         # how many times we need to repeat
-        n_reps = np.int(np.ceil(options['n_rays']/(nx*ny)))
+        n_reps = int(np.ceil(options['n_rays']/(nx*ny)))
         # print('n_reps', n_reps)
 
-        # thetas and phis divided into
-        thetas = np.zeros((n_reps*nx*ny, len(wavelengths)))
-        phis = np.zeros((n_reps*nx*ny, len(wavelengths)))
-        n_passes = np.zeros((n_reps*nx*ny, len(wavelengths)))
+        # if n_rays_tol is set, batches of n_rays rays are traced until the standard error of R, T and the
+        # absorption in each layer is below n_rays_tol, up to a total of n_rays_max rays per wavelength
+        n_rays_tol = options.get('n_rays_tol', None)
+        if n_rays_tol is not None:
+            max_batches = max(1, int(np.ceil(options.get('n_rays_max', options['n_rays']) / (n_reps*nx*ny))))
+        else:
+            max_batches = 1
 
-        Is = np.zeros((n_reps*nx*ny, len(wavelengths)))
-    
         pol = options['pol']
         randomize = options['randomize_surface']
+        decision_sampling = options.get('decision_sampling', 'random')
+        splitting = options.get('ray_splitting', False)
+        max_depth = options.get('splitting_max_depth', 8)
+        roulette = options.get('roulette_survival', 0.1) if options.get('russian_roulette', False) else 0
+
+        if splitting and not options.get('ray_packets', False):
+            warn('Ray splitting is only implemented for the ray packet tracer, which will be used.')
+
+        # with hero-wavelength tracing, each band of wavelengths with similar refractive indices is traced with the
+        # same rays; otherwise, each wavelength is traced separately
+        hero_wavelength = options.get('hero_wavelength', False)
+        if hero_wavelength and (splitting or not options.get('ray_packets', False)):
+            warn('Hero-wavelength tracing is only implemented for the ray packet tracer without ray splitting. '
+                 'The wavelengths will be traced separately.')
+            hero_wavelength = False
+
+        if hero_wavelength:
+            wl_groups = spectral_bands(nks, options.get('hero_n_tol', 0.01), options.get('hero_max_band', 20))
+        else:
+            wl_groups = range(len(wavelengths))
+
+        # the first intersection of the rays launched from each position with the first surface does not depend on
+        # the wavelength, so it is only calculated once and shared by all the wavelengths
+        if options.get('ray_packets', False) or splitting:
+            inner = packet_inner
+            xys = np.array(list(product(xs, ys)))
+            first_hit = first_intersection_packet(xys[:, 0], xys[:, 1], r_a_0, surfaces[0])
+        elif options.get('jit_kernel', False) and jit_kernel.jit_available and jit_kernel.jit_supported(surfaces):
+            # the compiled kernel calculates the first intersections itself
+            inner = jit_inner
+            first_hit = None
+        else:
+            if options.get('jit_kernel', False):
+                warn('The compiled ray-tracing kernel is not available (numba is not installed, or one of the '
+                     'surfaces is invariant along one axis). The rays will be traced in Python.')
+            inner = parallel_inner
+            first_hit = [first_intersection(x, y, r_a_0, surfaces[0]) for x, y in product(xs, ys)]
+
+        # in parallel, the rays for each wavelength (or band) are split into blocks of repetitions of the grid of
+        # positions, so that the blocks have similar costs, and the most expensive blocks are traced first (see
+        # rayflare.scheduling). This is not possible with n_rays_tol, where the rays are traced until convergence.
+        wl_costs = self.wavelength_costs(wavelengths, nks, alphas, widths)
+        group_costs = [np.sum(wl_costs[i1]) for i1 in wl_groups]
+
+        if options['parallel'] and options.get('load_balancing', True) and n_rays_tol is None:
+            n_blocks = ray_blocks(group_costs, n_reps, options['n_jobs'])
+        else:
+            n_blocks = np.ones(len(group_costs), dtype=int)
 
-        if not options['parallel']:
-            for j1 in range(n_reps):
+        tasks = [(i1, len(reps)) for i1, n_b in enumerate(n_blocks) for reps in np.array_split(np.arange(n_reps), n_b)]
 
-                offset = j1*nx*ny
-                for c, vals in enumerate(product(xs, ys)):
+        block_index = [i2 for n_b in n_blocks for i2 in range(n_b)]
+        blocks = [[None] * n_b for n_b in n_blocks]
+        costs = np.zeros(len(wavelengths))
 
-                    for i1, wl in enumerate(wavelengths):
-                        #print(wl)
-                        I, profile, A_per_layer, th_o, phi_o, n_pass, n_interact = single_ray_stack(vals[0], vals[1], nks[:, i1],
-                                                                                          alphas[:, i1], r_a_0,
-                                                                                          surfaces, widths, z_pos, I_thresh, pol, randomize)
-                        absorption_profiles[i1] = absorption_profiles[i1] + profile/(n_reps*nx*ny)
-                        thetas[c+offset, i1] = th_o
-                        phis[c+offset, i1] = phi_o
-                        A_layer[i1] = A_layer[i1] + A_per_layer/(n_reps*nx*ny)
-                        n_passes[c+offset, i1] = n_pass
-                        if th_o is not None:
-                            if np.real(th_o) < np.pi/2:
-                                R[i1] = np.real(R[i1] + I/(n_reps*nx*ny))
-                            else:
-                                T[i1] = np.real(T[i1] + I/(n_reps*nx*ny))
+        # the surfaces and first intersections are published once for all the tasks (see RT)
+        with SharedStore(options['parallel'] and options.get('shared_memory', True)) as store:
+            surfaces_s, first_hit_s = store.share(surfaces), store.share(first_hit)
 
-            return {'R': R, 'T': T, 'A_per_layer': A_layer[:, 1:-1], 'profile': absorption_profiles/1e3,
-                    'thetas': thetas, 'phis': phis, 'n_passes': n_passes}
+            for i_task, res in iter_tasks(converged_inner,
+                                          [(inner, nks[:, wl_groups[i1]], alphas[:, wl_groups[i1]], r_a_0, theta, phi,
+                                            surfaces_s, widths, z_pos, I_thresh, pol, nx, ny, reps, xs, ys, randomize,
+                                            n_rays_tol, max_batches, decision_sampling, splitting, max_depth, roulette,
+                                            first_hit_s) for i1, reps in tasks],
+                                          [group_costs[i1]*reps/n_reps for i1, reps in tasks], options['parallel'],
+                                          options['n_jobs']):
 
+                i1 = tasks[i_task][0]
+                blocks[i1][block_index[i_task]] = res
 
-        else:
+                # the results for a wavelength (or band) are complete when all its blocks have been traced
+                if any(block is None for block in blocks[i1]):
+                    continue
+
+                res = merge_blocks(blocks[i1])
+                blocks[i1] = None
+
+                for i_wl, item in zip(np.atleast_1d(wl_groups[i1]), res if hero_wavelength else [res]):
+                    costs[i_wl] = np.sum(item[5])/item[0].n
+                    yield i_wl, wavelength_result(item)
 
-            allres = Parallel(n_jobs=-1)(delayed(parallel_inner)(nks[:, i1], alphas[:, i1], r_a_0, theta, phi,
-                                                                  surfaces, widths, z_pos, I_thresh, pol, nx, ny, n_reps, xs, ys, randomize) for
-                                        i1 in range(len(wavelengths)))
+        order = np.argsort(wavelengths)
+        self.costs = (wavelengths[order], costs[order])
 
-            I = np.stack(item[0] for item in allres)
-            absorption_profiles = np.stack([item[1] for item in allres])
-            A_layer = np.stack([item[2] for item in allres])
-            thetas = np.stack([item[3] for item in allres])
-            phis = np.stack([item[4] for item in allres])
-            n_passes = np.stack([item[5] for item in allres])
-            n_interactions = np.stack([item[6] for item in allres])
 
+def wavelength_result(item):
+    """Dictionary with the results at one wavelength (see rt_structure.calculate), from the output of
+    converged_inner."""
+    stat, profile, thetas, phis, n_passes, n_interactions = item
+    std_error = stat.std_error()
 
+    # columns of mean and std_error: R, T, R0, absorption in each medium (including incidence and transmission)
+    return {'R': stat.mean[0], 'T': stat.mean[1], 'A_per_layer': stat.mean[4:-1], 'profile': profile/1e3,
+            'thetas': thetas, 'phis': phis, 'R0': stat.mean[2], 'n_passes': n_passes, 'n_interactions': n_interactions,
+            'R_err': std_error[0], 'T_err': std_error[1], 'A_per_layer_err': std_error[4:-1], 'n_rays': stat.n}
 
-            non_abs = ~np.isnan(thetas)
 
-            refl = np.logical_and(non_abs, np.less(np.real(thetas), np.pi / 2, where=~np.isnan(thetas)))
-            trns = np.logical_and(non_abs, np.greater(np.real(thetas), np.pi / 2, where=~np.isnan(thetas)))
+def merge_blocks(results):
+    """Combines the results of converged_inner for blocks of rays traced separately at the same wavelength(s), in
+    order, as if all the rays had been traced together."""
+    if len(results) == 1:
+        return results[0]
 
-            R = np.real(I * refl).T / (n_reps*nx * ny)
-            T = np.real(I * trns).T / (n_reps*nx * ny)
-            R = np.sum(R, 0)
-            T = np.sum(T, 0)
+    if isinstance(results[0], list):
+        # hero-wavelength tracing: results for each wavelength in the band
+        return [merge_blocks(list(x)) for x in zip(*results)]
 
-            refl_0 = non_abs * np.less(np.real(thetas), np.pi / 2, where=~np.isnan(thetas)) * (n_passes == 1)
-            R0 = np.real(I * refl_0).T / (n_reps * nx * ny)
-            R0 = np.sum(R0, 0)
+    stats = RunningStats(len(results[0][0].mean))
+    for res in results:
+        stats.merge(res[0])
 
-            return {'R': R, 'T': T, 'A_per_layer': A_layer[:, 1:-1], 'profile': absorption_profiles/1e3,
-                    'thetas': thetas, 'phis': phis, 'R0': R0, 'n_passes': n_passes, 'n_interactions': n_interactions}
+    # the profiles are normalized by the number of rays in each block
+    profile = np.sum([res[1]*res[0].n for res in results], axis=0)/stats.n
+    thetas, phis, n_passes, n_interactions = [np.concatenate(x) for x in zip(*[res[2:] for res in results])]
 
+    return stats, profile, thetas, phis, n_passes, n_interactions
 
-def parallel_inner(nks, alphas, r_a_0, theta, phi, surfaces, widths, z_pos, I_thresh, pol, nx, ny, n_reps, xs, ys, randomize):
-    #print(widths)
-    # thetas and phis divided into
+
+def spectral_bands(nks, n_tol, max_band):
+    """Splits the wavelengths into bands of consecutive wavelengths which can be traced together (hero-wavelength
+    tracing): in each band, the real part of the refractive index of each medium varies by at most n_tol. Since all
+    the wavelengths of a band follow the ray paths of the hero wavelength, this is an approximation (see
+    ray_packet_stack) which can fail even for small n_tol where the paths depend sharply on the refractive index.
+
+    :param nks: complex refractive indices, shape (n_media, n_wavelengths)
+    :param n_tol: maximum variation of the real part of the refractive indices in a band
+    :param max_band: maximum number of wavelengths in a band
+
+    :return: list of arrays with the indices of the wavelengths in each band
+    """
+    n = np.real(nks)
+    bands = []
+    start = 0
+
+    for i1 in range(1, n.shape[1] + 1):
+        in_band = n[:, start:i1 + 1]
+        if i1 == n.shape[1] or i1 - start == max_band or \
+                np.any(np.max(in_band, axis=1) - np.min(in_band, axis=1) > n_tol):
+            bands.append(np.arange(start, i1))
+            start = i1
+
+    return bands
+
+
+def pad_stack(arrays, fill):
+    length = max(len(x) for x in arrays)
+    return np.stack([np.concatenate((x, np.full(length - len(x), fill))) for x in arrays])
+
+
+def converged_inner(inner, nks, alphas, r_a_0, theta, phi, surfaces, widths, z_pos, I_thresh, pol, nx, ny, n_reps, xs,
+                    ys, randomize, n_rays_tol=None, max_batches=1, decision_sampling='random', splitting=False,
+                    max_depth=8, roulette=0, first_hit=None):
+    """Traces batches of n_reps*nx*ny rays at a single wavelength with inner (packet_inner or parallel_inner), keeping
+    running means and standard errors of R, T, R0 (reflection after a single pass) and the absorption in each medium.
+    Tracing stops when the standard errors of R, T and the absorption are all below n_rays_tol, or max_batches batches
+    have been traced. If n_rays_tol is None, a single batch is traced. With splitting, the statistics are for the
+    launched rays (summing over their branches). first_hit is the first intersection of the rays launched from each
+    position with the first surface (see packet_inner and parallel_inner), which is the same for all the batches.
+
+    If nks and alphas have shape (n_media, n_wavelengths), the wavelengths are traced together (hero-wavelength
+    tracing, see ray_packet_stack), until the results at all the wavelengths have converged. A list with the results
+    for each wavelength is then returned.
+
+    :return: stats: RunningStats with columns R, T, R0, absorption in each medium \
+    profile: absorption profile per ray \
+    thetas, phis, n_passes, n_interactions: per-ray (or per-branch) results for all the rays traced
+    """
+    band = np.ndim(nks) == 2
+    n_wl = nks.shape[1] if band else 1
+    tallies = [ProfileTally(widths) for _ in range(n_wl)]
+    stats = [RunningStats(len(widths) + 3) for _ in range(n_wl)]
+    batches = []
+
+    for i1 in range(max_batches):
+        Is, A_per_ray, thetas, phis, n_passes, n_interactions, origin = inner(nks, alphas, r_a_0, theta, phi, surfaces,
+                                                                             widths, z_pos, I_thresh, pol, nx, ny,
+                                                                             n_reps, xs, ys, randomize,
+                                                                             tallies if band else tallies[0],
+                                                                             decision_sampling, splitting, max_depth,
+                                                                             roulette, first_hit)
+
+        non_abs = ~np.isnan(thetas)
+        refl = np.logical_and(non_abs, np.less(np.real(thetas), np.pi / 2, where=non_abs))
+        trns = np.logical_and(non_abs, np.greater(np.real(thetas), np.pi / 2, where=non_abs))
+
+        n_rays = len(A_per_ray)
+        Is = np.reshape(Is, (len(Is), n_wl))
+        A_per_ray = np.reshape(A_per_ray, (n_rays, len(widths), n_wl))
+
+        for i2, stat in enumerate(stats):
+            stat.update(np.column_stack((np.bincount(origin, Is[:, i2] * refl, minlength=n_rays),
+                                         np.bincount(origin, Is[:, i2] * trns, minlength=n_rays),
+                                         np.bincount(origin, Is[:, i2] * refl * (n_passes == 1), minlength=n_rays),
+                                         A_per_ray[:, :, i2])))
+        batches.append((thetas, phis, n_passes, n_interactions))
+
+        # the R0 column is not used to decide convergence
+        if n_rays_tol is None or all(stat.converged(n_rays_tol, np.r_[0, 1, 3:len(widths) + 3]) for stat in stats):
+            break
+
+    # the absorption profile is only evaluated once, for all the rays
+    profiles = [tally.profile(z_pos)/stat.n for tally, stat in zip(tallies, stats)]
+
+    thetas, phis, n_passes, n_interactions = [np.concatenate(x) for x in zip(*batches)]
+
+    if band:
+        return [(stat, profile, thetas, phis, n_passes, n_interactions) for stat, profile in zip(stats, profiles)]
+
+    return stats[0], profiles[0], thetas, phis, n_passes, n_interactions
+
+
+def packet_inner(nks, alphas, r_a_0, theta, phi, surfaces, widths, z_pos, I_thresh, pol, nx, ny, n_reps, xs, ys,
+                 randomize, tally, decision_sampling='random', splitting=False, max_depth=8, roulette=0,
+                 first_hit=None):
+    # same inputs and outputs as parallel_inner, but all the rays are traced together by ray_packet_stack. With
+    # splitting, the per-ray results are for each branch. first_hit is (t, ind) from first_intersection_packet for
+    # the nx*ny positions.
+    xys = np.array(list(product(xs, ys)))
+    if first_hit is not None:
+        first_hit = tuple(np.tile(x, n_reps) for x in first_hit)
+
+    Is, _, A_per_ray, thetas, phis, n_passes, n_interactions, origin = \
+        ray_packet_stack(np.tile(xys[:, 0], n_reps), np.tile(xys[:, 1], n_reps), nks, alphas, r_a_0,
+                         surfaces, widths, z_pos, I_thresh, pol, randomize, tally, decision_sampling, splitting,
+                         max_depth, roulette, first_hit)
+
+    return np.real(Is), A_per_ray, thetas, phis, n_passes, n_interactions, origin
+
+
+def jit_inner(nks, alphas, r_a_0, theta, phi, surfaces, widths, z_pos, I_thresh, pol, nx, ny, n_reps, xs, ys,
+              randomize, tally, decision_sampling='random', splitting=False, max_depth=8, roulette=0, first_hit=None):
+    # same inputs and outputs as parallel_inner, but the rays are traced by the compiled kernel in jit_kernel.py
+    xys = np.array(list(product(xs, ys)))
+    Is, A_per_ray, thetas, phis, n_passes, n_interactions = \
+        jit_kernel.trace_rays_jit(np.tile(xys[:, 0], n_reps), np.tile(xys[:, 1], n_reps), nks, alphas, r_a_0,
+                                  surfaces, widths, I_thresh, pol, randomize, tally, roulette)
+
+    return Is, A_per_ray, thetas, phis, n_passes, n_interactions, np.arange(n_reps*nx*ny)
+
+
+def parallel_inner(nks, alphas, r_a_0, theta, phi, surfaces, widths, z_pos, I_thresh, pol, nx, ny, n_reps, xs, ys,
+                   randomize, tally, decision_sampling='random', splitting=False, max_depth=8, roulette=0,
+                   first_hit=None):
+    # traces n_reps*nx*ny rays one at a time; the passes through the layers are added to tally. Returns the
+    # final intensity, absorption per layer, final theta and phi and number of passes and interactions of each ray,
+    # and the index of each ray. decision_sampling, splitting and max_depth are not used: the rays are traced
+    # independently, so the decisions cannot be stratified and rays are not split. first_hit is a list with the
+    # result of first_intersection for each of the nx*ny positions.
     thetas = np.zeros(n_reps * nx * ny)
     phis = np.zeros(n_reps * nx * ny)
     n_passes = np.zeros(n_reps * nx * ny)
     n_interactions = np.zeros(n_reps * nx * ny)
-    absorption_profiles = np.zeros(len(z_pos))
-    A_layer = np.zeros(len(widths))
+    A_per_ray = np.zeros((n_reps * nx * ny, len(widths)))
     Is = np.zeros(n_reps*nx*ny)
 
-    profiles = np.zeros(len(z_pos))
-
     for j1 in range(n_reps):
         offset = j1 * nx * ny
         # print(offset, n_reps)
         for c, vals in enumerate(product(xs, ys)):
-            I, profile, A_per_layer, th_o, phi_o, n_pass, n_interact = single_ray_stack(vals[0], vals[1], nks, alphas, r_a_0,
-            surfaces, widths, z_pos, I_thresh, pol, randomize)
+            I, _, A_per_layer, th_o, phi_o, n_pass, n_interact = single_ray_stack(vals[0], vals[1], nks, alphas, r_a_0,
+            surfaces, widths, z_pos, I_thresh, pol, randomize, tally, roulette,
+            None if first_hit is None else first_hit[c])
 
             #print(phi_o)
             #print(th_o)
             #phi_o[th_o < 0] = phi_o + np.pi
             #th_o = abs(th_o)
 
-            profiles = profiles + profile/(n_reps*nx*ny)
             thetas[c+offset] = th_o
             phis[c+offset] = phi_o
             Is[c+offset] = np.real(I)
-            A_layer = A_layer+A_per_layer/(n_reps*nx*ny)
+            A_per_ray[c+offset] = A_per_layer
             n_passes[c+offset] = n_pass
             n_interactions[c+offset] = n_interact
 
-
-
     #print('THETAS PARALLEL INTTER', thetas)
     #print('done', np.mean(n_passes), np.mean(n_interactions))
-    return Is, profiles, A_layer, thetas, phis, n_passes, n_interactions
+    return Is, A_per_ray, thetas, phis, n_passes, n_interactions, np.arange(n_reps*nx*ny)
 
 
 def normalize(x):
@@ -591,11 +987,6 @@ def normalize(x):
         x = x/sum(x) - x.coords['A']
     return x
 
-def overall_bin(x, phi_intv, angle_vector_0):
-    phi_ind = np.digitize(x, phi_intv[x.coords['theta_bin'].data[0]], right=True) - 1
-    bin = np.argmin(abs(angle_vector_0 - x.coords['theta_bin'].data[0])) + phi_ind
-    return bin
-
 def make_profiles_wl(unique_thetas, n_a_in, side, widths,
                      angle_distmat, wl, lookuptable, pol, depth_spacing, prof_layers):
 
@@ -696,8 +1087,30 @@ def make_profiles_wl(unique_thetas, n_a_in, side, widths,
     return profile
 
 
+# surfaces with at most this many triangles are not given an acceleration grid: testing every triangle is faster
+min_triangles_grid = 32
+
+
 class RTSurface:
-    def __init__(self, Points):
+
+    # surfaces for which the intersections are calculated in closed form by the intersect method (see
+    # analytic_surfaces.py) rather than by testing the triangles
+    analytic = False
+
+    # 'x' or 'y' for analytic surfaces which are invariant along that axis (e.g. V-grooves): the rays are then only
+    # followed through the unit cells along the other axis, and the intersections reduce to a 2D problem in the plane
+    # perpendicular to the invariant axis
+    invariant_axis = None
+
+    def __init__(self, Points, grid_size=None):
+        """Triangulated surface used by the ray-tracer.
+
+        :param Points: array of shape (n_points, 3) with the x, y and z coordinates of the points on the surface. The \
+        surface is triangulated in the xy plane.
+        :param grid_size: (nx, ny), number of cells in the x and y directions of the grid used to find the \
+        triangles along a ray. If None, it is chosen based on the number of triangles (see build_grid). If False, \
+        no grid is used.
+        """
 
         tri = Delaunay(Points[:, [0, 1]])
         self.simplices = tri.simplices
@@ -716,6 +1129,130 @@ class RTSurface:
 
         self.zcov= Points[:,2][np.all(np.array([Points[:,0] == min(Points[:,0]), Points[:,1] == min(Points[:,1])]), axis = 0)]
 
+        self.build_grid(grid_size)
+
+    def offset(self, dz):
+        """Returns a copy of the surface translated by dz in the z direction, with the same grid settings."""
+        Points = self.Points.astype(float)
+        Points[:, 2] = Points[:, 2] + dz
+        return RTSurface(Points, False if self.grid is None else self.grid)
+
+    def build_grid(self, grid_size=None):
+        """Builds a uniform grid over the surface in the xy plane. Each grid cell stores the indices of the triangles
+        whose bounding box (in xy) overlaps the cell, so that only the triangles in the cells crossed by a ray have to
+        be tested for intersections. Surfaces with min_triangles_grid triangles or fewer do not get a grid.
+
+        :param grid_size: (nx, ny), number of grid cells in the x and y directions. If None, approximately two \
+        triangles per cell are used. If False, no grid is built.
+        """
+        if grid_size is False:
+            self.grid = None
+            return
+
+        if grid_size is None:
+            if self.size <= min_triangles_grid:
+                self.grid = None
+                return
+            n_cells = int(np.ceil(np.sqrt(self.size / 2)))
+            grid_size = (n_cells, n_cells)
+
+        nx, ny = grid_size
+        self.grid = grid_size
+        self.grid_min = np.min(self.Points, axis=0)
+        self.grid_max = np.max(self.Points, axis=0)
+        self.grid_step = np.array([self.Lx / nx, self.Ly / ny])
+
+        corners = np.stack((self.P_0s, self.P_1s, self.P_2s))[:, :, :2]
+        eps = 1e-9 * max(self.Lx, self.Ly)
+        ix0, iy0 = self.grid_cell(np.min(corners, axis=0) - eps).T
+        ix1, iy1 = self.grid_cell(np.max(corners, axis=0) + eps).T
+
+        # list all (triangle, cell) pairs
+        n_x = ix1 - ix0 + 1
+        counts = n_x * (iy1 - iy0 + 1)
+        tri_index = np.repeat(np.arange(self.size), counts)
+        offset = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell = (np.repeat(ix0, counts) + offset % np.repeat(n_x, counts)) * ny + \
+               np.repeat(iy0, counts) + offset // np.repeat(n_x, counts)
+
+        order = np.argsort(cell, kind='stable')
+        self.cell_triangles = tri_index[order]
+        self.cell_start = np.searchsorted(cell[order], np.arange(nx * ny + 1))
+
+    def grid_cell(self, xy):
+        """Indices (ix, iy) of the grid cells containing the points xy (array of shape (n, 2))."""
+        ind = np.floor((xy - self.grid_min[:2]) / self.grid_step).astype(int)
+        return np.clip(ind, 0, np.array(self.grid) - 1)
+
+    def candidate_triangles(self, r_a, d):
+        """Finds the triangles which each ray could intersect, using the grid built by build_grid.
+
+        :param r_a: starting points of the rays, array of shape (n_rays, 3)
+        :param d: directions of the rays, array of shape (n_rays, 3)
+
+        :return: ray_index, tri_index: arrays of the same length, listing the (ray, triangle) pairs which have to be \
+        tested for intersections.
+        """
+        n_rays = r_a.shape[0]
+
+        if self.grid is None:
+            return np.repeat(np.arange(n_rays), self.size), np.tile(np.arange(self.size), n_rays)
+
+        # range of the ray parameter t (r = r_a + t*d) for which the ray is inside the bounding box of the surface
+        eps = 1e-9 * max(self.Lx, self.Ly)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_lo = (self.grid_min - eps - r_a) / d
+            t_hi = (self.grid_max + eps - r_a) / d
+        t_in = np.fmin(t_lo, t_hi)
+        t_out = np.fmax(t_lo, t_hi)
+        t_in[np.isnan(t_in)] = -np.inf
+        t_out[np.isnan(t_out)] = np.inf
+        t_0 = np.maximum(np.max(t_in, axis=1), 0)
+        t_1 = np.min(t_out, axis=1)
+
+        hits_box = np.where(t_1 >= t_0)[0]
+        t_1 = np.minimum(t_1[hits_box], t_0[hits_box] + 2*np.sum(self.grid_max - self.grid_min))
+        t_0 = t_0[hits_box]
+
+        # positions (in units of grid cells) at which the rays enter and leave the bounding box
+        u_0 = (r_a[hits_box, :2] + t_0[:, None] * d[hits_box, :2] - self.grid_min[:2]) / self.grid_step
+        u_1 = (r_a[hits_box, :2] + t_1[:, None] * d[hits_box, :2] - self.grid_min[:2]) / self.grid_step
+        du = u_1 - u_0
+
+        # values of the segment parameter s (0 to 1) where the ray crosses grid lines in x and y
+        ray_s = [np.arange(len(hits_box)), np.arange(len(hits_box))]
+        s_vals = [np.zeros(len(hits_box)), np.ones(len(hits_box))]
+        for i1 in range(2):
+            start = np.floor(u_0[:, i1]).astype(int)
+            end = np.floor(u_1[:, i1]).astype(int)
+            n_cross = np.abs(end - start)
+            ray = np.repeat(np.arange(len(hits_box)), n_cross)
+            offset = np.arange(np.sum(n_cross)) - np.repeat(np.cumsum(n_cross) - n_cross, n_cross)
+            line = np.where(du[ray, i1] > 0, start[ray] + 1 + offset, start[ray] - offset)
+            ray_s.append(ray)
+            s_vals.append((line - u_0[ray, i1]) / du[ray, i1])
+
+        ray_s = np.concatenate(ray_s)
+        s_vals = np.clip(np.concatenate(s_vals), 0, 1)
+        order = np.lexsort((s_vals, ray_s))
+        ray_s = ray_s[order]
+        s_vals = s_vals[order]
+
+        # cells crossed: the cell containing the midpoint between consecutive crossings
+        same_ray = ray_s[1:] == ray_s[:-1]
+        ray_c = ray_s[:-1][same_ray]
+        s_mid = 0.5 * (s_vals[:-1] + s_vals[1:])[same_ray]
+        ix, iy = self.grid_cell(u_0[ray_c] * self.grid_step + self.grid_min[:2] +
+                                s_mid[:, None] * du[ray_c] * self.grid_step).T
+        cell = ix * self.grid[1] + iy
+
+        counts = self.cell_start[cell + 1] - self.cell_start[cell]
+        ray_index = hits_box[np.repeat(ray_c, counts)]
+        offset = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        tri_index = self.cell_triangles[np.repeat(self.cell_start[cell], counts) + offset]
+
+        return ray_index, tri_index
+
 
 
     def find_area(self):
@@ -738,26 +1275,13 @@ def calc_R(n1, n2, theta, pol):
     else:
         return (Rs+Rp)/2
 
-def exit_side(r_a, d, Lx, Ly):
-    n = np.array([[0, -1, 0], [-1, 0, 0], [0, 1, 0], [1, 0, 0]])    # surface normals: top, right, bottom, left
-    p_0 = np.array([[0, Ly, 0], [Lx, 0, 0], [0, 0, 0], [0, 0, 0]])  # points on each plane
-    denom = np.sum(d * n, axis=1)
-    denom[denom == 0] = 1e-12
-    t = np.sum((p_0 - r_a) * n, axis=1) / denom     # r_intersect = r_a + t*d
-    which_intersect = t > 0                                         # only want intersections of forward-travelling ray
-    t[~which_intersect] = float('inf')                              # set others to inf to avoid finding when doing min
-    which_side = np.argmin(t)                                       # find closest plane
-
-    return which_side, t[which_side]
-
-
 def calc_angle(x):
 
     v1 = np.array([0, 1])
     return np.math.atan2(np.linalg.det([x, v1]), np.dot(x, v1))  # - 180 to 180
 
 def single_ray_stack(x, y,  nks, alphas, r_a_0, surfaces, widths,
-                     z_pos, I_thresh, pol = 'u', randomize = False):
+                     z_pos, I_thresh, pol = 'u', randomize = False, tally = None, roulette = 0, first_hit = None):
     # final_res = 0: reflection
     # final_res = 1: transmission
     # This should get a list of surfaces and materials (optical constants, alpha + widths); there is one less surface than material
@@ -775,9 +1299,19 @@ def single_ray_stack(x, y,  nks, alphas, r_a_0, surfaces, widths,
     # should end when either material = final material (len(materials)-1) & direction == 1 or
     # material = 0 & direction == -1
 
+    # passes through the layers are added to tally (a ProfileTally); if no tally is passed, the profile for
+    # this ray is evaluated at z_pos and returned. Otherwise, the returned profile is None.
 
+    # if roulette > 0, a ray whose intensity drops below I_thresh is not simply stopped (which loses its remaining
+    # intensity): it survives with probability roulette, with its intensity scaled by 1/roulette (Russian roulette).
+
+    # first_hit is the first intersection of the ray with the first surface, from first_intersection; if None, it is
+    # calculated here.
+    if tally is None:
+        ray_tally = ProfileTally(widths)
+    else:
+        ray_tally = tally
 
-    profile = np.zeros(len(z_pos))
     # do everything in microns
     A_per_layer = np.zeros(len(widths))
 
@@ -798,13 +1332,6 @@ def single_ray_stack(x, y,  nks, alphas, r_a_0, surfaces, widths,
     n_passes = 0
 
     # print('r_a, d', r_a, d)
-    depths = []
-    depth_indices = []
-    for i1 in range(len(widths)):
-        depth_indices.append((z_pos < np.cumsum(widths)[i1]) & (z_pos >= np.cumsum(widths)[i1 - 1]))
-        depths.append(z_pos[depth_indices[i1]] - \
-             np.cumsum(widths)[i1 - 1])
-
     n_interactions = 0
 
     ## print('alphas', alphas)
@@ -842,7 +1369,8 @@ def single_ray_stack(x, y,  nks, alphas, r_a_0, surfaces, widths,
 
         res, theta, phi, r_a, d, _, n_interactions = single_interface_check(r_a, d, ni,
                                      nj, surf, surf.Lx, surf.Ly, direction,
-                                     surf.zcov, pol, n_interactions)
+                                     surf.zcov, pol, n_interactions, first_hit=first_hit)
+        first_hit = None
 
         if res == 0:  # reflection
             direction = -direction  # changing direction due to reflection
@@ -861,12 +1389,16 @@ def single_ray_stack(x, y,  nks, alphas, r_a_0, surfaces, widths,
 
 
         I_b = I
+        theta_b = theta
         #print('I before', I)
-        DA, stop, I, theta = traverse(widths[mat_index], theta, alphas[mat_index], x, y, I,
-                                      depths[mat_index], I_thresh, direction)
+        ray_tally.add(mat_index, direction, theta, alphas[mat_index], I_b)
+        stop, I, theta = traverse(widths[mat_index], theta, alphas[mat_index], x, y, I,
+                                  I_thresh, direction)
         #print('I after', I)
         A_per_layer[mat_index] = np.real(A_per_layer[mat_index] + I_b - I)
-        profile[depth_indices[mat_index]] = np.real(profile[depth_indices[mat_index]] + DA)
+
+        if stop and roulette > 0 and random() < roulette:
+            stop, I, theta = False, I/roulette, theta_b
 
         n_passes = n_passes + 1
 
@@ -880,9 +1412,11 @@ def single_ray_stack(x, y,  nks, alphas, r_a_0, surfaces, widths,
             #print('REFLECTION', theta, d)
             # have ended with reflection
 
+    profile = ray_tally.profile(z_pos) if tally is None else None
+
     return I, profile, A_per_layer, theta, phi, n_passes, n_interactions
 
-def single_ray_interface(x, y,  nks, r_a_0, theta, phi, surfaces, pol, wl, Fr_or_TMM, lookuptable):
+def single_ray_interface(x, y,  nks, r_a_0, theta, phi, surfaces, pol, wl, Fr_or_TMM, lookuptable, first_hit=None):
 
     direction = 1   # start travelling downwards; 1 = down, -1 = up
     mat_index = 0   # start in first medium
@@ -906,7 +1440,8 @@ def single_ray_interface(x, y,  nks, r_a_0, theta, phi, surfaces, pol, wl, Fr_or
 
         res, theta, phi, r_a, d, theta_loc, _ = single_interface_check(r_a, d, nks[mat_index],
                                      nks[mat_index+1], surf, surf.Lx, surf.Ly, direction,
-                                     surf.zcov, pol, 0, wl, Fr_or_TMM, lookuptable)
+                                     surf.zcov, pol, 0, wl, Fr_or_TMM, lookuptable, first_hit)
+        first_hit = None
 
 
         if res == 0:  # reflection
@@ -939,10 +1474,9 @@ def single_ray_interface(x, y,  nks, r_a_0, theta, phi, surfaces, pol, wl, Fr_or
     return I, theta, phi, surface_A
 
 
-def traverse(width, theta, alpha, x, y, I_i, positions, I_thresh, direction):
-
+def traverse(width, theta, alpha, x, y, I_i, I_thresh, direction):
+    # the absorption profile is not calculated here; the pass is added to a ProfileTally instead.
     stop = False
-    DA = (alpha/abs(cos(theta)))*I_i*np.exp((-alpha*positions/abs(cos(theta))))
     I_back = I_i*np.exp(-alpha*width/abs(cos(theta)))
     #print('alpha, width', alpha, width)
     if I_back < I_thresh:
@@ -950,10 +1484,7 @@ def traverse(width, theta, alpha, x, y, I_i, positions, I_thresh, direction):
         theta = None
         #print('ABSORBED')
 
-    if direction == -1:
-        DA = np.flip(DA)
-
-    return DA, stop, I_back, theta
+    return stop, I_back, theta
 
 
 def decide_RT_Fresnel(n0, n1, theta, d, N, side, pol, rnd, wl = None, lookuptable = None):
@@ -985,10 +1516,8 @@ def decide_RT_Fresnel(n0, n1, theta, d, N, side, pol, rnd, wl = None, lookuptabl
     return d, side, None # never absorbed, A = False
 
 def decide_RT_TMM(n0, n1, theta, d, N, side, pol, rnd, wl, lookuptable):
-    data = lookuptable.loc[dict(side=side, pol=pol)].sel(angle=abs(theta), wl=wl*1e9, method='nearest')
-    R = np.real(data['R'].data.item(0))
-    T = np.real(data['T'].data.item(0))
-    A_per_layer = np.real(data['Alayer'].data)
+    # lookuptable is a TMMLookupTable
+    R, T, A_per_layer = lookuptable.lookup(side, pol, abs(theta), wl)
 
     if rnd <= R:  # REFLECTION
 
@@ -1016,186 +1545,175 @@ def decide_RT_TMM(n0, n1, theta, d, N, side, pol, rnd, wl, lookuptable):
     return d, side, A
 
 
-def single_interface_check(r_a, d, ni, nj, tri, Lx, Ly, side, z_cov, pol, n_interactions=0, wl=None, Fr_or_TMM=0, lookuptable=None):
+def single_interface_check(r_a, d, ni, nj, tri, Lx, Ly, side, z_cov, pol, n_interactions=0, wl=None, Fr_or_TMM=0, lookuptable=None,
+                           first_hit=None):
     decide = {0: decide_RT_Fresnel, 1: decide_RT_TMM}
-    # print('intf check')
-    # weird stuff happens around edges; can get transmission counted as reflection
+    # the next intersection of the ray with the periodic surface is found by check_intersect_periodic, which follows
+    # the ray through the unit cells it crosses in order. If there is no intersection, the ray has left the surface.
+    # If first_hit (the result of check_intersect_periodic for r_a and d) is passed, it is used for the first
+    # intersection instead of being calculated again.
     d0 = d
-    intersect = True
-    checked_translation = False
-    side_0 = side
-    #print('d0', d)
-    # [top, right, bottom, left]
-    translation = np.array([[0, -Ly, 0], [-Lx, 0, 0], [0, Ly, 0], [Lx, 0, 0]])
-    n_misses = 0
-    i1 = 0
-    while intersect:
-        i1 = i1+1
-        with np.errstate(divide='ignore', invalid='ignore'): # there will be divide by 0/multiply by inf - this is fine but gives lots of warnings
-            result = check_intersect(r_a, d, tri)
-        #print('results', result)
-        if result == False and not checked_translation:
-            if i1 > 1:
-
-                which_side, tt = exit_side(r_a, d, Lx, Ly)
-                #print('before translation', r_a)
-                r_a = r_a + translation[which_side]
-                #print('translation', which_side)
-                #print('after normal translation', r_a, which_side)
-                checked_translation = True
+    theta = 0
+    while True:
+        if first_hit is not None:
+            result, first_hit = first_hit, None
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'): # there will be divide by 0/multiply by inf - this is fine but gives lots of warnings
+                result = check_intersect_periodic(r_a, d, tri)
 
-            else:
-                if n_misses < 100:
-                # misses surface. Try again
-                # print('MISS                                    !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!', r_a, d, side)
-                    if d[2] < 0: # coming from above
-                        r_a = [np.random.rand()*Lx, np.random.rand()*Ly, tri.z_max+0.01]
-                    else:
-                        r_a = [np.random.rand()*Lx, np.random.rand()*Ly, tri.z_min-0.01]
-                    n_misses += 1
-                    i1 = 0
-                else:
-                    # ray keeps missing, probably because it's travelling (almost) exactly perpendicular to surface.
-                    # assume it is reflected back into layer it came from
-                    #print('GIVE UP')
-                    d[2] = -d[2]
-                    o_t = np.real(acos(d[2] / (np.linalg.norm(d) ** 2)))
-                    o_p = np.real(atan2(d[1], d[0]))
-                    return 0, o_t, o_p, r_a, d, 0, n_interactions
-
-        elif result == False and checked_translation:
-
-            #print(tri.z_min)
-            #print(tri.z_max)
-            if (side == 1 and d[2] < 0 and r_a[2] > tri.z_min) or (side == -1 and d[2] > 0 and r_a[2] < tri.z_max):
-                # going down but above surface
-
-                if r_a[0] > Lx or r_a[0] < 0:
-                    r_a[0] = r_a[0] % Lx # translate back into until cell before doing any additional translation
-                if r_a[1] > Ly or r_a[1] < 0:
-                    r_a[1] = r_a[1] % Ly # translate back into until cell before doing any additional translation
-                #print('weird situation', r_a, side)
-                exit, t = exit_side(r_a, d, Lx, Ly)
-
-                r_a = r_a + t * d + translation[exit]
-                #print('after traversing', r_a, d, exit)
-                checked_translation = True
+        if result is False:
+            o_t = np.real(acos(d[2] / (np.linalg.norm(d) ** 2)))
+            o_p = np.real(atan2(d[1], d[0]))
+
+            if np.sign(d0[2]) == np.sign(d[2]):
+                #print('interface trans')
+                final_res = 1
 
             else:
+                #print('interface ref')
+                final_res = 0
 
-                o_t = np.real(acos(d[2] / (np.linalg.norm(d) ** 2)))
-                o_p = np.real(atan2(d[1], d[0]))
+            if r_a[0] > Lx or r_a[0] < 0:
+                r_a[0] = r_a[0] % Lx  # translate back into until cell before next ray
+            if r_a[1] > Ly or r_a[1] < 0:
+                r_a[1] = r_a[1] % Ly  # translate back into until cell before next ray
 
-                if np.sign(d0[2]) == np.sign(d[2]):
-                    intersect = False
-                    #print('interface trans')
-                    final_res = 1
+            return final_res, o_t, o_p, r_a, d, theta, n_interactions  # theta is LOCAL incidence angle (relative to texture)
 
-                else:
-                    intersect = False
-                    #print('interface ref')
-                    final_res = 0
-
-                # if side == side_0:
-                #     intersect = False
-                #     final_res = 0
-                #     #print('ref')
-                #     #print(side, side_0, d)
-                #
-                # else:
-                #     intersect = False
-                #     final_res = 1
-                #     #print('trns')
-                #     #print(side, side_0, d)
-
-                #print('finished w interface', final_res, d, r_a)
-                if r_a[0] > Lx or r_a[0] < 0:
-                    r_a[0] = r_a[0] % Lx  # translate back into until cell before next ray
-                if r_a[1] > Ly or r_a[1] < 0:
-                    r_a[1] = r_a[1] % Ly  # translate back into until cell before next ray
-
-                return final_res, o_t, o_p, r_a, d, theta, n_interactions  # theta is LOCAL incidence angle (relative to texture)
+        # there has been an intersection
+        n_interactions += 1
 
-        else:
+        intersn = result[0] # coordinate of the intersection (3D)
 
-            # there has been an intersection
-            n_interactions += 1
+        theta =  result[1]
 
-            intersn = result[0] # coordinate of the intersection (3D)
+        N = result[2]*side # so angles get worked out correctly, relative to incident face normal
 
-            theta =  result[1]
+        if side == 1:
+            n0 = ni
+            n1 = nj
 
-            N = result[2]*side # so angles get worked out correctly, relative to incident face normal
+        else:
+            n0 = nj
+            n1 = ni
 
-            if side == 1:
-                n0 = ni
-                n1 = nj
+        rnd = random()
 
-            else:
-                n0 = nj
-                n1 = ni
+        d, side, A = decide[Fr_or_TMM](n0, n1, theta, d, N, side, pol, rnd, wl, lookuptable)
 
-            rnd = random()
+        r_a = np.real(intersn + d / 1e9) # this is to make sure the raytracer doesn't immediately just find the same intersection again
 
-            #print('side before', side, d)
-            d, side, A = decide[Fr_or_TMM](n0, n1, theta, d, N, side, pol, rnd, wl, lookuptable)
+        if A is not None:
+            final_res = 2
+            o_t = A
+            o_p = 0
 
-            #print('side after', side, d)
+            return final_res, o_t, o_p, r_a, d, theta, n_interactions  # theta is LOCAL incidence angle (relative to texture)
 
-            r_a = np.real(intersn + d / 1e9) # this is to make sure the raytracer doesn't immediately just find the same intersection again
-            #print('interns', intersn, r_a)
 
-            checked_translation = False # reset, need to be able to translate the ray back into the unit cell again if necessary
+def first_intersection(x, y, r_a_0, surf):
+    # first intersection (result of check_intersect_periodic) of the ray launched from (x, y, 0) + r_a_0 towards
+    # (x, y, 0) with the surface surf, after translating it into the unit cell as in single_ray_stack and
+    # single_ray_interface. This only depends on the geometry, not on the wavelength, so it can be calculated once and
+    # passed as first_hit to those functions for each wavelength.
+    r_a = r_a_0 + np.array([x, y, 0])
+    r_b = np.array([x, y, 0])
+    d = (r_b - r_a) / np.linalg.norm(r_b - r_a)
+
+    r_a[0] = r_a[0]-surf.Lx*((r_a[0]+d[0]*(surf.zcov-r_a[2])/d[2])//surf.Lx)
+    r_a[1] = r_a[1]-surf.Ly*((r_a[1]+d[1]*(surf.zcov-r_a[2])/d[2])//surf.Ly)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return check_intersect_periodic(r_a, d, surf)
+
+
+def check_intersect_periodic(r_a, d, tri):
+    # finds the closest intersection of the ray with the surface tri, repeated periodically in x and y. The part of
+    # the ray between z_min and z_max is followed through the unit cells it crosses in order (2D DDA), and
+    # check_intersect is called for the ray translated back into the unit cell, until there is an intersection.
+    # For surfaces which are invariant along one axis, the ray only moves through the cells along the other axis.
+    # Returns the same as check_intersect (with the intersection in the original coordinates of the ray), or False if
+    # the ray does not intersect the surface. See check_intersect_periodic_packet for the vectorized version.
+    L = np.array([tri.Lx, tri.Ly])
+    origin = np.min(tri.Points[:, :2], axis=0)
+    eps = 1e-9 * max(tri.Lx, tri.Ly)
+
+    # range of t (r = r_a + t*d) for which the ray is between z_min and z_max
+    if d[2] != 0:
+        t_lo = (tri.z_min - eps - r_a[2]) / d[2]
+        t_hi = (tri.z_max + eps - r_a[2]) / d[2]
+        t_0 = max(min(t_lo, t_hi), 0)
+        t_1 = max(t_lo, t_hi)
+    elif tri.z_min - eps <= r_a[2] <= tri.z_max + eps:
+        t_0, t_1 = 0, float('inf')
+    else:
+        return False
 
-            if A is not None:
-                intersect = False
-                checked_translation = True
-                final_res = 2
-                o_t = A
-                o_p = 0
+    if t_1 < t_0:
+        return False
+
+    cell = np.floor((r_a[:2] + t_0 * d[:2] - origin) / L)
+    step = np.sign(d[:2]) * periodic_axes(tri)
+    t_next = np.full(2, float('inf'))
+    t_delta = np.full(2, float('inf'))
+    for i1 in range(2):
+        if step[i1] != 0:
+            t_next[i1] = (origin[i1] + (cell[i1] + (step[i1] > 0)) * L[i1] - r_a[i1]) / d[i1]
+            t_delta[i1] = L[i1] / abs(d[i1])
 
-                return final_res, o_t, o_p, r_a, d, theta, n_interactions  # theta is LOCAL incidence angle (relative to texture)
+    for _ in range(max_cells):
+        shift = np.array([cell[0] * L[0], cell[1] * L[1], 0])
+        result = check_intersect(r_a - shift, d, tri)
 
-        # if we are above surface, going downwards, or below surface, going upwards, and we have not yet
-        # reached z_cov, we should keep trying to translate, so want to set check_translation = false
-        # we also need to update r_a so that check_translation can correctly identify the next unit cell
-        # the ray will move into
+        if result is not False:
+            result[0] = result[0] + shift
+            return result
 
-        # if (side == 1 and d[2] < 0 and r_a[2] > z_cov) or \
-        #         (side == -1 and d[2] > 0 and r_a[2] < z_cov) and checked_translation:  # going down but above surface
-        #
-        #     print('weird situation', r_a, side)
-        #     #r_a[0] = r_a[0] % Lx # translate back into until cell before doing any additional translation
-        #     #r_a[1] = r_a[1] % Ly
-        #     exit, t = exit_side(r_a, d, Lx, Ly)
-        #
-        #     r_a = r_a + t*d + translation[exit]
-        #     #r_a[0] = r_a[0] % Lx # translate back into until cell before doing any additional translation
-        #     #r_a[1] = r_a[1] % Ly
-        #     print('after translation', r_a, d, exit)
-        #     checked_translation = False
+        # move into the next cell along the ray, unless it has left the slab
+        axis = 0 if t_next[0] <= t_next[1] else 1
+        if t_next[axis] > t_1:
+            return False
+        cell[axis] += step[axis]
+        t_next[axis] += t_delta[axis]
 
+    return False
 
 
 def check_intersect(r_a, d, tri):
 
+    if tri.analytic:
+        t, ind = tri.intersect(np.array([r_a]), np.array([d]))
+        if np.isinf(t[0]):
+            return False
+
+        N = tri.crossP[ind[0]] / np.linalg.norm(tri.crossP[ind[0]])
+        theta = atan(np.linalg.norm(np.cross(N, -d))/np.dot(N, -d))  # in radians, angle relative to plane
+        return [r_a + t[0] * d, theta, N]
+
     # all the stuff which is only surface-dependent (and not dependent on incoming direction) is
     # in the surface object tri.
-    D = np.matlib.repmat(np.transpose([-d]), 1, tri.size).T
-    pref = 1 / np.sum(D * tri.crossP, axis=1)
-    corner = r_a - tri.P_0s
-    t = pref * np.sum(tri.crossP * corner, axis=1)
-    u = pref * np.sum(np.cross(tri.P_2s - tri.P_0s, D) * corner, axis=1)
-    v = pref * np.sum(np.cross(D, tri.P_1s - tri.P_0s) * corner, axis=1)
+    if tri.grid is None:
+        P_0s, P_1s, P_2s, crossP = tri.P_0s, tri.P_1s, tri.P_2s, tri.crossP
+    else:
+        # only test the triangles in the grid cells the ray passes through
+        _, cand = tri.candidate_triangles(np.array([r_a]), np.array([d]))
+        P_0s, P_1s, P_2s, crossP = tri.P_0s[cand], tri.P_1s[cand], tri.P_2s[cand], tri.crossP[cand]
+
+    D = np.matlib.repmat(np.transpose([-d]), 1, len(P_0s)).T
+    pref = 1 / np.sum(D * crossP, axis=1)
+    corner = r_a - P_0s
+    t = pref * np.sum(crossP * corner, axis=1)
+    u = pref * np.sum(np.cross(P_2s - P_0s, D) * corner, axis=1)
+    v = pref * np.sum(np.cross(D, P_1s - P_0s) * corner, axis=1)
 
     which_intersect = (u + v <= 1) & (np.all(np.vstack((u, v)) >= -1e-10, axis=0)) & (t > 0)
     # get errors if set exactly to zero.
     if sum(which_intersect) > 0:
 
         t = t[which_intersect]
-        P0 = tri.P_0s[which_intersect]
-        P1 = tri.P_1s[which_intersect]
-        P2 = tri.P_2s[which_intersect]
+        P0 = P_0s[which_intersect]
+        P1 = P_1s[which_intersect]
+        P2 = P_2s[which_intersect]
         ind = np.argmin(t)
         t = min(t)
 
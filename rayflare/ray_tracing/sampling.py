@@ -0,0 +1,58 @@
+import numpy as np
+from scipy.stats import qmc
+
+
+def sample_points(n, dim, sequence='random'):
+    """Generates n points in the unit hypercube [0, 1)^dim, used to choose ray starting positions and incidence
+    angles.
+
+    :param n: number of points
+    :param dim: number of dimensions
+    :param sequence: 'random' (independent uniform random numbers), 'sobol' (scrambled Sobol low-discrepancy \
+    sequence) or 'stratified' (Latin hypercube: in each dimension, exactly one point falls in each of n equal \
+    intervals). The scrambling of 'sobol' and 'stratified' is seeded from numpy's global random state, so \
+    np.random.seed makes the points reproducible.
+
+    :return: array of shape (n, dim)
+    """
+    if sequence == 'random':
+        # each dimension is drawn in turn, as when calling np.random.random(n) once per dimension
+        return np.random.random((dim, n)).T
+
+    seed = np.random.randint(2**31)
+
+    if sequence == 'sobol':
+        # the Sobol sequence is balanced for powers of 2, so generate the next power of 2 and keep the first n points
+        points = qmc.Sobol(d=dim, scramble=True, seed=seed).random_base2(int(np.ceil(np.log2(max(n, 1)))))
+        return points[:n]
+
+    elif sequence == 'stratified':
+        return qmc.LatinHypercube(d=dim, seed=seed).random(n)
+
+    else:
+        raise ValueError("sequence must be 'random', 'sobol' or 'stratified'")
+
+
+def decision_numbers(n, sampling='random'):
+    """Generates the random numbers used to decide whether each of n rays interacting with a surface is reflected,
+    transmitted or absorbed. Each number is uniformly distributed in [0, 1), so the decisions are unbiased for any
+    choice of sampling; the alternatives to 'random' reduce the variance of the fraction of rays reflected.
+
+    :param n: number of rays
+    :param sampling: 'random' (independent uniform random numbers), 'stratified' (one number in each of n equal \
+    intervals, shuffled between the rays) or 'antithetic' (pairs of numbers u and 1 - u, shuffled between the rays)
+
+    :return: array of length n
+    """
+    if sampling == 'random':
+        return np.random.random(n)
+
+    elif sampling == 'stratified':
+        return (np.random.permutation(n) + np.random.random(n)) / n
+
+    elif sampling == 'antithetic':
+        u = np.random.random(int(np.ceil(n / 2)))
+        return np.random.permutation(np.concatenate((u, 1 - u))[:n])
+
+    else:
+        raise ValueError("sampling must be 'random', 'stratified' or 'antithetic'")
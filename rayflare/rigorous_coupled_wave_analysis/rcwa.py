@@ -2,9 +2,10 @@ import numpy as np
 import tmm
 import xarray as xr
 from solcore.absorption_calculator import OptiStack
-from joblib import Parallel, delayed
-from rayflare.angles import make_angle_vector
+from rayflare.scheduling import run_tasks, iter_tasks, rcwa_cost, checkpoint_paths, checkpoint_key
+from rayflare.angles import angle_grid
 import os
+import shutil
 from sparse import COO, save_npz, load_npz, stack
 from rayflare.config import results_path
 from time import time
@@ -112,7 +113,8 @@ def RCWA(structure, size, orders, options, incidence, transmission, only_inciden
         rcwa_options.update(user_options)
         print(rcwa_options)
 
-        theta_intv, phi_intv, angle_vector = make_angle_vector(n_theta_bins, phi_sym, c_az)
+        grid = angle_grid(n_theta_bins, phi_sym, c_az)
+        angle_vector = grid.angle_vector
 
         if only_incidence_angle:
             thetas_in = np.array([options['theta_in']])
@@ -128,26 +130,28 @@ def RCWA(structure, size, orders, options, incidence, transmission, only_inciden
         # initialise_S has to happen inside parallel job (get Pickle errors otherwise);
         # just pass relevant optical constants for each wavelength, like for RT
 
-        angle_vector_0 = angle_vector[:, 0]
-
         if front_or_rear == "front":
             side = 1
         else:
             side = -1
 
-        if options['parallel']:
-            allres = Parallel(n_jobs=options['n_jobs'])(delayed(RCWA_wl)
-                                                        (wavelengths[i1]*1e9, geom_list, layers_oc[i1], shapes_oc[i1], shapes_names,
-                                                         pol, thetas_in, phis_in, widths, size,
-                                                         orders, phi_sym, theta_intv, phi_intv,
-                                                         angle_vector_0, rcwa_options, detail_layer, side)
-                                                        for i1 in range(len(wavelengths)))
-
+        # the result at each wavelength is saved as soon as it is calculated, so that an interrupted calculation can
+        # be resumed (see RT)
+        if save and options.get('checkpoint', False):
+            checkpoint_folder = os.path.join(structpath, surf_name + front_or_rear + 'checkpoints')
+            key = checkpoint_key(options, geom_list, layers_oc, shapes_oc, shapes_names, widths, size, orders,
+                                 only_incidence_angle, side, detail_layer)
+            checkpoints = checkpoint_paths(checkpoint_folder, wavelengths, key)
         else:
-            allres = [RCWA_wl(wavelengths[i1]*1e9, geom_list, layers_oc[i1], shapes_oc[i1], shapes_names,
-                              pol, thetas_in, phis_in, widths, size, orders, phi_sym, theta_intv, phi_intv,
-                              angle_vector_0, rcwa_options, detail_layer, side)
-                      for i1 in range(len(wavelengths))]
+            checkpoints = None
+
+        # the wavelengths with the most propagating orders are started first
+        allres = run_tasks(RCWA_wl, [(wavelengths[i1]*1e9, geom_list, layers_oc[i1], shapes_oc[i1], shapes_names,
+                                      pol, thetas_in, phis_in, widths, size, orders, phi_sym, grid, rcwa_options,
+                                      detail_layer, side)
+                                     for i1 in range(len(wavelengths))],
+                           rcwa_cost(size, orders, wavelengths, layers_oc), options['parallel'], options['n_jobs'],
+                           checkpoints)
 
         R = np.stack([item[0] for item in allres])
         T = np.stack([item[1] for item in allres])
@@ -161,8 +165,11 @@ def RCWA(structure, size, orders, options, incidence, transmission, only_inciden
         A_mat = COO(A_mat)
 
         if save:
-            save_npz(savepath_RT, full_mat)
             save_npz(savepath_A, A_mat)
+            save_npz(savepath_RT, full_mat)
+
+        if checkpoints is not None:
+            shutil.rmtree(checkpoint_folder, ignore_errors=True)
 
         #R_pfbo = np.stack([item[3] for item in allres])
         #T_pfbo = np.stack([item[4] for item in allres])
@@ -177,7 +184,7 @@ def RCWA(structure, size, orders, options, incidence, transmission, only_inciden
 
 
 def RCWA_wl(wl, geom_list, l_oc, s_oc, s_names, pol, theta, phi, widths, size, orders, phi_sym,
-            theta_intv, phi_intv, angle_vector_0, rcwa_options, layer_details = False, side=1):
+            grid, rcwa_options, layer_details = False, side=1):
 
     S = initialise_S(size, orders, geom_list, l_oc, s_oc, s_names, widths, rcwa_options)
 
@@ -200,22 +207,14 @@ def RCWA_wl(wl, geom_list, l_oc, s_oc, s_names, pol, theta, phi, widths, size, o
     T = np.zeros((len(theta)))
     A_layer = np.zeros((len(theta), len(widths)-2))
 
-    mat_RT = np.zeros((len(angle_vector_0), int(len(angle_vector_0)/2)))
-    mat_int = np.zeros((len(angle_vector_0), int(len(angle_vector_0)/2)))
+    mat_RT = np.zeros((grid.n_bins, grid.n_a_in))
+    mat_int = np.zeros((grid.n_bins, grid.n_a_in))
 
     if side == 1:
         in_bin = np.arange(len(theta))
 
     else:
-        binned_theta_in = np.digitize(np.pi-np.pi*theta/180, theta_intv, right=True) - 1
-
-        #print(theta, binned_theta_in)
-        phi_in = xr.DataArray(np.pi*phi/180,
-                              coords={'theta_bin': (['angle_in'], binned_theta_in)},
-                              dims=['angle_in'])
-        #print(len(phi_intv), len(angle_vector_0))
-        in_bin = phi_in.groupby('theta_bin').apply(overall_bin,
-                                                   args=(phi_intv, angle_vector_0)).data - int(len(angle_vector_0)/2)
+        in_bin = grid.angle_bin(np.pi-np.pi*theta/180, np.pi*phi/180) - grid.n_a_in
 
     #print(in_bin)
 
@@ -317,19 +316,14 @@ def RCWA_wl(wl, geom_list, l_oc, s_oc, s_names, pol, theta, phi, widths, size, o
         theta_t[theta_t == 0] = 1e-10
         phi_rt[phi_rt == 0] = 1e-10
 
-        theta_r_bin = np.digitize(theta_r, theta_intv, right=True) - 1
-        theta_t_bin = np.digitize(theta_t, theta_intv, right=True) - 1
+        theta_r_bin = grid.theta_bin(theta_r)
+        theta_t_bin = grid.theta_bin(theta_t)
 
-        for i2 in np.nonzero(R_pfbo)[0]:
-            phi_ind = np.digitize(phi_rt[i2], phi_intv[theta_r_bin[i2]], right=True) - 1
-            bin = np.argmin(abs(angle_vector_0 -theta_r_bin[i2])) + phi_ind
-            #print(R_pfbo[i2], phi_rt[i2], bin, i1, phi_ind, np.argmin(abs(angle_vector_0 -theta_r_bin[i2])))
-            mat_RT[bin, in_bin[i1]] = mat_RT[bin, i1] + R_pfbo[i2]
+        nz_r = np.nonzero(R_pfbo)[0]
+        np.add.at(mat_RT, (grid.overall_bin(theta_r_bin[nz_r], phi_rt[nz_r]), in_bin[i1]), R_pfbo[nz_r])
 
-        for i2 in np.nonzero(T_pfbo)[0]:
-            phi_ind = np.digitize(phi_rt[i2], phi_intv[theta_t_bin[i2]], right=True) - 1
-            bin = np.argmin(abs(angle_vector_0 -theta_t_bin[i2])) + phi_ind
-            mat_RT[bin, in_bin[i1]] = mat_RT[bin, i1] + T_pfbo[i2]
+        nz_t = np.nonzero(T_pfbo)[0]
+        np.add.at(mat_RT, (grid.overall_bin(theta_t_bin[nz_t], phi_rt[nz_t]), in_bin[i1]), T_pfbo[nz_t])
 
         if layer_details:
             #print(R_pfbo_int_p)
@@ -352,15 +346,10 @@ def RCWA_wl(wl, geom_list, l_oc, s_oc, s_names, pol, theta, phi, widths, size, o
 
             R_pfbo_int[np.abs(R_pfbo_int < 1e-16)] = 0  # sometimes get very small negative valyes
             #print(theta_l)
-            theta_l_bin = np.digitize(theta_l, theta_intv, right=True) - 1
+            theta_l_bin = grid.theta_bin(theta_l)
             #print(theta_l_bin)
-            for i2 in np.nonzero(R_pfbo_int)[0]:
-                phi_ind = np.digitize(phi_rt[i2], phi_intv[theta_l_bin[i2]], right=True) - 1
-                bin = np.argmin(abs(angle_vector_0 - theta_l_bin[i2])) + phi_ind
-                #print(bin)
-                #print(R_pfbo_int[i2], phi_rt[i2], bin, i1, phi_ind,
-                #      np.argmin(abs(angle_vector_0 - theta_l_bin[i2])))
-                mat_int[bin, i1] = mat_int[bin, i1] + R_pfbo_int[i2]
+            nz_l = np.nonzero(R_pfbo_int)[0]
+            np.add.at(mat_int, (grid.overall_bin(theta_l_bin[nz_l], phi_rt[nz_l]), i1), R_pfbo_int[nz_l])
 
 
     mat_RT = COO(mat_RT)
@@ -650,27 +639,16 @@ class rcwa_structure:
     def calculate(self):
 
         #print(self.options['theta_in'], self.options['pol'])
-        if self.options['parallel']:
-            allres = Parallel(n_jobs=self.options['n_jobs'])(delayed(self.RCWA_wl)
-                                                        (self.wavelengths[i1] * 1e9, self.geom_list, self.layers_oc[i1], self.shapes_oc[i1],
-                                                         self.shapes_names, self.options['pol'], self.options['theta_in'], self.options['phi_in'],
-                                                         self.widths, self.size,
-                                                         self.orders, self.options['A_per_order'], self.rcwa_options)
-                                                        for i1 in range(len(self.wavelengths)))
+        allres = [None] * len(self.wavelengths)
 
-        else:
-            allres = [
-                self.RCWA_wl(self.wavelengths[i1] * 1e9, self.geom_list, self.layers_oc[i1], self.shapes_oc[i1],
-                                                         self.shapes_names, self.options['pol'], self.options['theta_in'], self.options['phi_in'],
-                                                         self.widths, self.size,
-                                                         self.orders, self.options['A_per_order'], self.rcwa_options)
-                for i1 in range(len(self.wavelengths))]
+        for i1, result in self.calculate_iter():
+            allres[i1] = result
 
         if self.options['A_per_order']:
-            R = np.stack([item[0] for item in allres])
-            T = np.stack([item[1] for item in allres])
-            A_mat = np.stack([item[2] for item in allres])
-            A_order = np.stack([item[3] for item in allres])
+            R = np.stack([item['R'] for item in allres])
+            T = np.stack([item['T'] for item in allres])
+            A_mat = np.stack([item['A_per_layer'] for item in allres])
+            A_order = np.stack([item['A_layer_order'] for item in allres])
 
             self.rat_output_A = np.sum(A_mat, 1)  # used for profile calculation
 
@@ -683,14 +661,32 @@ class rcwa_structure:
             return {'R': R, 'T': T, 'A_per_layer': A_mat, 'A_layer_order': A_order, 'basis_set': basis_set, 'reciprocal': f_mat}
 
         else:
-            R = np.stack([item[0] for item in allres])
-            T = np.stack([item[1] for item in allres])
-            A_mat = np.stack([item[2] for item in allres])
+            R = np.stack([item['R'] for item in allres])
+            T = np.stack([item['T'] for item in allres])
+            A_mat = np.stack([item['A_per_layer'] for item in allres])
 
             self.rat_output_A = np.sum(A_mat, 1) # used for profile calculation
 
             return {'R': R, 'T': T, 'A_per_layer': A_mat}
 
+    def calculate_iter(self):
+        """Generator version of calculate: yields (index, result) for each wavelength as soon as the calculation for
+        that wavelength is finished (in the order in which the calculations finish, if options.parallel is True).
+        index is the index of the wavelength in options.wavelengths, and result is a dictionary with R, T and
+        A_per_layer (and A_layer_order, if options.A_per_order is True) at that wavelength. Closing the generator
+        early cancels the calculations which have not been started yet. Unlike calculate, this does not store the
+        absorption used by calculate_profile."""
+        keys = ['R', 'T', 'A_per_layer', 'A_layer_order']
+
+        for i1, result in iter_tasks(self.RCWA_wl, [(self.wavelengths[i1] * 1e9, self.geom_list, self.layers_oc[i1],
+                                                     self.shapes_oc[i1], self.shapes_names, self.options['pol'],
+                                                     self.options['theta_in'], self.options['phi_in'], self.widths,
+                                                     self.size, self.orders, self.options['A_per_order'],
+                                                     self.rcwa_options)
+                                                    for i1 in range(len(self.wavelengths))],
+                                     rcwa_cost(self.size, self.orders, self.wavelengths, self.layers_oc),
+                                     self.options['parallel'], self.options['n_jobs']):
+            yield i1, dict(zip(keys, result))
 
 
     def calculate_profile(self, z_limit=None, step_size=2, dist=None):
@@ -731,29 +727,14 @@ class rcwa_structure:
         self.dist = dist
 
 
-        if self.options['parallel']:
-            allres = Parallel(n_jobs=self.options['n_jobs'])(delayed(self.RCWA_wl_prof)
-                                                             (self.wavelengths[i1] * 1e9, self.rat_output_A[i1],
-                                                              dist,
-                                                              self.geom_list,
-                                                              self.layers_oc[i1], self.shapes_oc[i1],
-                                                              self.shapes_names, self.options['pol'],
-                                                              self.options['theta_in'], self.options['phi_in'],
-                                                              self.widths, self.size,
-                                                              self.orders, self.rcwa_options)
-                                                             for i1 in range(len(self.wavelengths)))
-
-        else:
-            allres = [
-                self.RCWA_wl_prof(self.wavelengths[i1] * 1e9, self.rat_output_A[i1],
-                                                              dist,
-                                                              self.geom_list,
-                                                              self.layers_oc[i1], self.shapes_oc[i1],
-                                                              self.shapes_names, self.options['pol'],
-                                                              self.options['theta_in'], self.options['phi_in'],
-                                                              self.widths, self.size,
-                                                              self.orders, self.rcwa_options)
-                for i1 in range(len(self.wavelengths))]
+        allres = run_tasks(self.RCWA_wl_prof, [(self.wavelengths[i1] * 1e9, self.rat_output_A[i1], dist,
+                                                self.geom_list, self.layers_oc[i1], self.shapes_oc[i1],
+                                                self.shapes_names, self.options['pol'], self.options['theta_in'],
+                                                self.options['phi_in'], self.widths, self.size, self.orders,
+                                                self.rcwa_options)
+                                               for i1 in range(len(self.wavelengths))],
+                           rcwa_cost(self.size, self.orders, self.wavelengths, self.layers_oc),
+                           self.options['parallel'], self.options['n_jobs'])
 
         output = np.stack(allres)
 
@@ -865,7 +846,3 @@ class rcwa_structure:
 
         return profile_data
 
-def overall_bin(x, phi_intv, angle_vector_0):
-    phi_ind = np.digitize(x, phi_intv[x.coords['theta_bin'].data[0]], right=True) - 1
-    bin = np.argmin(abs(angle_vector_0 - x.coords['theta_bin'].data[0])) + phi_ind
-    return bin
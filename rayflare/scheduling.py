@@ -0,0 +1,264 @@
+import numpy as np
+import os
+import shutil
+import tempfile
+import xarray as xr
+import joblib
+from joblib import Parallel, delayed, effective_n_jobs, dump, load, hash as joblib_hash
+
+# objects attached by this process (in the workers) from a SharedStore, by path
+_attached = {}
+
+# joblib >= 1.4 can yield the results of Parallel in the order in which the tasks finish, joblib 1.3 only in the
+# order of the tasks, and older versions return all the results at the end
+_joblib_version = tuple(int(x) for x in joblib.__version__.split('.')[:2])
+if _joblib_version >= (1, 4):
+    _return_as = 'generator_unordered'
+elif _joblib_version >= (1, 3):
+    _return_as = 'generator'
+else:
+    _return_as = None
+
+# options which do not change the results of a calculation (see checkpoint_key)
+_scheduling_options = ['parallel', 'n_jobs', 'load_balancing', 'shared_memory', 'checkpoint', 'project_name']
+
+
+def run_tasks(func, args_list, costs, parallel=True, n_jobs=-1, checkpoints=None):
+    """Calls func(*args) for each args in args_list. In parallel, the tasks are dispatched to the workers starting
+    with the most expensive ones (according to costs), so that no expensive task is started at the end of the run
+    while the other workers are idle (longest-processing-time-first scheduling).
+
+    :param func: function to call
+    :param args_list: list of tuples of arguments, one per task
+    :param costs: estimated relative cost of each task
+    :param parallel: whether to run the tasks in parallel with joblib
+    :param n_jobs: number of joblib workers
+    :param checkpoints: optional list with a file path for each task (see checkpoint_paths). The result of each task \
+    is saved to its file as soon as the task is finished, and tasks for which the file already exists (e.g. from a \
+    calculation which was interrupted) are not run again: the saved result is used instead.
+
+    :return: list with the result of each task, in the same order as args_list
+    """
+    results = [None] * len(args_list)
+
+    for i1, result in iter_tasks(func, args_list, costs, parallel, n_jobs, checkpoints):
+        results[i1] = result
+
+    return results
+
+
+def iter_tasks(func, args_list, costs, parallel=True, n_jobs=-1, checkpoints=None):
+    """Generator version of run_tasks: yields (index, result) for each task as soon as it is finished, where index is
+    the position of the task in args_list. The results loaded from checkpoints are yielded first; in parallel, the
+    other results are yielded in the order in which the tasks finish (with joblib >= 1.4; with older versions, in the
+    order in which they are started, and only once all the tasks are finished for joblib < 1.3). If the generator is
+    closed before the end (e.g. by breaking out of a loop over it), the tasks which have not been started are
+    cancelled (joblib >= 1.3).
+
+    The parameters are the same as for run_tasks.
+    """
+    if checkpoints is None:
+        checkpoints = [None] * len(args_list)
+
+    todo = []
+
+    for i1, path in enumerate(checkpoints):
+        if path is not None and os.path.isfile(path):
+            yield i1, load(path)
+        else:
+            todo.append(i1)
+
+    if parallel:
+        order = np.argsort(-np.asarray(costs, dtype=float)[todo], kind='stable')
+        tasks = (delayed(call_task)(todo[i1], func, checkpoints[todo[i1]], *args_list[todo[i1]]) for i1 in order)
+
+        if _return_as is None:
+            yield from Parallel(n_jobs=n_jobs)(tasks)
+        else:
+            yield from Parallel(n_jobs=n_jobs, return_as=_return_as)(tasks)
+
+    else:
+        for i1 in todo:
+            yield call_task(i1, func, checkpoints[i1], *args_list[i1])
+
+
+def checkpoint_paths(folder, wavelengths, key=None):
+    """File paths used by run_tasks to save the result of the calculation at each wavelength (in m), in the folder
+    folder (which is created if necessary).
+
+    :param folder: path of the folder
+    :param wavelengths: wavelengths in m
+    :param key: string identifying the inputs of the calculation, added to the file names (see checkpoint_key), so \
+    that the results saved by a calculation with different inputs are not used
+
+    :return: list of file paths, one per wavelength
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    suffix = '' if key is None else '_' + key
+
+    return [os.path.join(folder, '{:.4f}nm{}.pkl'.format(wl*1e9, suffix)) for wl in wavelengths]
+
+
+def checkpoint_key(options, *args):
+    """Short hash of the user options and of the other inputs of a calculation (e.g. the optical constants and the
+    surfaces), used to name the checkpoint files (see checkpoint_paths). The options which only control how the
+    calculation is run (parallelization, checkpoints) are left out.
+
+    :param options: user options
+    :param args: other inputs of the calculation (any objects which can be pickled)
+
+    :return: string with the first 12 characters of the hash
+    """
+    options = {key: value for key, value in options.items() if key not in _scheduling_options}
+
+    return joblib_hash((options, args))[:12]
+
+
+def ray_blocks(costs, n_reps, n_jobs, chunks_per_job=4):
+    """Number of blocks into which the rays traced for each wavelength are split, so that the blocks of all the
+    wavelengths have similar costs and there are about chunks_per_job blocks per worker.
+
+    :param costs: estimated cost of tracing all the rays for each wavelength
+    :param n_reps: number of repetitions of the grid of ray positions for each wavelength (the rays are split into \
+    blocks of whole repetitions, so this is the maximum number of blocks)
+    :param n_jobs: number of joblib workers
+    :param chunks_per_job: target number of blocks per worker
+
+    :return: array with the number of blocks for each wavelength
+    """
+    costs = np.asarray(costs, dtype=float)
+    n_workers = effective_n_jobs(n_jobs)
+
+    if n_workers == 1:
+        return np.ones(len(costs), dtype=int)
+
+    target = np.sum(costs) / (chunks_per_job * n_workers)
+
+    return np.clip(np.ceil(costs / target), 1, n_reps).astype(int)
+
+
+def ray_tracing_cost(nks, alphas, widths):
+    """Estimated number of passes of a ray through the bulk layers of a stack at each wavelength, used as the relative
+    cost of tracing it. A ray crossing the stack keeps a fraction tau = exp(-sum(alpha*width)) of its intensity,
+    and is assumed to escape with probability 1/n**2 (the escape cone of a Lambertian surface) each time it reaches a
+    surface, for the highest refractive index n in the stack: the expected number of passes is then
+    1/(1 - tau*(1 - 1/n**2)).
+
+    :param nks: complex refractive indices of the media, shape (n_media, n_wavelengths)
+    :param alphas: absorption coefficients of the media, shape (n_media, n_wavelengths), in units of 1/(units of widths)
+    :param widths: widths of the media
+
+    :return: array with the relative cost at each wavelength
+    """
+    tau = np.exp(-np.sum(np.real(alphas) * np.asarray(widths)[:, None], axis=0))
+    n_max = np.max(np.real(nks), axis=0)
+
+    return 1 / (1 - tau * (1 - 1 / n_max**2))
+
+
+def rcwa_cost(size, orders, wavelengths, eps):
+    """Estimated relative cost of an RCWA calculation at each wavelength, taken to be proportional to the number of
+    diffraction orders which propagate in the highest-index medium (at most orders): the number of points of the
+    reciprocal lattice inside a circle of radius n/wavelength.
+
+    :param size: period (for a 1D grating) or lattice vectors ((ax, ay), (bx, by)) of the unit cell, in nm
+    :param orders: number of orders retained in the calculation
+    :param wavelengths: wavelengths in m
+    :param eps: complex permittivities of the media, shape (n_wavelengths, n_media)
+
+    :return: array with the relative cost at each wavelength
+    """
+    size = np.array(size, dtype=float)
+    n_max = np.max(np.real(np.sqrt(eps)), axis=1)
+    k = n_max / (np.asarray(wavelengths) * 1e9)
+
+    if size.ndim == 2:
+        n_propagating = np.pi * abs(np.linalg.det(size)) * k**2
+    else:
+        n_propagating = 2 * np.prod(size) * k
+
+    return np.minimum(n_propagating, orders) + 1
+
+
+def call_task(index, func, checkpoint, *args):
+    """Calls func(*args), replacing any SharedData in args by the object it refers to, and saves the result to the
+    file checkpoint (unless it is None). The result is written to a temporary file which is then renamed, so that a
+    task interrupted while saving its result does not leave an incomplete file. Returns (index, result)."""
+    result = func(*[arg.load() if isinstance(arg, SharedData) else arg for arg in args])
+
+    if checkpoint is not None:
+        dump(result, checkpoint + '.tmp')
+        os.replace(checkpoint + '.tmp', checkpoint)
+
+    return index, result
+
+
+class SharedData:
+    """Reference to an object published by a SharedStore. Only the path of the file is sent to the workers, which
+    load the object with its arrays memory-mapped (read-only), so that all the workers use the same copy of the data
+    in memory. The object is only loaded once by each worker process.
+
+    :param path: path of the file written by joblib.dump
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if self.path not in _attached:
+            # objects from previous calculations are no longer needed
+            folder = os.path.dirname(self.path)
+            for path in [path for path in _attached if os.path.dirname(path) != folder]:
+                del _attached[path]
+
+            _attached[self.path] = load(self.path, mmap_mode='r')
+
+        return _attached[self.path]
+
+
+class SharedStore:
+    """Context manager used to send large read-only objects (surfaces, optical constants, lookup tables...) to the
+    parallel workers without pickling a copy of them for every task. Each object passed to share is written once to
+    a temporary folder with joblib.dump, and replaced in the arguments of the tasks by a SharedData reference
+    (resolved by run_tasks). The folder is deleted on exit. If enabled is False (e.g. for serial calculations), share
+    returns the objects unchanged.
+
+    :param enabled: whether to publish the objects
+    :param temp_folder: folder in which the temporary folder is created. By default, the folder set by the \
+    JOBLIB_TEMP_FOLDER environment variable (like for the arrays memory-mapped by joblib itself) or the system's \
+    temporary folder is used; a folder in a RAM-backed file system (e.g. /dev/shm) avoids writing the data to disk.
+    """
+    def __init__(self, enabled=True, temp_folder=None):
+        self.enabled = enabled
+        self.temp_folder = temp_folder or os.environ.get('JOBLIB_TEMP_FOLDER')
+        self.folder = None
+        self.n_objects = 0
+
+    def __enter__(self):
+        if self.enabled:
+            self.folder = tempfile.mkdtemp(prefix='rayflare_', dir=self.temp_folder)
+        return self
+
+    def __exit__(self, *exc):
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.folder = None
+
+    def share(self, obj):
+        """Publishes obj, and returns a SharedData reference to it (or obj itself if the store is not enabled).
+
+        :param obj: object to publish. xarray Datasets backed by a file are loaded into memory first, so that their \
+        data is also shared.
+        """
+        if self.folder is None or obj is None:
+            return obj
+
+        if isinstance(obj, xr.Dataset):
+            obj = obj.load()
+
+        path = os.path.join(self.folder, '{}.pkl'.format(self.n_objects))
+        self.n_objects += 1
+        dump(obj, path)
+
+        return SharedData(path)
@@ -1,5 +1,5 @@
 from rayflare.ray_tracing.rt import RTSurface
-import math
+from rayflare.ray_tracing.analytic_surfaces import PlaneSurface, PyramidSurface, VGrooveSurface
 import numpy as np
 import os
 
@@ -12,24 +12,8 @@ def regular_pyramids(elevation_angle=55, upright=True, size=1):
     :return:
     """
 
-    char_angle = math.radians(elevation_angle)
-    Lx = size*1
-    Ly = size*1
-    h = Lx*math.tan(char_angle)/2
-    x = np.array([0, Lx/2, Lx, 0, Lx])
-    y = np.array([0, Ly/2, 0, Ly, Ly])
-
-    if upright:
-        z = np.array([0, h, 0, 0, 0])
-
-    if not upright:
-        z = np.array([0, -h, 0, 0, 0])
-
-    Points = np.vstack([x, y, z]).T
-    surf_fi = RTSurface(Points)
-
-    Points_ri = np.vstack([x, y, -z]).T
-    surf_ri = RTSurface(Points_ri)
+    surf_fi = PyramidSurface(elevation_angle, upright, size)
+    surf_ri = PyramidSurface(elevation_angle, not upright, size)
 
     return [surf_fi, surf_ri]
 
@@ -39,15 +23,8 @@ def planar_surface(size = 1):
     :param size:
     :return:
     """
-    Lx = 1*size
-    Ly = 1*size
-    x = np.array([0, Lx, Lx, 0])
-    y = np.array([0, Ly, 0, Ly])
-    z = np.array([0, 0, 0, 0])
-
-    Points = np.vstack([x, y, z]).T
-    surf_fi = RTSurface(Points)
-    surf_ri = RTSurface(Points)
+    surf_fi = PlaneSurface(size)
+    surf_ri = PlaneSurface(size)
 
     return [surf_fi, surf_ri]
 
@@ -83,23 +60,7 @@ def V_grooves(elevation_angle=55, width=1, direction='y'):
     :param direction:
     :return:
     """
-    char_angle = math.radians(elevation_angle)
-    h = width*math.tan(char_angle)/2
-    if direction == 'y':
-        x = np.array([0, width, 0, width, width/2, width/2])
-        y = np.array([0, 0, width, width, 0, 1])
+    surf_fi = VGrooveSurface(elevation_angle, width, direction, True)
+    surf_ri = VGrooveSurface(elevation_angle, width, direction, False)
 
-
-    if direction == 'x':
-        y = np.array([0, width, 0, width, width/2, width/2])
-        x = np.array([0, 0, width, width, 0, 1])
-
-    z = np.array([0, 0, 0, 0, h, h])
-
-    Points = np.vstack([x, y, z]).T
-    surf_fi = RTSurface(Points)
-
-    Points_ri = np.vstack([x, y, -z]).T
-    surf_ri = RTSurface(Points_ri)
-
-    return [surf_fi, surf_ri]
\ No newline at end of file
+    return [surf_fi, surf_ri]
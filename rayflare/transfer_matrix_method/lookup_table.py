@@ -134,3 +134,84 @@ def make_TMM_lookuptable(layers, incidence, transmission, surf_name, options,
         allres.to_netcdf(savepath)
 
     return allres
+
+
+class TMMLookupTable:
+    """Fast lookups in a TMM lookup table (as produced by make_TMM_lookuptable) for the ray-tracer. The R, T and
+    absorption per layer are stored as contiguous numpy arrays indexed as (side, pol, wl, angle(, layer)), and since the
+    angles in the lookup table are evenly spaced, the index of the angle can be calculated directly rather than searched
+    for. Usually, the table is sliced to a single wavelength (using the wavelength method) before ray-tracing.
+
+    :param lookuptable: xarray Dataset produced by make_TMM_lookuptable
+    :param interpolate: if True, values are linearly interpolated between the angles in the lookup table. If False, \
+    the nearest angle in the lookup table is used.
+    """
+    def __init__(self, lookuptable, interpolate=False):
+
+        if lookuptable is None:
+            # used by wavelength() to make a new instance without going through xarray
+            return
+
+        self.sides = np.array(lookuptable.side.data)
+        self.pols = list(lookuptable.pol.data)
+        self.wls = np.array(lookuptable.wl.data)
+        self.angles = np.array(lookuptable.angle.data)
+        self.interpolate = interpolate
+
+        self.R = np.ascontiguousarray(np.real(lookuptable['R'].transpose('side', 'pol', 'wl', 'angle').data))
+        self.T = np.ascontiguousarray(np.real(lookuptable['T'].transpose('side', 'pol', 'wl', 'angle').data))
+        self.Alayer = np.ascontiguousarray(np.real(lookuptable['Alayer'].transpose('side', 'pol', 'wl',
+                                                                                    'angle', 'layer').data))
+        self.n_layers = self.Alayer.shape[-1]
+
+    def wavelength(self, wl):
+        """Returns a new TMMLookupTable containing only the wavelength in the lookup table closest to wl.
+
+        :param wl: wavelength in m
+        """
+        i_wl = np.argmin(np.abs(self.wls - wl * 1e9))
+        sliced = TMMLookupTable(None)
+        sliced.sides = self.sides
+        sliced.pols = self.pols
+        sliced.angles = self.angles
+        sliced.interpolate = self.interpolate
+        sliced.n_layers = self.n_layers
+        sliced.wls = self.wls[i_wl:i_wl+1]
+        sliced.R = np.ascontiguousarray(self.R[:, :, i_wl:i_wl+1])
+        sliced.T = np.ascontiguousarray(self.T[:, :, i_wl:i_wl+1])
+        sliced.Alayer = np.ascontiguousarray(self.Alayer[:, :, i_wl:i_wl+1])
+        return sliced
+
+    def lookup(self, side, pol, theta, wl=None):
+        """Finds R, T and the absorption per layer for the given side(s) of incidence, polarization and local
+        incidence angle(s).
+
+        :param side: side of incidence (1 or -1). Can be a scalar or an array with the same shape as theta.
+        :param pol: polarization ('s', 'p' or 'u')
+        :param theta: local incidence angle(s) in radians. The absolute value is used.
+        :param wl: wavelength in m. Not needed if the table only contains one wavelength.
+
+        :return: R, T, A_per_layer (A_per_layer has an extra final dimension with length equal to the number of layers)
+        """
+        i_side = np.where(side == self.sides[0], 0, 1)
+        i_pol = self.pols.index(pol)
+        i_wl = 0 if wl is None or len(self.wls) == 1 else np.argmin(np.abs(self.wls - wl * 1e9))
+
+        n_angles = len(self.angles)
+        u = (np.abs(theta) - self.angles[0]) / (self.angles[1] - self.angles[0])
+
+        if self.interpolate:
+            i_angle = np.clip(np.floor(u).astype(int), 0, n_angles - 2)
+            f = np.clip(u - i_angle, 0, 1)
+            R = (1 - f) * self.R[i_side, i_pol, i_wl, i_angle] + f * self.R[i_side, i_pol, i_wl, i_angle + 1]
+            T = (1 - f) * self.T[i_side, i_pol, i_wl, i_angle] + f * self.T[i_side, i_pol, i_wl, i_angle + 1]
+            A = (1 - f)[..., None] * self.Alayer[i_side, i_pol, i_wl, i_angle] + \
+                f[..., None] * self.Alayer[i_side, i_pol, i_wl, i_angle + 1]
+
+        else:
+            i_angle = np.clip(np.rint(u).astype(int), 0, n_angles - 1)
+            R = self.R[i_side, i_pol, i_wl, i_angle]
+            T = self.T[i_side, i_pol, i_wl, i_angle]
+            A = self.Alayer[i_side, i_pol, i_wl, i_angle]
+
+        return R, T, A
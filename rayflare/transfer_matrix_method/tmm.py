@@ -1,6 +1,6 @@
 import numpy as np
 from solcore.absorption_calculator import tmm_core_vec as tmm
-from rayflare.angles import make_angle_vector, fold_phi
+from rayflare.angles import angle_grid, fold_phi
 from rayflare.config import results_path
 import os
 import xarray as xr
@@ -33,51 +33,31 @@ def TMM(layers, incidence, transmission, surf_name, options,
 
     def make_matrix_wl(wl):
         # binning into matrix, including phi
-        RT_mat = np.zeros((len(theta_bins_in)*2, len(theta_bins_in)))
-        A_mat = np.zeros((n_layers, len(theta_bins_in)))
+        n_a_in = len(theta_bins_in)
+        RT_mat = np.zeros((n_a_in*2, n_a_in))
 
-        for i1 in range(len(theta_bins_in)):
+        data = allres.sel(wl=wl).loc[dict(angle=theta_lookup)]
 
-            theta = theta_lookup[i1]#angle_vector[i1, 1]
+        R_prob = np.real(data['R'].transpose('pol', 'angle').data[0])
+        T_prob = np.real(data['T'].transpose('pol', 'angle').data[0])
 
-            data = allres.loc[dict(angle=theta, wl=wl)]
+        Alayer_prob = np.real(data['Alayer'].transpose('pol', 'layer', 'angle').data[0])
 
-            R_prob = np.real(data['R'].data.item(0))
-            T_prob = np.real(data['T'].data.item(0))
+        # reflection
+        bin_out_r = grid.overall_bin(theta_bins_in, phis_out)
+        RT_mat[bin_out_r, np.arange(n_a_in)] = R_prob
 
-            Alayer_prob = np.real(data['Alayer'].data)
-            phi_out = phis_out[i1]
+        # transmission
+        with np.errstate(invalid='ignore'):
+            theta_t = np.abs(-np.arcsin((inc.n(wl * 1e-9) / trns.n(wl * 1e-9)) * np.sin(theta_lookup)) + quadrant)
 
-            #print(R_prob, T_prob)
-
-            # reflection
-            phi_int = phi_intv[theta_bins_in[i1]]
-            phi_ind = np.digitize(phi_out, phi_int, right=True) - 1
-            bin_out_r = np.argmin(abs(angle_vector[:, 0] - theta_bins_in[i1])) + phi_ind
-
-            #print(bin_out_r, i1+offset)
-
-            RT_mat[bin_out_r, i1] = R_prob
-            #print(R_prob)
-            # transmission
-            theta_t = np.abs(-np.arcsin((inc.n(wl * 1e-9) / trns.n(wl * 1e-9)) * np.sin(theta_lookup[i1])) + quadrant)
-
-            #print('angle in, transmitted', angle_vector_th[i1], theta_t)
-            # theta switches half-plane (th < 90 -> th >90
-            if ~np.isnan(theta_t):
-
-                theta_out_bin = np.digitize(theta_t, theta_intv, right=True) - 1
-                phi_int = phi_intv[theta_out_bin]
-
-                phi_ind = np.digitize(phi_out, phi_int, right=True) - 1
-                bin_out_t = np.argmin(abs(angle_vector[:, 0] - theta_out_bin)) + phi_ind
-
-                RT_mat[bin_out_t, i1] = T_prob
-                #print(bin_out_t, i1+offset)
-
-            # absorption
-            A_mat[:, i1] = Alayer_prob
+        # theta switches half-plane (th < 90 -> th >90
+        transmitted = ~np.isnan(theta_t)
+        bin_out_t = grid.angle_bin(theta_t[transmitted], phis_out[transmitted])
+        RT_mat[bin_out_t, np.arange(n_a_in)[transmitted]] = T_prob[transmitted]
 
+        # absorption
+        A_mat = Alayer_prob
 
         fullmat = COO(RT_mat)
         A_mat = COO(A_mat)
@@ -105,7 +85,8 @@ def TMM(layers, incidence, transmission, surf_name, options,
 
         wavelengths = options['wavelengths']*1e9 # convert to nm
 
-        theta_intv, phi_intv, angle_vector = make_angle_vector(options['n_theta_bins'], options['phi_symmetry'], options['c_azimuth'])
+        grid = angle_grid(options['n_theta_bins'], options['phi_symmetry'], options['c_azimuth'])
+        angle_vector = grid.angle_vector
         angles_in = angle_vector[:int(len(angle_vector) / 2), :]
         thetas = np.unique(angles_in[:, 1])
 
@@ -251,7 +232,7 @@ def TMM(layers, incidence, transmission, surf_name, options,
 
         phis_out[phis_out == 0] = 1e-10
 
-        theta_bins_in = np.digitize(angle_vector_th, theta_intv, right=True) -1
+        theta_bins_in = grid.theta_bin(angle_vector_th)
 
         #print(theta_bins_in)
         mats = [make_matrix_wl(wl) for wl in wavelengths]
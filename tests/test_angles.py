@@ -0,0 +1,50 @@
+from pytest import approx
+import numpy as np
+
+
+def test_angle_bin():
+    from rayflare.angles import make_angle_vector, angle_bin, accumulate_bins
+
+    theta_intv, phi_intv, angle_vector = make_angle_vector(20, np.pi/4, 0.5)
+
+    np.random.seed(4)
+    thetas = np.random.rand(1000) * np.pi
+    phis = np.random.rand(1000) * np.pi/4
+
+    # bin centres and edges
+    thetas = np.concatenate((thetas, angle_vector[:, 1], theta_intv[1:]))
+    phis = np.concatenate((phis, angle_vector[:, 2], np.full(len(theta_intv) - 1, np.pi/8)))
+
+    bins = angle_bin(thetas, phis, theta_intv, phi_intv)
+
+    theta_bins = np.digitize(thetas, theta_intv, right=True) - 1
+    expected = [np.argmax(angle_vector[:, 0] == theta_bins[i1]) +
+                np.digitize(phi, phi_intv[theta_bins[i1]], right=True) - 1 for i1, phi in enumerate(phis)]
+
+    assert np.array_equal(bins, expected)
+    assert np.array_equal(bins[1000:1000 + len(angle_vector)], np.arange(len(angle_vector)))
+
+    counts = accumulate_bins(bins, np.zeros(len(bins), dtype=int), len(angle_vector), 1)
+    assert np.sum(counts) == len(bins)
+    assert counts[:, 0] == approx(np.bincount(bins, minlength=len(angle_vector)))
+
+
+def test_angle_grid():
+    from rayflare.angles import make_angle_vector, angle_grid
+    import pytest
+
+    grid = angle_grid(20, np.pi/4, 0.5)
+    theta_intv, phi_intv, angle_vector = make_angle_vector(20, np.pi/4, 0.5)
+
+    assert angle_grid(20, np.pi/4, 0.5) is grid
+    assert np.array_equal(grid.angle_vector, angle_vector)
+    assert np.array_equal(grid.theta_intv, theta_intv)
+    assert grid.n_a_in == len(angle_vector) / 2
+
+    # first bin of each theta bin
+    assert np.array_equal(grid.global_index(np.arange(40), 0),
+                          [np.argmax(angle_vector[:, 0] == i1) for i1 in range(40)])
+    assert np.array_equal(grid.angle_bin(angle_vector[:, 1], angle_vector[:, 2]), np.arange(len(angle_vector)))
+
+    with pytest.raises(ValueError):
+        grid.angle_vector[0, 0] = 1
@@ -0,0 +1,231 @@
+from pytest import approx
+import numpy as np
+
+
+def test_batched_products():
+    from sparse import COO, dot
+    from rayflare.matrix_formalism.multiply_matrices import dot_wl, dot_wl_u2d, batch_wl
+
+    np.random.seed(1)
+    num_wl, n_out, n_in = 7, 12, 10
+
+    mats = np.random.rand(num_wl, n_out, n_in)
+    mats[mats < 0.7] = 0
+    mat = COO(mats)
+    shared_mat = COO(mats[0, :n_in])
+    vec = np.random.rand(num_wl, n_in)
+
+    # the same results as the products at each wavelength, to the last bit
+    assert np.array_equal(dot_wl(batch_wl(mat), vec), np.stack([dot(mat[i1], vec[i1]) for i1 in range(num_wl)]))
+    assert np.array_equal(dot_wl(batch_wl(mat), vec), dot_wl(mat, vec))
+    assert np.array_equal(dot_wl_u2d(batch_wl(shared_mat), vec), dot_wl_u2d(shared_mat, vec))
+    assert dot_wl(batch_wl(mat), vec) == approx(np.einsum('wij,wj->wi', mats, vec))
+
+
+def test_select_wl():
+    from sparse import COO
+    from rayflare.matrix_formalism.multiply_matrices import dot_wl, batch_wl, select_wl
+
+    np.random.seed(3)
+    num_wl, n_out, n_in = 6, 8, 5
+
+    mats = np.random.rand(num_wl, n_out, n_in)
+    mats[mats < 0.6] = 0
+    mat = batch_wl(COO(mats))
+    shared_mat = batch_wl(COO(mats[0]))
+    vec = np.random.rand(num_wl, n_in)
+    active = np.array([True, False, False, True, True, False])
+
+    assert np.array_equal(dot_wl(select_wl(mat, active, n_in), vec[active]), dot_wl(mat, vec)[active])
+    assert select_wl(shared_mat, active, n_in) is shared_mat
+
+
+def test_fused_operators():
+    from sparse import COO, stack
+    from rayflare.angles import angle_grid
+    from rayflare.matrix_formalism.multiply_matrices import dot_wl, dot_wl_u2d, batch_wl, make_D, row_block, \
+        stack_wl, split_wl, out_to_in_matrix, permutation_index, permute_wl
+
+    np.random.seed(4)
+    num_wl, n_in = 5, 9
+
+    mats = np.random.rand(num_wl, 2*n_in, n_in)
+    mats[mats < 0.6] = 0
+    mat = COO(mats)
+    vec = np.random.rand(num_wl, n_in)
+
+    def same(x, y):
+        return x.shape == y.shape and np.array_equal(x.coords, y.coords) and np.array_equal(x.data, y.data)
+
+    R, T = row_block(mat, 0, n_in), row_block(mat, n_in, 2*n_in)
+    assert same(R, mat[:, :n_in, :]) and same(T, mat[:, n_in:, :])
+
+    # the matrices which are the same for all the wavelengths are repeated
+    mats_stacked = [batch_wl(R), batch_wl(COO(mats[0, n_in:])), batch_wl(T)]
+    stacked, n_outs = stack_wl(mats_stacked, num_wl, n_in)
+    for product, single in zip(split_wl(dot_wl(stacked, vec), n_outs), mats_stacked):
+        assert np.array_equal(product, dot_wl(single, vec))
+
+    alphas = np.random.rand(num_wl)*1e4
+    thetas = np.random.rand(n_in)
+    assert same(make_D(alphas, 1e-4, thetas), stack([COO(np.diag(x)) for x in
+                                                     np.exp(-alphas[:, None]*1e-4/abs(np.cos(thetas[None, :])))]))
+
+    grid = angle_grid(10, np.pi/2, 0.25)
+    for perm in out_to_in_matrix(np.pi/2, grid.angle_vector, grid.theta_intv, grid.phi_intv):
+        perm = batch_wl(perm)
+        vec = np.random.rand(num_wl, grid.n_a_in)
+        assert np.array_equal(permute_wl(perm, permutation_index(perm), vec), dot_wl_u2d(perm, vec))
+
+
+def test_bounce_series():
+    from sparse import COO
+    from rayflare.matrix_formalism.multiply_matrices import batch_wl, bounce_series, dot_wl
+
+    np.random.seed(2)
+    num_wl, n = 4, 6
+
+    def random_matrix(scale):
+        mats = np.random.rand(num_wl, n, n)
+        mats[mats < 0.5] = 0
+        return batch_wl(COO(scale*mats/np.sum(mats, 1)[:, None, :]))
+
+    D = batch_wl(COO(np.stack([np.diag(x) for x in np.random.rand(num_wl, n)])))
+    Rf_back, Rb_front = random_matrix(0.9), random_matrix(0.8)
+    perm = batch_wl(COO(np.eye(n)[np.random.permutation(n)]))
+    vf = np.random.rand(num_wl, n)
+
+    # sum of the passes
+    total = np.zeros_like(vf)
+    v = vf
+    for i1 in range(200):
+        total += v
+        for mat in [perm, D, Rf_back, D, perm, Rb_front]:
+            v = dot_wl(mat, v)
+
+    for solver in ['direct', 'iterative']:
+        assert bounce_series(vf, D, Rf_back, Rb_front, perm, perm, solver) == approx(total, rel=1e-8)
+
+
+def test_bulk_solver():
+    import os
+    import shutil
+    from solcore import material, si
+    from rayflare.structure import Interface, BulkLayer, Structure
+    from rayflare.matrix_formalism.process_structure import process_structure
+    from rayflare.matrix_formalism.multiply_matrices import calculate_RAT
+    from rayflare.textures import regular_pyramids
+    from rayflare.options import default_options
+    from rayflare.config import results_path
+
+    Air = material('Air')()
+    Si = material('Si')()
+    Ag = material('Ag')()
+
+    options = default_options()
+    options.wavelengths = np.array([900, 1050, 1150]) * 1e-9
+    options.nx = 3
+    options.ny = 3
+    options.n_rays = 9*100
+    options.n_theta_bins = 10
+    options.parallel = False
+    options.project_name = 'test_bulk_solver'
+
+    front = Interface('RT_Fresnel', texture=regular_pyramids(), layers=[], name='front')
+    back = Interface('RT_Fresnel', texture=regular_pyramids(10, upright=False), layers=[], name='back')
+    SC = Structure([front, BulkLayer(si('200um'), Si), back], incidence=Air, transmission=Ag)
+
+    process_structure(SC, options)
+
+    options.I_thresh = 1e-9
+    RAT, results_per_pass = calculate_RAT(SC, options)
+
+    for solver in ['direct', 'iterative']:
+        options.bulk_solver = solver
+        RAT_solver, results_per_pass_solver = calculate_RAT(SC, options)
+
+        assert results_per_pass_solver is None
+        for quantity in ['R', 'A_bulk', 'T']:
+            assert RAT_solver[quantity].data == approx(RAT[quantity].data, abs=1e-8)
+
+    # only the totals are kept
+    options.bulk_solver = 'passes'
+    options.results_per_pass = False
+    RAT_totals, results_per_pass_totals = calculate_RAT(SC, options)
+
+    assert results_per_pass_totals is None
+    assert RAT_totals['A_bulk'].data == approx(RAT['A_bulk'].data, rel=1e-12)
+
+    shutil.rmtree(os.path.join(results_path, options.project_name))
+
+
+def test_multi_incidence():
+    import os
+    import shutil
+    from solcore import material, si
+    from rayflare.structure import Interface, BulkLayer, Structure
+    from rayflare.matrix_formalism.process_structure import process_structure
+    from rayflare.matrix_formalism.multiply_matrices import calculate_RAT, make_v0
+    from rayflare.textures import regular_pyramids
+    from rayflare.options import default_options
+    from rayflare.config import results_path
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.array([500, 1000, 1100]) * 1e-9
+    options.nx = 3
+    options.ny = 3
+    options.n_rays = 9*100
+    options.n_theta_bins = 10
+    options.parallel = False
+    options.project_name = 'test_multi_incidence'
+
+    front = Interface('RT_Fresnel', texture=regular_pyramids(), layers=[], name='front')
+    back = Interface('RT_Fresnel', texture=regular_pyramids(10, upright=False), layers=[], name='back')
+    SC = Structure([front, BulkLayer(si('200um'), Si), back], incidence=Air, transmission=Air)
+
+    process_structure(SC, options)
+
+    thetas = np.array([0, 0.4, 0.8])
+    phis = [0, 'all', 0.3]
+
+    for solver, tol in [('direct', 1e-12), ('passes', options.I_thresh)]:
+        options.bulk_solver = solver
+        options.theta_in = thetas
+        options.phi_in = phis
+        RAT, results_per_pass = calculate_RAT(SC, options)
+
+        assert RAT['R'].dims == ('bulk_index', 'wl', 'incidence')
+        assert np.array_equal(RAT['theta_in'], thetas)
+        assert list(RAT['phi_in'].data) == phis
+
+        v0 = make_v0(thetas, phis, 1, options.n_theta_bins, options.c_azimuth, options.phi_symmetry)[0]
+        RAT_distribution, _ = calculate_RAT(SC, options, incidence=v0)
+        assert 'theta_in' not in RAT_distribution.coords
+
+        for i1, (theta, phi) in enumerate(zip(thetas, phis)):
+            options.theta_in = theta
+            options.phi_in = phi
+            RAT_single, _ = calculate_RAT(SC, options)
+
+            # with the pass loop, the wavelengths are only removed once the power left is below I_thresh for all
+            # the incidences
+            for quantity in ['R', 'A_bulk', 'T']:
+                assert RAT[quantity].isel(incidence=i1).data == approx(RAT_single[quantity].data, abs=tol)
+                assert np.array_equal(RAT_distribution[quantity].isel(incidence=i1), RAT[quantity].isel(incidence=i1))
+
+    # a single phi_in is used for all the incidences
+    v0 = make_v0(thetas, 0.3, 2, options.n_theta_bins, options.c_azimuth, options.phi_symmetry)
+    assert v0.shape[:2] == (2, 3)
+    for i1, theta in enumerate(thetas):
+        assert np.array_equal(v0[:, i1], make_v0(theta, 0.3, 2, options.n_theta_bins, options.c_azimuth,
+                                                 options.phi_symmetry))
+
+    options.theta_in = thetas
+    options.phi_in = 0.3
+    RAT, _ = calculate_RAT(SC, options)
+    assert RAT['phi_in'].data == approx([0.3, 0.3, 0.3])
+
+    shutil.rmtree(os.path.join(results_path, options.project_name))
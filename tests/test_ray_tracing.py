@@ -0,0 +1,893 @@
+from pytest import approx
+import numpy as np
+
+
+def test_planar_packets():
+    from solcore import material, si
+    from rayflare.ray_tracing.rt import rt_structure
+    from rayflare.textures import planar_surface
+    from rayflare.options import default_options
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.array([500, 700]) * 1e-9
+    options.nx = 5
+    options.ny = 5
+    options.n_rays = 2000
+    options.parallel = False
+    options.depth_spacing = si('10um')
+
+    rtstr = rt_structure(textures=[planar_surface(), planar_surface()], materials=[Si],
+                         widths=[si('100um')], incidence=Air, transmission=Air)
+
+    n_Si = Si.n(options.wavelengths) + 1j*Si.k(options.wavelengths)
+    R_expected = np.abs((1 - n_Si)/(1 + n_Si))**2
+
+    options.ray_packets = True
+    result_packets = rtstr.calculate(options)
+
+    options.ray_packets = False
+    options.n_rays = 500
+    result_single = rtstr.calculate(options)
+
+    # all light entering the Si is absorbed at these wavelengths
+    assert result_packets['R'] == approx(R_expected, abs=0.05)
+    assert result_single['R'] == approx(R_expected, abs=0.08)
+    assert result_packets['R'] + result_packets['A_per_layer'][:, 0] == approx(1, abs=1e-6)
+    assert result_packets['T'] == approx(0, abs=1e-6)
+
+
+def test_surface_grid():
+    from rayflare.ray_tracing.rt import RTSurface, check_intersect
+    from rayflare.ray_tracing.ray_packets import check_intersect_packet
+
+    np.random.seed(1)
+    x, y = np.meshgrid(np.linspace(0, 10, 30), np.linspace(0, 10, 30))
+    Points = np.stack([x.flatten(), y.flatten(), 3*np.random.rand(x.size)], axis=1)
+
+    surf_grid = RTSurface(Points)
+    surf_dense = RTSurface(Points, grid_size=False)
+    assert surf_dense.grid is None and not hasattr(surf_dense, 'cell_triangles')
+
+    n_rays = 500
+    r_a = np.stack([10*np.random.rand(n_rays), 10*np.random.rand(n_rays), np.full(n_rays, 4)], axis=1)
+    theta = 1.4*np.random.rand(n_rays)
+    phi = 2*np.pi*np.random.rand(n_rays)
+    d = np.stack([np.sin(theta)*np.cos(phi), np.sin(theta)*np.sin(phi), -np.cos(theta)], axis=1)
+
+    assert surf_grid.grid is not None
+    t_grid, ind_grid = check_intersect_packet(r_a, d, surf_grid)
+    t_dense, ind_dense = check_intersect_packet(r_a, d, surf_dense)
+    assert np.array_equal(t_grid, t_dense)
+    assert np.array_equal(ind_grid, ind_dense)
+
+    for i1 in range(20):
+        res_grid = check_intersect(r_a[i1], d[i1], surf_grid)
+        res_dense = check_intersect(r_a[i1], d[i1], surf_dense)
+        if res_dense is False:
+            assert res_grid is False
+        else:
+            assert res_grid[0] == approx(res_dense[0])
+
+    # offset surfaces keep the grid settings
+    surf_coarse = RTSurface(Points, grid_size=(3, 4))
+    assert surf_coarse.offset(-2).grid == (3, 4)
+    surf_offset = surf_dense.offset(-2)
+    assert surf_offset.grid is None and not hasattr(surf_offset, 'cell_triangles')
+    assert surf_grid.offset(-2).grid == surf_grid.grid
+
+
+def test_periodic_intersection():
+    from rayflare.ray_tracing.rt import RTSurface, check_intersect_periodic
+    from rayflare.ray_tracing.ray_packets import check_intersect_packet, check_intersect_periodic_packet
+
+    np.random.seed(6)
+    x, y = np.meshgrid(np.linspace(0, 10, 8), np.linspace(0, 10, 8))
+    # periodic surface: the heights on opposite edges of the unit cell are the same
+    z = 3*np.random.rand(8, 8)
+    z[-1] = z[0]
+    z[:, -1] = z[:, 0]
+    Points = np.stack([x.flatten(), y.flatten(), z.flatten()], axis=1)
+    surf = RTSurface(Points)
+
+    n_rays = 300
+    theta = 1.3*np.random.rand(n_rays)
+    phi = 2*np.pi*np.random.rand(n_rays)
+    d = np.stack([np.sin(theta)*np.cos(phi), np.sin(theta)*np.sin(phi), -np.cos(theta)], axis=1)
+    r_a = np.stack([30*np.random.rand(n_rays) - 10, 30*np.random.rand(n_rays) - 10, np.full(n_rays, 4)], axis=1)
+
+    # closest intersection with explicit copies of the surface in the neighbouring unit cells
+    t_all = [check_intersect_packet(r_a - [10*i1, 10*i2, 0], d, surf)[0] for i1 in range(-5, 6) for i2 in range(-5, 6)]
+    t_expected = np.min(t_all, axis=0)
+
+    t, ind = check_intersect_periodic_packet(r_a, d, surf)
+    assert np.all(np.isfinite(t))
+    assert t == approx(t_expected)
+
+    for i1 in range(20):
+        res = check_intersect_periodic(r_a[i1], d[i1], surf)
+        assert res[0] == approx(r_a[i1] + t_expected[i1]*d[i1])
+
+    # rays travelling away from the surface
+    t, _ = check_intersect_periodic_packet(r_a, -d, surf)
+    assert np.all(np.isinf(t))
+
+
+def test_analytic_surfaces():
+    from rayflare.ray_tracing.rt import RTSurface
+    from rayflare.ray_tracing.analytic_surfaces import FacetedSurface
+    from rayflare.ray_tracing.ray_packets import check_intersect_periodic_packet
+    from rayflare.textures import regular_pyramids, V_grooves, planar_surface
+
+    np.random.seed(7)
+    n_rays = 2000
+
+    for surf in regular_pyramids() + regular_pyramids(40, False, 2) + V_grooves() + V_grooves(direction='x') + \
+            planar_surface():
+        assert isinstance(surf, FacetedSurface)
+        surf_tri = RTSurface(surf.Points)
+
+        theta = np.arccos(2*np.random.rand(n_rays) - 1)
+        phi = 2*np.pi*np.random.rand(n_rays)
+        d = np.stack([np.sin(theta)*np.cos(phi), np.sin(theta)*np.sin(phi), np.cos(theta)], axis=1)
+        r_a = np.stack([surf.Lx*np.random.rand(n_rays), surf.Ly*np.random.rand(n_rays),
+                        surf.z_min - 0.5 + (surf.z_max - surf.z_min + 1)*np.random.rand(n_rays)], axis=1)
+
+        t, ind = check_intersect_periodic_packet(r_a, d, surf)
+        t_tri, ind_tri = check_intersect_periodic_packet(r_a, d, surf_tri)
+
+        hit = np.isfinite(t_tri)
+        assert np.array_equal(np.isfinite(t), hit)
+        assert t[hit] == approx(t_tri[hit])
+        assert surf.crossP[ind[hit]] == approx(surf_tri.crossP[ind_tri[hit]])
+
+
+def test_invariant_surface():
+    from rayflare.ray_tracing.analytic_surfaces import FacetedSurface
+    from rayflare.ray_tracing.ray_packets import check_intersect_periodic_packet
+    from rayflare.textures import V_grooves
+    from rayflare.angles import fold_phi, fold_phi_mirror, angle_grid
+    from rayflare.ray_tracing import rt
+
+    np.random.seed(8)
+    n_rays = 2000
+
+    for surf in V_grooves() + V_grooves(40, 2, 'x'):
+        assert surf.invariant_axis is not None
+        surf_3D = FacetedSurface(surf.Points)
+
+        theta = np.arccos(2*np.random.rand(n_rays) - 1)
+        phi = 2*np.pi*np.random.rand(n_rays)
+        d = np.stack([np.sin(theta)*np.cos(phi), np.sin(theta)*np.sin(phi), np.cos(theta)], axis=1)
+        r_a = np.stack([6*np.random.rand(n_rays) - 2, 6*np.random.rand(n_rays) - 2,
+                        surf.z_min - 0.5 + (surf.z_max - surf.z_min + 1)*np.random.rand(n_rays)], axis=1)
+
+        t, ind = check_intersect_periodic_packet(r_a, d, surf)
+        t_3D, ind_3D = check_intersect_periodic_packet(r_a, d, surf_3D)
+
+        hit = np.isfinite(t_3D)
+        assert np.array_equal(np.isfinite(t), hit)
+        assert t[hit] == approx(t_3D[hit])
+        assert surf.crossP[ind[hit]] == approx(surf_3D.crossP[ind_3D[hit]])
+
+    phis = np.array([0.1, np.pi - 0.1, np.pi + 0.1, -0.1, np.pi/2 + 0.1])
+    assert fold_phi_mirror(phis) == approx([0.1, 0.1, 0.1, 0.1, np.pi/2 - 0.1])
+
+    # the azimuthal angles are only folded with the mirror symmetry if the angle grid covers 0 to pi/2; otherwise
+    # they are folded into 0 to phi_symmetry, so they are not all put in the last phi bin
+    phis = 2*np.pi*np.random.rand(n_rays)
+    assert rt.fold_phi_surfaces(phis, V_grooves(), np.pi/2) == approx(fold_phi_mirror(phis))
+    phis_folded = rt.fold_phi_surfaces(phis, V_grooves(), np.pi/4)
+    assert np.all(phis_folded < np.pi/4)
+    assert phis_folded == approx(fold_phi(phis, np.pi/4))
+
+    grid = angle_grid(10, np.pi/4, 0.25)
+    bins = rt.incidence_bins(np.full(n_rays, 0.5), phis, grid, V_grooves(), np.pi/4, 1)
+    assert np.array_equal(bins, grid.angle_bin(np.full(n_rays, 0.5), fold_phi(phis, np.pi/4)))
+    assert len(np.unique(bins)) > 1
+
+
+def test_lookuptable_interpolation():
+    import xarray as xr
+    from rayflare.transfer_matrix_method.lookup_table import TMMLookupTable
+
+    sides = [1, -1]
+    pols = ['s', 'p', 'u']
+    wls = np.array([500, 600, 700])
+    angles = np.linspace(0, np.pi/2, 50)
+    shape = (len(sides), len(pols), len(wls), len(angles))
+    coords = {'side': sides, 'pol': pols, 'wl': wls, 'angle': angles}
+
+    np.random.seed(2)
+    R = xr.DataArray(np.random.rand(*shape), dims=['side', 'pol', 'wl', 'angle'], coords=coords, name='R')
+    T = xr.DataArray(np.random.rand(*shape), dims=['side', 'pol', 'wl', 'angle'], coords=coords, name='T')
+    Alayer = xr.DataArray(np.random.rand(*shape, 2), dims=['side', 'pol', 'wl', 'angle', 'layer'],
+                          coords=dict(coords, layer=[1, 2]), name='Alayer')
+    lookuptable = xr.merge([R, T, Alayer])
+
+    thetas = np.random.rand(100) * np.pi / 2
+
+    nearest = TMMLookupTable(lookuptable).wavelength(610e-9)
+    interp = TMMLookupTable(lookuptable, interpolate=True)
+
+    for side in sides:
+        for pol in pols:
+            data = lookuptable.loc[dict(side=side, pol=pol)].sel(angle=xr.DataArray(thetas, dims='ray'),
+                                                                 wl=610, method='nearest')
+            R_n, T_n, A_n = nearest.lookup(side, pol, thetas)
+            assert R_n == approx(data['R'].data)
+            assert T_n == approx(data['T'].data)
+            assert A_n == approx(data['Alayer'].transpose('ray', 'layer').data)
+
+            data = lookuptable.loc[dict(side=side, pol=pol)].sel(wl=700).interp(angle=thetas)
+            R_i, T_i, A_i = interp.lookup(side, pol, thetas, 700e-9)
+            assert R_i == approx(data['R'].data)
+            assert A_i == approx(data['Alayer'].transpose('angle', 'layer').data)
+
+
+def test_profile_tally():
+    from rayflare.ray_tracing.profile_tally import ProfileTally
+
+    widths = [0, 10, 5, 0]
+    z_pos = np.arange(0, 15, 0.01)
+    alpha = 0.3
+    theta = 0.4
+
+    tally = ProfileTally(widths)
+    tally.add(1, 1, theta, alpha, 1)
+    tally.add(np.array([1, 2]), np.array([-1, 1]), np.array([theta, 0.1]), alpha, np.array([0.5, 0.2]))
+
+    a = alpha/np.cos(theta)
+    expected = np.zeros(len(z_pos))
+    in_1 = z_pos < 10
+    expected[in_1] = a*np.exp(-a*z_pos[in_1]) + 0.5*a*np.exp(-a*(10 - z_pos[in_1]))
+    a = alpha/np.cos(0.1)
+    expected[~in_1] = 0.2*a*np.exp(-a*(z_pos[~in_1] - 10))
+
+    assert tally.profile(z_pos) == approx(expected)
+
+
+def test_adaptive_n_rays():
+    from solcore import material, si
+    from rayflare.ray_tracing.rt import rt_structure
+    from rayflare.ray_tracing.convergence import RunningStats
+    from rayflare.textures import regular_pyramids, planar_surface
+    from rayflare.options import default_options
+
+    np.random.seed(3)
+    samples = np.random.rand(1000, 3)
+    stats = RunningStats(3)
+    for i1 in range(0, 1000, 300):
+        stats.update(samples[i1:i1 + 300])
+
+    assert stats.mean == approx(np.mean(samples, 0))
+    assert stats.std_error() == approx(np.std(samples, 0, ddof=1)/np.sqrt(1000))
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.array([400, 1100]) * 1e-9
+    options.nx = 5
+    options.ny = 5
+    options.n_rays = 500
+    options.parallel = False
+    options.ray_packets = True
+    options.n_rays_tol = 0.008
+    options.n_rays_max = 20000
+
+    rtstr = rt_structure(textures=[regular_pyramids(), planar_surface()], materials=[Si],
+                         widths=[si('100um')], incidence=Air, transmission=Air)
+
+    result = rtstr.calculate(options)
+
+    assert np.all(result['R_err'] <= 0.008)
+    assert np.all(result['A_per_layer_err'] <= 0.008)
+    assert np.all(result['n_rays'] % 500 == 0)
+    assert result['n_rays'][1] > 500
+    assert result['thetas'].shape == (2, np.max(result['n_rays']))
+    assert result['R'] + result['T'] + result['A_per_layer'][:, 0] == approx(1, abs=0.02)
+
+
+def test_sampling():
+    from rayflare.ray_tracing.sampling import sample_points, decision_numbers
+
+    np.random.seed(4)
+    for sequence in ['random', 'sobol', 'stratified']:
+        points = sample_points(100, 2, sequence)
+        assert points.shape == (100, 2)
+        assert np.all((points >= 0) & (points < 1))
+
+    # one point in each interval
+    points = sample_points(50, 2, 'stratified')
+    assert np.all(np.sort(np.floor(points*50), 0) == np.arange(50)[:, None])
+
+    rnd = decision_numbers(101, 'stratified')
+    assert np.array_equal(np.sort(np.floor(rnd*101)), np.arange(101))
+
+    rnd = decision_numbers(100, 'antithetic')
+    assert np.sum(rnd) == approx(50)
+
+
+def test_ray_splitting():
+    from solcore import material, si
+    from rayflare.ray_tracing.rt import rt_structure
+    from rayflare.textures import planar_surface, regular_pyramids
+    from rayflare.options import default_options
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.array([900, 1000, 1100]) * 1e-9
+    options.nx = 1
+    options.ny = 1
+    options.n_rays = 1
+    options.parallel = False
+    options.ray_splitting = True
+    options.splitting_max_depth = 50
+    options.I_thresh = 1e-7
+
+    d = si('200um')
+    rtstr = rt_structure(textures=[planar_surface(), planar_surface()], materials=[Si],
+                         widths=[d], incidence=Air, transmission=Air)
+
+    result = rtstr.calculate(options)
+
+    # incoherent slab
+    n = Si.n(options.wavelengths)
+    R = ((n - 1)/(n + 1))**2
+    tau = np.exp(-Si.alpha(options.wavelengths)*d)
+
+    assert result['R'] == approx(R + (1 - R)**2*R*tau**2/(1 - R**2*tau**2), abs=1e-5)
+    assert result['T'] == approx((1 - R)**2*tau/(1 - R**2*tau**2), abs=1e-5)
+    assert result['R'] + result['T'] + result['A_per_layer'][:, 0] == approx(1, abs=1e-5)
+
+    # weakly absorbing textured case with the default I_thresh: low-weight branches are only terminated by Russian
+    # roulette, so no light is lost
+    options.wavelengths = np.array([1075, 1150]) * 1e-9
+    options.nx = 10
+    options.ny = 10
+    options.n_rays = 2000
+    options.splitting_max_depth = 8
+    options.I_thresh = 1e-2
+    rtstr = rt_structure(textures=[regular_pyramids(), planar_surface()], materials=[Si],
+                         widths=[d], incidence=Air, transmission=Air)
+
+    np.random.seed(3)
+    result = rtstr.calculate(options)
+    assert result['R'] + result['T'] + result['A_per_layer'][:, 0] == approx(1, abs=0.003)
+
+
+def test_russian_roulette():
+    from solcore import material, si
+    from rayflare.ray_tracing.rt import rt_structure
+    from rayflare.textures import planar_surface
+    from rayflare.options import default_options
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.array([1000, 1100]) * 1e-9
+    options.nx = 1
+    options.ny = 1
+    options.n_rays = 2000
+    options.parallel = False
+    options.ray_splitting = True
+    options.I_thresh = 0.05
+    options.roulette_survival = 0.2
+
+    d = si('200um')
+    rtstr = rt_structure(textures=[planar_surface(), planar_surface()], materials=[Si],
+                         widths=[d], incidence=Air, transmission=Air)
+
+    n = Si.n(options.wavelengths)
+    R = ((n - 1)/(n + 1))**2
+    tau = np.exp(-Si.alpha(options.wavelengths)*d)
+    R_slab = R + (1 - R)**2*R*tau**2/(1 - R**2*tau**2)
+
+    np.random.seed(5)
+    result_cutoff = rtstr.calculate(options)
+
+    options.russian_roulette = True
+    np.random.seed(5)
+    result_roulette = rtstr.calculate(options)
+
+    # with splitting, the branches are not stopped in the bulk (only by Russian roulette at the surfaces), so no
+    # intensity is lost with or without Russian roulette in the bulk
+    for result in [result_cutoff, result_roulette]:
+        assert result['R'] + result['T'] + result['A_per_layer'][:, 0] == approx(1, abs=0.003)
+        assert result['R'] == approx(R_slab, abs=0.003)
+
+
+def test_russian_roulette_no_splitting():
+    from solcore import material, si
+    from rayflare.ray_tracing.rt import rt_structure
+    from rayflare.textures import planar_surface
+    from rayflare.options import default_options
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.array([1000, 1100]) * 1e-9
+    options.nx = 1
+    options.ny = 1
+    options.n_rays = 4000
+    options.parallel = False
+    options.roulette_survival = 0.2
+
+    d = si('200um')
+    rtstr = rt_structure(textures=[planar_surface(), planar_surface()], materials=[Si],
+                         widths=[d], incidence=Air, transmission=Air)
+
+    # without splitting, each ray makes random reflection/transmission decisions, so the results with Russian
+    # roulette are only the same as without it (and with a low intensity threshold) within the Monte Carlo error
+    for ray_packets in [True, False]:
+        options.ray_packets = ray_packets
+
+        options.I_thresh = 1e-3
+        options.russian_roulette = False
+        np.random.seed(2)
+        result_ref = rtstr.calculate(options)
+
+        options.I_thresh = 0.5
+        np.random.seed(2)
+        result_cutoff = rtstr.calculate(options)
+
+        options.russian_roulette = True
+        np.random.seed(2)
+        result_roulette = rtstr.calculate(options)
+
+        # at 1000 nm, rays are stopped after a single pass through the Si, so nothing is transmitted with a hard cutoff
+        assert result_cutoff['T'][0] == 0
+        assert result_ref['T'][0] > 0.1
+
+        assert result_roulette['R'] == approx(result_ref['R'], abs=0.04)
+        assert result_roulette['T'] == approx(result_ref['T'], abs=0.04)
+        assert result_roulette['A_per_layer'][:, 0] == approx(result_ref['A_per_layer'][:, 0], abs=0.04)
+
+
+def test_first_hit_cache():
+    from rayflare.ray_tracing.rt import first_intersection, launch_offset
+    from rayflare.ray_tracing.ray_packets import first_intersection_packet, ray_packet_stack
+    from rayflare.textures import regular_pyramids, planar_surface
+
+    front = regular_pyramids()[0]
+    surfaces = [front, planar_surface()[0].offset(-20)]
+    xs, ys = np.meshgrid(np.linspace(0.01, 0.99, 6), np.linspace(0.02, 0.98, 6))
+    xs, ys = xs.flatten(), ys.flatten()
+    r_a_0 = launch_offset(0.4, 0.3, max(front.Points[:, 2]))
+
+    t, ind = first_intersection_packet(xs, ys, r_a_0, front)
+    assert np.all(np.isfinite(t))
+
+    # same as the scalar first intersection
+    for i1 in range(len(xs)):
+        res = first_intersection(xs[i1], ys[i1], r_a_0, front)
+        r_a = r_a_0 + np.array([xs[i1], ys[i1], 0])
+        assert res[0][2] == approx(r_a[2] + t[i1]*(-r_a_0[2]/np.linalg.norm(r_a_0)))
+
+    # tracing with the cached first intersection gives the same results
+    nks = np.array([1, 3.5 + 0.01j, 1])
+    alphas = np.array([0, 0.05, 0])
+    widths = np.array([0, 20, 0])
+
+    results = []
+    for first_hit in [None, (t, ind)]:
+        np.random.seed(3)
+        results.append(ray_packet_stack(xs, ys, nks, alphas, r_a_0, surfaces, widths, np.arange(0, 20, 1), 1e-3,
+                                        first_hit=first_hit))
+
+    for x, y in zip(*results):
+        assert np.array_equal(x, y, equal_nan=True)
+
+
+def test_hero_wavelength():
+    from solcore import material, si
+    from rayflare.ray_tracing.rt import rt_structure, spectral_bands
+    from rayflare.textures import planar_surface
+    from rayflare.options import default_options
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.linspace(950, 1150, 11) * 1e-9
+    options.nx = 10
+    options.ny = 10
+    options.n_rays = 20000
+    options.parallel = False
+    options.ray_packets = True
+    options.hero_wavelength = True
+    options.hero_n_tol = 0.05
+
+    nks = np.array([Air.n(options.wavelengths), Si.n(options.wavelengths)])
+    bands = spectral_bands(nks, options.hero_n_tol, options.hero_max_band)
+    assert np.array_equal(np.concatenate(bands), np.arange(11))
+    assert len(bands) < 11
+    assert all(np.ptp(Si.n(options.wavelengths[band])) <= 0.05 for band in bands)
+
+    d = si('200um')
+    rtstr = rt_structure(textures=[planar_surface(), planar_surface()], materials=[Si],
+                         widths=[d], incidence=Air, transmission=Air)
+
+    np.random.seed(2)
+    result = rtstr.calculate(options)
+
+    # incoherent slab
+    n = Si.n(options.wavelengths)
+    R = ((n - 1)/(n + 1))**2
+    tau = np.exp(-Si.alpha(options.wavelengths)*d)
+    R_slab = R + (1 - R)**2*R*tau**2/(1 - R**2*tau**2)
+    T_slab = (1 - R)**2*tau/(1 - R**2*tau**2)
+
+    assert result['R'] == approx(R_slab, abs=0.015)
+    assert result['T'] == approx(T_slab, abs=0.015)
+    assert result['R'] + result['T'] + result['A_per_layer'][:, 0] == approx(1, abs=0.01)
+
+
+def test_hero_wavelength_textured():
+    from solcore import material, si
+    from rayflare.ray_tracing.rt import rt_structure
+    from rayflare.textures import planar_surface, regular_pyramids
+    from rayflare.options import default_options
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.linspace(850, 950, 11) * 1e-9
+    options.nx = 10
+    options.ny = 10
+    options.n_rays = 10000
+    options.parallel = False
+    options.ray_packets = True
+
+    rtstr = rt_structure(textures=[regular_pyramids(), planar_surface()], materials=[Si],
+                         widths=[si('200um')], incidence=Air, transmission=Air)
+
+    np.random.seed(4)
+    result_single = rtstr.calculate(options)
+
+    options.hero_wavelength = True
+    np.random.seed(4)
+    result_hero = rtstr.calculate(options)
+
+    # the ray paths on the textured surface are those of the hero wavelength; this is accurate here, since the light
+    # is absorbed before it can escape near the critical angle at the rear surface (see ray_packet_stack)
+    for quantity in ['R', 'T']:
+        assert result_hero[quantity] == approx(result_single[quantity], abs=0.015)
+    assert result_hero['A_per_layer'][:, 0] == approx(result_single['A_per_layer'][:, 0], abs=0.015)
+
+
+def test_hero_wavelength_critical_angle():
+    from rayflare.ray_tracing.ray_packets import decide_RT_Fresnel_band
+
+    # rays going from n = 3.5 into air at an angle between the critical angles of the wavelengths in the band; the
+    # hero wavelength (the middle one) is totally internally reflected
+    n0_band = np.tile([3.4, 3.5, 3.6], (4, 1))
+    n1_band = np.ones((4, 3))
+    n0, n1 = n0_band[:, 1], n1_band[:, 1]
+    theta = np.full(4, np.arcsin(1/3.45))
+    N = np.tile([0, 0, 1.0], (4, 1))
+    d = np.stack([np.sin(theta), np.zeros(4), -np.cos(theta)], axis=1)
+    rnd = np.array([0.1, 0.5, 0.9, 0.99])
+
+    d_new, side, factor = decide_RT_Fresnel_band(n0, n1, n0_band, n1_band, theta, d, N, np.ones(4), 'u', rnd)
+
+    transmitted = side == -1
+    assert np.any(transmitted) and np.any(~transmitted)
+    # only the first wavelength is transmitted, and the direction is given by Snell's law for it (rather than
+    # grazing, as for the hero wavelength)
+    assert factor[transmitted, 1:] == approx(0)
+    assert d_new[transmitted, 0] == approx(3.4*np.sin(theta[transmitted]))
+    assert d_new[~transmitted] == approx(d[~transmitted] * [1, 1, -1])
+
+
+def test_jit_kernel():
+    from solcore import material, si
+    from rayflare.ray_tracing.rt import rt_structure
+    from rayflare.textures import planar_surface, regular_pyramids
+    from rayflare.options import default_options
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.array([900, 1000, 1100]) * 1e-9
+    options.nx = 10
+    options.ny = 10
+    options.n_rays = 5000
+    options.parallel = False
+    options.ray_packets = False
+    options.jit_kernel = True
+    options.depth_spacing = si('1um')
+
+    d = si('200um')
+    rtstr = rt_structure(textures=[planar_surface(), planar_surface()], materials=[Si],
+                         widths=[d], incidence=Air, transmission=Air)
+
+    np.random.seed(4)
+    result = rtstr.calculate(options)
+
+    # incoherent slab
+    n = Si.n(options.wavelengths)
+    R = ((n - 1)/(n + 1))**2
+    tau = np.exp(-Si.alpha(options.wavelengths)*d)
+    R_slab = R + (1 - R)**2*R*tau**2/(1 - R**2*tau**2)
+    T_slab = (1 - R)**2*tau/(1 - R**2*tau**2)
+
+    assert result['R'] == approx(R_slab, abs=0.03)
+    assert result['T'] == approx(T_slab, abs=0.03)
+    assert np.sum(result['profile'], 1)*1e3 == approx(result['A_per_layer'][:, 0], rel=0.05)
+
+    # same results as the ray packet tracer for a textured surface
+    rtstr = rt_structure(textures=[regular_pyramids(), planar_surface()], materials=[Si],
+                         widths=[d], incidence=Air, transmission=Air)
+    result = rtstr.calculate(options)
+    options.ray_packets = True
+    result_packets = rtstr.calculate(options)
+
+    assert result['R'] == approx(result_packets['R'], abs=0.03)
+    assert result['A_per_layer'] == approx(result_packets['A_per_layer'], abs=0.03)
+
+
+def test_load_balancing(monkeypatch):
+    from rayflare import scheduling
+    from solcore import material, si
+    from rayflare.ray_tracing.rt import rt_structure
+    from rayflare.ray_tracing.convergence import RunningStats
+    from rayflare.scheduling import run_tasks, ray_blocks
+    from rayflare.textures import planar_surface, regular_pyramids
+    from rayflare.options import default_options
+
+    # merged statistics are the same as if all the samples had been added together
+    samples = np.random.rand(50, 3)
+    stats, stats_a, stats_b = RunningStats(3), RunningStats(3), RunningStats(3)
+    stats.update(samples)
+    stats_a.update(samples[:20])
+    stats_b.update(samples[20:])
+    stats_a.merge(stats_b)
+
+    assert stats_a.mean == approx(stats.mean)
+    assert stats_a.std_error() == approx(stats.std_error())
+
+    # results are returned in the original order, whatever the order the tasks are run in
+    assert run_tasks(np.square, [(1,), (2,), (3,)], [1, 3, 2], True, 2) == [1, 4, 9]
+
+    # same with older versions of joblib, which do not yield the results as the tasks finish
+    for return_as in ['generator', None]:
+        monkeypatch.setattr(scheduling, '_return_as', return_as)
+        assert run_tasks(np.square, [(1,), (2,), (3,)], [1, 3, 2], True, 2) == [1, 4, 9]
+    monkeypatch.undo()
+    assert list(ray_blocks([1, 10], 4, 2)) == [1, 4]
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.array([800, 1000, 1150]) * 1e-9
+    options.nx = 5
+    options.ny = 5
+    options.n_rays = 1000
+    options.parallel = True
+    options.ray_packets = True
+    options.n_jobs = 2
+    options.depth_spacing = si('1um')
+
+    rtstr = rt_structure(textures=[regular_pyramids(), planar_surface()], materials=[Si],
+                         widths=[si('200um')], incidence=Air, transmission=Air)
+
+    np.random.seed(5)
+    result = rtstr.calculate(options)
+
+    # the second calculation uses the number of interactions per ray of the first one as the cost of each wavelength,
+    # and traces the rays for the weakly absorbed wavelengths in several blocks
+    assert rtstr.costs[1][2] > rtstr.costs[1][0]
+    result_balanced = rtstr.calculate(options)
+    options.load_balancing = False
+    result_unbalanced = rtstr.calculate(options)
+
+    # the same within the statistical error
+    for res in [result_balanced, result_unbalanced]:
+        R_err = 4*np.sqrt(res['R_err']**2 + result['R_err']**2)
+        A_err = 4*np.sqrt(res['A_per_layer_err']**2 + result['A_per_layer_err']**2)[:, 0]
+        assert np.all(np.abs(res['R'] - result['R']) < R_err)
+        assert np.all(np.abs(res['A_per_layer'][:, 0] - result['A_per_layer'][:, 0]) < A_err)
+        assert np.all(np.abs(np.sum(res['profile'] - result['profile'], 1)*1e3) < A_err)
+
+
+def test_shared_store():
+    import os
+    from rayflare.scheduling import SharedStore, SharedData, run_tasks
+    from rayflare.textures import regular_pyramids
+
+    def surface_arrays_info(surfaces):
+        return [(isinstance(surf.Points, np.memmap), np.sum(surf.crossP)) for surf in surfaces]
+
+    surfaces = regular_pyramids()
+
+    with SharedStore() as store:
+        shared = store.share(surfaces)
+        folder = store.folder
+        assert isinstance(shared, SharedData)
+
+        # the workers receive memory-mapped copies of the surfaces' arrays
+        result = run_tasks(surface_arrays_info, [(shared,)]*4, np.ones(4), True, 2)
+
+    for res in result:
+        assert [info[0] for info in res] == [True, True]
+        assert [info[1] for info in res] == approx([np.sum(surf.crossP) for surf in surfaces])
+
+    assert not os.path.exists(folder)
+
+    # not enabled: objects are passed unchanged
+    with SharedStore(False) as store:
+        assert store.share(surfaces) is surfaces
+
+
+def test_checkpoint_resume(monkeypatch):
+    import os
+    import pytest
+    import shutil
+    from solcore import material
+    from rayflare.ray_tracing import rt
+    from rayflare.structure import RTgroup
+    from rayflare.textures import regular_pyramids
+    from rayflare.options import default_options
+    from rayflare.config import results_path
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.array([500, 800, 1100]) * 1e-9
+    options.nx = 3
+    options.ny = 3
+    options.n_rays = 9*50
+    options.n_theta_bins = 10
+    options.parallel = False
+    options.project_name = 'test_checkpoint'
+    options.checkpoint = True
+
+    structpath = os.path.join(results_path, options.project_name)
+    shutil.rmtree(structpath, ignore_errors=True)
+
+    group = RTgroup(textures=[regular_pyramids()])
+    RT_wl = rt.RT_wl
+    calculated = []
+    interrupt = [True]
+
+    def logged_RT_wl(i1, wl, *args):
+        # the calculation is interrupted at the last wavelength
+        if interrupt[0] and wl > 1000e-9:
+            raise RuntimeError('interrupted')
+        calculated.append(wl)
+        return RT_wl(i1, wl, *args)
+
+    monkeypatch.setattr(rt, 'RT_wl', logged_RT_wl)
+
+    with pytest.raises(RuntimeError):
+        rt.RT(group, Air, Si, 'surf', options, 0, 'front', 0, False, save=True)
+
+    assert len(os.listdir(os.path.join(structpath, 'surffrontcheckpoints'))) == 2
+    assert not os.path.isfile(os.path.join(structpath, 'surffrontRT.npz'))
+
+    # the results saved with different options are not used
+    calculated.clear()
+    options.n_rays = 9*40
+    with pytest.raises(RuntimeError):
+        rt.RT(group, Air, Si, 'surf', options, 0, 'front', 0, False, save=True)
+
+    assert calculated == approx([500e-9, 800e-9])
+    assert len(os.listdir(os.path.join(structpath, 'surffrontcheckpoints'))) == 4
+
+    # resuming only calculates the missing wavelength
+    calculated.clear()
+    interrupt[0] = False
+    full_mat, A_mat = rt.RT(group, Air, Si, 'surf', options, 0, 'front', 0, False, save=True)
+
+    assert calculated == [1100e-9]
+    assert full_mat.shape[0] == 3
+    assert os.path.isfile(os.path.join(structpath, 'surffrontRT.npz'))
+    assert not os.path.exists(os.path.join(structpath, 'surffrontcheckpoints'))
+
+    shutil.rmtree(structpath)
+
+
+def test_incidence_blocks():
+    import os
+    import shutil
+    from solcore import material
+    from rayflare.ray_tracing import rt
+    from rayflare.structure import RTgroup
+    from rayflare.textures import regular_pyramids
+    from rayflare.options import default_options
+    from rayflare.config import results_path
+    from rayflare.angles import angle_grid
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.array([500, 800, 1100]) * 1e-9
+    options.nx = 3
+    options.ny = 3
+    options.n_rays = 9*200
+    options.n_theta_bins = 10
+    options.project_name = 'test_incidence_blocks'
+    structpath = os.path.join(results_path, options.project_name)
+
+    group = RTgroup(textures=[regular_pyramids()])
+
+    results = []
+    for parallel in [False, True]:
+        # in parallel, the incidence angles at each wavelength are traced in several blocks
+        options.parallel = parallel
+        options.n_jobs = 2
+        shutil.rmtree(structpath, ignore_errors=True)
+        full_mat, A_mat = rt.RT(group, Air, Si, 'surf', options, 0, 'front', 0, False, save=True)
+        results.append(full_mat.todense())
+
+    shutil.rmtree(structpath)
+
+    # each column is normalized by the number of rays in its incidence bin (no absorption at this interface)
+    grid = angle_grid(10, options.phi_symmetry, options.c_azimuth)
+    n_a_in = grid.n_a_in
+    assert results[1].shape == results[0].shape
+    assert np.sum(results[1], 1) == approx(np.ones((3, n_a_in)))
+    assert np.mean(np.sum(results[1][:, :18], 1), 1) == approx(np.mean(np.sum(results[0][:, :18], 1), 1), abs=0.02)
+
+    # tracing the incidence bins separately and adding the results gives the full matrices
+    angles_in = grid.angle_vector[:n_a_in]
+    surfaces = [regular_pyramids()[0]]
+    nks = np.array([[1], [Si.n(800e-9)]])
+    xs, ys = np.linspace(0.1, 0.9, 3), np.linspace(0.1, 0.9, 3)
+    args = (3, 3, [], angles_in[:, 1], angles_in[:, 2], surfaces[0].z_max, xs, ys, nks, surfaces, 'u',
+            options.phi_symmetry, grid, 0, 0, None, None, 0, 1)
+    blocks = [rt.RT_wl(0, 800e-9, n_a_in, *args, angles=angles) for angles in np.array_split(np.arange(n_a_in), 3)]
+    out_mat = np.sum([block[0].todense() for block in blocks], 0)
+    assert np.sum(out_mat, 0) == approx(np.ones(n_a_in))
+    for block, angles in zip(blocks, np.array_split(np.arange(n_a_in), 3)):
+        assert np.all(np.delete(block[0].todense(), angles, axis=1) == 0)
+
+
+def test_calculate_iter():
+    from solcore import material, si
+    from rayflare.ray_tracing.rt import rt_structure
+    from rayflare.textures import planar_surface, regular_pyramids
+    from rayflare.options import default_options
+
+    Air = material('Air')()
+    Si = material('Si')()
+
+    options = default_options()
+    options.wavelengths = np.array([700, 900, 1100]) * 1e-9
+    options.nx = 5
+    options.ny = 5
+    options.n_rays = 500
+    options.parallel = True
+    options.ray_packets = True
+    options.n_jobs = 2
+    options.depth_spacing = si('1um')
+
+    rtstr = rt_structure(textures=[regular_pyramids(), planar_surface()], materials=[Si],
+                         widths=[si('200um')], incidence=Air, transmission=Air)
+
+    results = dict(rtstr.calculate_iter(options))
+
+    assert sorted(results) == [0, 1, 2]
+    for result in results.values():
+        assert result['R'] + result['T'] + np.sum(result['A_per_layer']) == approx(1, abs=1e-3)
+        assert result['n_rays'] == 500
+        assert len(result['thetas']) == 500
+
+    # stopping early
+    for i1, result in rtstr.calculate_iter(options):
+        break
+
+    assert rtstr.calculate(options)['R'].shape == (3,)